@@ -175,15 +175,29 @@ class Command(object):
             self.authenticated = False
         if not self.authenticated and 'CONFLUENT_USER' in os.environ:
             username = os.environ['CONFLUENT_USER']
-            passphrase = os.environ['CONFLUENT_PASSPHRASE']
-            self.authenticate(username, passphrase)
-
-    def authenticate(self, username, password):
-        tlvdata.send(self.connection,
-                     {'username': username, 'password': password})
+            if 'CONFLUENT_SESSIONTOKEN' in os.environ:
+                self.authenticate(
+                    username, token=os.environ['CONFLUENT_SESSIONTOKEN'])
+            if not self.authenticated:
+                passphrase = os.environ['CONFLUENT_PASSPHRASE']
+                self.authenticate(username, passphrase)
+
+    def authenticate(self, username, password=None, token=None):
+        """Authenticate by passphrase or by a session token
+
+        A token to authenticate again in another session is kept as
+        sessiontoken.
+        """
+        if token is not None:
+            tlvdata.send(self.connection,
+                         {'username': username, 'sessiontoken': token})
+        else:
+            tlvdata.send(self.connection,
+                         {'username': username, 'password': password})
         authdata = tlvdata.recv(self.connection)
         if authdata['authpassed'] == 1:
             self.authenticated = True
+            self.sessiontoken = authdata.get('sessiontoken', None)
 
     def add_precede_key(self, keyname):
         self._prevkeyname = keyname
@@ -309,6 +323,22 @@ class Command(object):
             cprint('')
             return 0
 
+    def batch_update_attributes(self, nodeattribs, noderange=None):
+        """Set attributes that differ per node in a single request
+
+        The server applies the whole batch as one configuration transaction,
+        which is far faster than a request per node.
+
+        :param nodeattribs: Dictionary of node names to dictionaries of
+                            attributes to set, None clears an attribute
+        :param noderange: Noderange covering the nodes, defaults to
+                          listing the nodes
+        """
+        if noderange is None:
+            noderange = ','.join(nodeattribs)
+        return self.update(
+            '/noderange/{0}/attributes/batch'.format(noderange), nodeattribs)
+
     def read(self, path, parameters=None):
         if not self.authenticated:
             raise Exception('Unauthenticated')
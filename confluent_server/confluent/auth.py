@@ -18,14 +18,24 @@
 # authentication scheme caches passphrase values to help HTTP Basic auth
 # the PBKDF2 transform is skipped unless a user has been idle for sufficient
 # time
+# PBKDF2 is computed by a pool of 'auth_workers' processes, in the [security]
+# section of service.cfg (as many as there are CPUs), started on first use
+# and kept.
+# Once authenticated, a client may be given a session token, signed by a key
+# of this process and good for 'session_token_ttl' seconds (3600) or until
+# the passphrase is changed, to authenticate again without the passphrase.
 
+import base64
+import confluent.config.conf as conf
 import confluent.config.configmanager as configmanager
 import eventlet
+import eventlet.event
 import eventlet.tpool
 import Cryptodome.Protocol.KDF as KDF
 from fnmatch import fnmatch
 import hashlib
 import hmac
+import json
 import multiprocessing
 import os
 import pwd
@@ -38,12 +48,17 @@ except ImportError:
     pass
 import time
 
+try:
+    unicode
+except NameError:
+    unicode = str
+
 _pamservice = 'confluent'
 _passcache = {}
 _passchecking = {}
 
 authworkers = None
-authcleaner = None
+_tokenkey = None
 
 _allowedbyrole = {
     'Operator': {
@@ -204,10 +219,10 @@ def check_user_passphrase(name, passphrase, operation=None, element=None, tenant
     user, tenant = _get_usertenant(name, tenant)
     while (user, tenant) in _passchecking:
         # Want to serialize passphrase checking activity
-        # by a user, which might be malicious
-        # would normally make an event and wait
-        # but here there's no need for that
-        eventlet.sleep(0.5)
+        # by a user, which might be malicious.  Waiting for the check under
+        # way also lets a check of the same passphrase be answered by the
+        # cache it fills
+        _passchecking[(user, tenant)].wait()
     cfm = configmanager.ConfigManager(tenant, username=user)
     ucfg = cfm.get_user(user)
     if ucfg is None:
@@ -234,11 +249,10 @@ def check_user_passphrase(name, passphrase, operation=None, element=None, tenant
             # invalidate cache and force the slower check
             del _passcache[(user, tenant)]
     if 'cryptpass' in ucfg:
-        _passchecking[(user, tenant)] = True
-        # TODO(jbjohnso): WORKERPOOL
-        # PBKDF2 is, by design, cpu intensive
-        # throw it at the worker pool when implemented
-        # maybe a distinct worker pool, wondering about starving out non-auth stuff
+        checking = eventlet.event.Event()
+        _passchecking[(user, tenant)] = checking
+        # PBKDF2 is, by design, cpu intensive, so it is thrown at the
+        # worker pool
         salt, crypt = ucfg['cryptpass']
         # execute inside tpool to get greenthreads to give it a special thread
         # world
@@ -246,21 +260,22 @@ def check_user_passphrase(name, passphrase, operation=None, element=None, tenant
         # such a beast could be passed into pyghmi as a way for pyghmi to
         # magically get offload of the crypto functions without having
         # to explicitly get into the eventlet tpool game
-        global authworkers
-        global authcleaner
-        if authworkers is None:
-            authworkers = multiprocessing.Pool(processes=1)
-        else:
-            authcleaner.cancel()
-        authcleaner = eventlet.spawn_after(30, _clean_authworkers)
-        crypted = eventlet.tpool.execute(_do_pbkdf, passphrase, salt)
-        del _passchecking[(user, tenant)]
+        try:
+            # the pool is made here rather than in the tpool thread, so
+            # concurrent checks cannot each start one
+            crypted = eventlet.tpool.execute(
+                _do_pbkdf, _get_authworkers(), passphrase, salt)
+            if crypt == crypted:
+                _passcache[(user, tenant)] = hashlib.sha256(
+                    bpassphrase).digest()
+        finally:
+            del _passchecking[(user, tenant)]
+            checking.send()
         eventlet.sleep(
             0.05)  # either way, we want to stall so that client can't
         # determine failure because there is a delay, valid response will
         # delay as well
         if crypt == crypted:
-            _passcache[(user, tenant)] = hashlib.sha256(bpassphrase).digest()
             return authorize(user, element, tenant, operation)
     if pam:
         pwe = None
@@ -301,16 +316,92 @@ def _apply_pbkdf(passphrase, salt):
                       lambda p, s: hmac.new(p, s, hashlib.sha256).digest())
 
 
-def _clean_authworkers():
+def _get_authworkers():
     global authworkers
-    global authcleaner
-    authworkers = None
-    authcleaner = None
+    if authworkers is None:
+        workers = conf.get_int_option('security', 'auth_workers')
+        if not workers:
+            workers = multiprocessing.cpu_count()
+        authworkers = multiprocessing.Pool(processes=workers)
+    return authworkers
 
 
-def _do_pbkdf(passphrase, salt):
+def _do_pbkdf(workers, passphrase, salt):
     # we must get it over to the authworkers pool or else get blocked in
     # compute.  However, we do want to wait for result, so we have
     # one of the exceedingly rare sort of circumstances where 'apply'
     # actually makes sense
-    return authworkers.apply(_apply_pbkdf, [passphrase, salt])
+    return workers.apply(_apply_pbkdf, [passphrase, salt])
+
+
+def _sign_token(payload):
+    global _tokenkey
+    if _tokenkey is None:
+        _tokenkey = os.urandom(32)
+    return hmac.new(_tokenkey, payload, hashlib.sha256).digest()
+
+
+def _passphrase_stamp(name):
+    # a value that changes with the passphrase of a user, so that tokens
+    # carrying it end when the passphrase is changed.  It is keyed, as it is
+    # handed to the client.  Passphrases checked by PAM are not known here,
+    # those tokens last until expiry
+    user, tenant = _get_usertenant(name)
+    cfm = configmanager.ConfigManager(tenant, username=user)
+    ucfg = cfm.get_user(user)
+    if not ucfg or 'cryptpass' not in ucfg:
+        return ''
+    salt, crypt = ucfg['cryptpass']
+    return util.stringify(base64.b64encode(_sign_token(salt + crypt)))
+
+
+def make_session_token(name):
+    """Give a token to authenticate as an authenticated name again
+
+    The token is no longer accepted once the passphrase of the user is
+    changed.
+
+    :param name: The login name, as authenticated
+    """
+    ttl = conf.get_int_option('security', 'session_token_ttl')
+    if ttl is None:
+        ttl = 3600
+    payload = json.dumps([util.stringify(name), int(time.time()) + ttl,
+                          _passphrase_stamp(name)])
+    payload = payload.encode('utf8')
+    signature = _sign_token(payload)
+    return util.stringify(b'.'.join(
+        base64.urlsafe_b64encode(x) for x in (payload, signature)))
+
+
+def check_session_token(token):
+    """Check a session token, giving the login name it was made for
+
+    The name is to be authorized as any other, the token only stands in
+    for the passphrase.
+
+    :param token: A token from make_session_token
+    :returns: The login name, or None if the token is invalid or expired
+    """
+    if not isinstance(token, bytes):
+        token = token.encode('utf8')
+    try:
+        payload, signature = [base64.urlsafe_b64decode(x)
+                              for x in token.split(b'.')]
+    except (TypeError, ValueError):
+        return None
+    # nothing in the payload is looked at before it is known to be ours
+    if not hmac.compare_digest(signature, _sign_token(payload)):
+        return None
+    try:
+        name, expiry, stamp = json.loads(payload.decode('utf8'))
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(name, (str, unicode)) or not isinstance(expiry, int):
+        return None
+    if expiry < time.time():
+        return None
+    if not hmac.compare_digest(util.stringify(stamp),
+                               _passphrase_stamp(name)):
+        return None
+    return name
@@ -52,6 +52,7 @@ except ModuleNotFoundError:
     import dbm
 import ast
 import base64
+import collections
 from binascii import hexlify
 import confluent.config.attributes as allattributes
 import confluent.config.conf as conf
@@ -72,6 +73,7 @@ import eventlet.event as event
 import eventlet.green.select as select
 import eventlet.green.threading as gthread
 import fnmatch
+import functools
 import hashlib
 import json
 import msgpack
@@ -88,6 +90,10 @@ try:
     unicode
 except NameError:
     unicode = str
+try:
+    _intern = sys.intern
+except AttributeError:
+    _intern = intern
 
 
 _masterkey = None
@@ -105,6 +111,35 @@ _cfgstore = None
 _pendingchangesets = {}
 _txcount = 0
 _hasquorum = True
+# bumped on any modification so that derived data (e.g. evaluated noderanges)
+# can tell when it is stale
+_cfggeneration = 0
+# the generation each node last changed at, keyed by (tenant, node), and
+# the generation the configuration was last replaced wholesale at
+_nodegenerations = {}
+_replacedgeneration = 0
+_attribindexes = {}
+# Changes are appended to a journal of records, which is folded into the dbm
+# snapshot once it grows past a threshold
+_journalname = 'journal'
+_journaledkeys = {}
+# node and group records may be left pickled until first use, to speed
+# startup
+_lazy_areas = ('nodegroups', 'nodes')
+_loadstats = {}
+# nodes inheriting an attribute from a group share one copy of the value,
+# keyed by (tenant, group, attribute)
+_sharedinherited = {}
+# compiled matchers for attribute watch globs, keyed by glob
+_globmatchers = {}
+_notifierdispatch = None
+# parsed expression templates and fields, and the attributes each expression
+# refers to, shared by every node using the same expression
+_expressioncachesize = 1024
+_templatecache = {}
+_fieldcache = {}
+_expressiondeps = {}
+_templateparser = string.Formatter()
 
 _attraliases = {
     'bmc': 'hardwaremanagement.manager',
@@ -126,6 +161,27 @@ def attrib_supports_expression(attrib):
     return True
 
 
+def _journal_compact_size():
+    compactsize = conf.get_int_option('config', 'journal_compact_size')
+    if compactsize is None:
+        compactsize = 16777216
+    return compactsize
+
+
+def _fsync_dbm(filename):
+    # dbm modules offer no sync of their own, and may add a suffix to the
+    # name they are given
+    for suffix in ('', '.db', '.dat', '.dir', '.pag'):
+        try:
+            fd = os.open(filename + suffix, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
 def _mkpath(pathname):
     try:
         os.makedirs(pathname)
@@ -198,6 +254,89 @@ def _do_notifier(cfg, watcher, callback):
         logException()
 
 
+def _watcher_concurrency():
+    concurrency = conf.get_int_option('config', 'watcher_concurrency')
+    if concurrency is None:
+        concurrency = 32
+    return concurrency
+
+
+def _get_glob_matchers(attrglobs):
+    matchers = []
+    for attrglob in attrglobs:
+        if attrglob not in _globmatchers:
+            _globmatchers[attrglob] = re.compile(
+                fnmatch.translate(attrglob)).match
+        matchers.append((attrglob, _globmatchers[attrglob]))
+    return matchers
+
+
+class _NotifierDispatch(object):
+    """Deliver attribute change notifications to watchers
+
+    Notifications for a watcher that is already queued or running are merged
+    into a single pending callback rather than each getting a greenthread, and
+    at most a fixed number of callbacks run at once.
+    """
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.workers = 0
+        self.pending = {}
+        self.scheduled = set([])
+        self.ready = collections.deque()
+
+    def queue(self, notifierid, cfg, nodeattrs, callback):
+        if notifierid in self.pending:
+            currattrs = self.pending[notifierid]['nodeattrs']
+            for node in nodeattrs:
+                if node not in currattrs:
+                    currattrs[node] = nodeattrs[node]
+                    continue
+                for attrname in nodeattrs[node]:
+                    if attrname not in currattrs[node]:
+                        currattrs[node].append(attrname)
+        else:
+            self.pending[notifierid] = {'cfg': cfg, 'nodeattrs': nodeattrs,
+                                        'callback': callback}
+        if notifierid in self.scheduled:
+            # a worker will pick up the merged notification
+            return
+        self.scheduled.add(notifierid)
+        self.ready.append(notifierid)
+        if self.workers < self.concurrency:
+            self.workers += 1
+            eventlet.spawn_n(self._work)
+
+    def cancel(self, notifierid):
+        self.pending.pop(notifierid, None)
+
+    def _work(self):
+        try:
+            while self.ready:
+                notifierid = self.ready.popleft()
+                watcher = self.pending.pop(notifierid, None)
+                try:
+                    if watcher is not None:
+                        _do_notifier(watcher['cfg'], watcher,
+                                     watcher['callback'])
+                finally:
+                    if notifierid in self.pending:
+                        # changes arrived while the callback ran
+                        self.ready.append(notifierid)
+                    else:
+                        self.scheduled.discard(notifierid)
+        finally:
+            self.workers -= 1
+
+
+def _get_notifier_dispatch():
+    global _notifierdispatch
+    if _notifierdispatch is None:
+        _notifierdispatch = _NotifierDispatch(_watcher_concurrency())
+    return _notifierdispatch
+
+
 
 def _rpc_master_del_usergroup(tenant, name):
     ConfigManager(tenant).del_usergroup(name)
@@ -228,6 +367,14 @@ def _rpc_master_set_node_attributes(tenant, attribmap, autocreate):
     ConfigManager(tenant).set_node_attributes(attribmap, autocreate)
 
 
+def _rpc_master_batch_node_attributes(tenant, attribmaps, autocreate):
+    ConfigManager(tenant).batch_node_attributes(attribmaps, autocreate)
+
+
+def _rpc_batch_node_attributes(tenant, attribmaps, autocreate):
+    ConfigManager(tenant)._true_batch_node_attributes(attribmaps, autocreate)
+
+
 def _rpc_master_rename_nodes(tenant, renamemap):
     ConfigManager(tenant).rename_nodes(renamemap)
 
@@ -508,6 +655,25 @@ def grub_hashcrypt_value(value):
     return ret
 
 
+def _hash_crypted_attributes(attribmap):
+    # crypted values are hashed once up front, so that the collective
+    # only ever sees the hashes
+    for element in attribmap:
+        curr = attribmap[element]
+        for attrib in curr:
+            if attrib.startswith('crypted.') and curr[attrib] is not None:
+                if not isinstance(curr[attrib], dict):
+                    curr[attrib] = {'value': curr[attrib]}
+                if 'hashvalue' not in curr[attrib]:
+                    curr[attrib]['hashvalue'] = hashcrypt_value(
+                        curr[attrib]['value'])
+                    if 'grubhashvalue' not in curr[attrib]:
+                        curr[attrib]['grubhashvalue'] = grub_hashcrypt_value(
+                            curr[attrib]['value'])
+                if 'value' in curr[attrib]:
+                    del curr[attrib]['value']
+
+
 def hashcrypt_value(value):
     salt = confluent.util.stringify(base64.b64encode(os.urandom(12),
                                     altchars=b'./'))
@@ -534,29 +700,234 @@ def crypt_value(value,
     return iv, cryptval, hmac, b'\x02'
 
 
-def _load_dict_from_dbm(dpath, tdb):
+class _LazyRecords(dict):
+    """Dictionary of records that are unpickled on first access
+
+    For fast startup, records are held in their compact pickled form as read
+    from the dbm snapshot and only turned into live objects when something
+    actually looks at them.  Key membership and iteration do not require
+    the records to be loaded.
+    """
+
+    def __init__(self):
+        super(_LazyRecords, self).__init__()
+        self._pending = {}
+        self._compactor = None
+
+    def add_pending(self, key, rawvalue):
+        self._pending[key] = rawvalue
+
+    def set_compactor(self, compactor):
+        self._compactor = compactor
+
+    def _fault(self, key):
+        rawvalue = self._pending.pop(key, None)
+        if rawvalue is None:  # someone else got to it first
+            return dict.__getitem__(self, key)
+        value = cPickle.loads(rawvalue)
+        if self._compactor is not None:
+            value = self._compactor(value)
+        dict.__setitem__(self, key, value)
+        return value
+
+    def _fault_all(self):
+        for key in list(self._pending):
+            self._fault(key)
+
+    def __missing__(self, key):
+        if key in self._pending:
+            return self._fault(key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._pending
+
+    def __iter__(self):
+        return iter(list(dict.keys(self)) + list(self._pending))
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._pending)
+
+    def __setitem__(self, key, value):
+        self._pending.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if self._pending.pop(key, None) is None:
+            dict.__delitem__(self, key)
+
+    def __eq__(self, other):
+        self._fault_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.copy(), memo)
+
+    def copy(self):
+        self._fault_all()
+        return dict(dict.items(self))
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        self._fault_all()
+        return dict.items(self)
+
+    def values(self):
+        self._fault_all()
+        return dict.values(self)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        if key in self._pending:
+            self._fault(key)
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self._pending.clear()
+        dict.clear(self)
+
+
+def _load_dict_from_dbm(dpath, tdb, lazy=False):
     try:
         dbe = dbm.open(tdb, 'r')
         currdict = _cfgstore
         for elem in dpath:
             elem = confluent.util.stringify(elem)
             if elem not in currdict:
-                currdict[elem] = {}
+                if lazy and elem == dpath[-1]:
+                    currdict[elem] = _LazyRecords()
+                else:
+                    currdict[elem] = {}
             currdict = currdict[elem]
+        if lazy:
+            loadrecord = currdict.add_pending
+        else:
+            loadrecord = lambda k, v: currdict.__setitem__(k, cPickle.loads(v))
         try:
             for tk in dbe.keys():
                 tks = confluent.util.stringify(tk)
-                currdict[tks] = cPickle.loads(dbe[tk])
+                loadrecord(tks, dbe[tk])
         except AttributeError:
             tk = dbe.firstkey()
             while tk != None:
                 tks = confluent.util.stringify(tk)
-                currdict[tks] = cPickle.loads(dbe[tk])
+                loadrecord(tks, dbe[tk])
                 tk = dbe.nextkey(tk)
     except dbm.error:
         return
 
 
+def _intern_name(name):
+    if isinstance(name, str):
+        return _intern(name)
+    return name
+
+
+def _shared_inherited(tenant, groupcfg, group, attrib):
+    """Get the copy of a group attribute shared by all inheriting nodes
+
+    :param tenant: The tenant the group belongs to
+    :param groupcfg: The configuration record of the group
+    :param group: The name of the group
+    :param attrib: The name of the attribute being inherited
+    """
+    groupattr = groupcfg[attrib]
+    key = (tenant, group, attrib)
+    cached = _sharedinherited.get(key)
+    # group attributes are replaced rather than modified when changed, so
+    # identity tells whether the shared copy is still current
+    if cached is None or cached[0] is not groupattr:
+        shared = copy.deepcopy(groupattr)
+        shared['inheritedfrom'] = group
+        cached = (groupattr, shared)
+        _sharedinherited[key] = cached
+    return cached[1]
+
+
+def _forget_shared_inherited(tenant, group, attrib=None):
+    """Drop the shared copies of attributes of a group
+
+    :param tenant: The tenant the group belongs to
+    :param group: The name of the group
+    :param attrib: The attribute to drop, or None for all of the group
+    """
+    if attrib is not None:
+        _sharedinherited.pop((tenant, group, attrib), None)
+        return
+    for key in [key for key in _sharedinherited
+                if key[0] == tenant and key[1] == group]:
+        del _sharedinherited[key]
+
+
+def _compact_record(record, tenant=None, groups=None):
+    """Rebuild a freshly unpickled record in its compact form
+
+    Attribute names are interned and, if groups is given, inherited values
+    are replaced by the copy shared with other members of the group.
+    """
+    compact = {}
+    for attrib in record:
+        val = record[attrib]
+        if (groups is not None and isinstance(val, dict) and
+                'inheritedfrom' in val and 'expression' not in val):
+            group = val['inheritedfrom']
+            try:
+                shared = _shared_inherited(tenant, groups[group], group,
+                                           attrib)
+            except KeyError:
+                shared = None
+            if shared == val:
+                val = shared
+        elif attrib == 'groups' and isinstance(val, list):
+            val = [_intern_name(x) for x in val]
+        compact[_intern_name(attrib)] = val
+    return compact
+
+
+def _compact_loaded_records():
+    stores = [(None, _cfgstore.get('main', {}))]
+    stores.extend(_cfgstore.get('tenant', {}).items())
+    for tenant, store in stores:
+        groups = store.get('nodegroups', {})
+        for category, inherit in (('nodegroups', None), ('nodes', groups)):
+            records = store.get(category, None)
+            if records is None:
+                continue
+            compactor = functools.partial(_compact_record, tenant=tenant,
+                                          groups=inherit)
+            if isinstance(records, _LazyRecords):
+                records.set_compactor(compactor)
+                keys = list(dict.keys(records))
+            else:
+                keys = list(records)
+            for key in keys:
+                dict.__setitem__(records, key, compactor(records[key]))
+
+
+def get_load_stats():
+    """Report how long the configuration took to load and in what mode"""
+    return dict(_loadstats)
+
+
 def is_tenant(tenant):
     try:
         return tenant in _cfgstore['tenant']
@@ -761,6 +1132,8 @@ def rollback_clear():
     global _oldtxcount
     _txcount = _oldtxcount
     _cfgstore = _oldcfgstore
+    _bump_generation(replaced=True)
+    _clear_attrib_indexes()
     _oldtxcount = 0
     _oldcfgstore = None
     ConfigManager.wait_for_sync(True)
@@ -777,6 +1150,8 @@ def clear_configuration():
     _oldtxcount = _txcount
     _cfgstore = {}
     _txcount = 0
+    _bump_generation(replaced=True)
+    _clear_attrib_indexes()
 
 def commit_clear():
     global _oldtxcount
@@ -792,7 +1167,9 @@ def commit_clear():
     _oldcfgstore = None
     _oldtxcount = 0
     with _synclock:
-        todelete = ('transactioncount', 'globals', 'collective') + _config_areas
+        todelete = ('transactioncount', 'globals', 'collective',
+                    _journalname) + _config_areas
+        _journaledkeys.clear()
         for cfg in todelete:
             try:
                 os.remove(os.path.join(ConfigManager._cfgdir, cfg))
@@ -948,16 +1325,43 @@ def get_collective_member_by_address(address):
             return currdrone
 
 
-def _mark_dirtykey(category, key, tenant=None):
+def _bump_generation(replaced=False):
+    global _cfggeneration
+    global _replacedgeneration
+    _cfggeneration += 1
+    if replaced:
+        _replacedgeneration = _cfggeneration
+        _nodegenerations.clear()
+
+
+def _clear_attrib_indexes():
+    # for wholesale replacement of the configuration, the indexes and shared
+    # inherited values get rebuilt from scratch on next use
+    _attribindexes.clear()
+    _sharedinherited.clear()
+
+
+def _mark_dirtykey(category, key, tenant=None, attrib=None):
+    # dirty keys map to the attributes changed, or None if the whole
+    # record is to be written
+    _bump_generation()
     key = confluent.util.stringify(key)
+    if category == 'nodes':
+        _nodegenerations[(tenant, key)] = _cfggeneration
     with _dirtylock:
         if 'dirtykeys' not in _cfgstore:
             _cfgstore['dirtykeys'] = {}
         if tenant not in _cfgstore['dirtykeys']:
             _cfgstore['dirtykeys'][tenant] = {}
         if category not in _cfgstore['dirtykeys'][tenant]:
-            _cfgstore['dirtykeys'][tenant][category] = set()
-        _cfgstore['dirtykeys'][tenant][category].add(key)
+            _cfgstore['dirtykeys'][tenant][category] = {}
+        dirtykeys = _cfgstore['dirtykeys'][tenant][category]
+        if attrib is None:
+            dirtykeys[key] = None
+        elif key not in dirtykeys:
+            dirtykeys[key] = set([attrib])
+        elif dirtykeys[key] is not None:
+            dirtykeys[key].add(attrib)
 
 
 def _generate_new_id():
@@ -997,9 +1401,11 @@ class _ExpressionFormat(string.Formatter):
         self._nodename = nodename
         self._numbers = None
 
+    def parse(self, format_string):
+        return _parse_template(format_string)
+
     def get_field(self, field_name, args, kwargs):
-        parsed = ast.parse(field_name)
-        return self._handle_ast_node(parsed.body[0].value), field_name
+        return self._handle_ast_node(_parse_field(field_name)), field_name
 
     def _handle_ast_node(self, node):
         if isinstance(node, ast.Num):
@@ -1059,6 +1465,72 @@ class _ExpressionFormat(string.Formatter):
         return val
 
 
+def _cache_expression(cache, key, value):
+    if len(cache) >= _expressioncachesize:
+        cache.clear()
+    cache[key] = value
+
+
+def _parse_template(template):
+    parsed = _templatecache.get(template, None)
+    if parsed is None:
+        parsed = tuple(_templateparser.parse(template))
+        _cache_expression(_templatecache, template, parsed)
+    return parsed
+
+
+def _parse_field(field_name):
+    parsed = _fieldcache.get(field_name, None)
+    if parsed is None:
+        parsed = ast.parse(field_name).body[0].value
+        _cache_expression(_fieldcache, field_name, parsed)
+    return parsed
+
+
+def _field_dependencies(node, deps):
+    if isinstance(node, ast.Attribute):
+        key = ''
+        while isinstance(node, ast.Attribute):
+            key = '.' + node.attr + key
+            node = node.value
+        deps.add(node.id + key)
+    elif isinstance(node, ast.Name):
+        var = node.id
+        if var in ('node', 'nodename'):
+            return
+        if var in _attraliases:
+            deps.add(_attraliases[var])
+        elif not re.match(_ExpressionFormat.posmatch, var):
+            deps.add(var)
+    elif isinstance(node, ast.BinOp):
+        _field_dependencies(node.left, deps)
+        _field_dependencies(node.right, deps)
+
+
+def _expression_dependencies(expression):
+    """Determine the attributes an expression refers to
+
+    Returns a frozenset of attribute names, or None if the expression could
+    not be understood, in which case it must be assumed to depend on
+    everything.
+    """
+    if expression in _expressiondeps:
+        return _expressiondeps[expression]
+    deps = set([])
+    try:
+        for _, field_name, format_spec, _ in _parse_template(expression):
+            if field_name is None:
+                continue
+            _field_dependencies(_parse_field(field_name), deps)
+            if format_spec and '{' in format_spec:
+                deps.update(_expression_dependencies(format_spec))
+        deps = frozenset(deps)
+    except Exception:
+        deps = None
+    _cache_expression(_expressiondeps, expression, deps)
+    return deps
+
+
 def _decode_attribute(attribute, nodeobj, formatter=None, decrypt=False):
     if attribute not in nodeobj:
         return None
@@ -1067,7 +1539,7 @@ def _decode_attribute(attribute, nodeobj, formatter=None, decrypt=False):
     # get methods will skip the formatter allowing value to come on through
     # set methods induce recalculation as appropriate to get a cached value
     if 'expression' in nodeobj[attribute] and formatter is not None:
-        retdict = copy.deepcopy(nodeobj[attribute])
+        retdict = dict(nodeobj[attribute])
         if 'value' in retdict:
             del retdict['value']
         try:
@@ -1078,7 +1550,7 @@ def _decode_attribute(attribute, nodeobj, formatter=None, decrypt=False):
     elif 'value' in nodeobj[attribute]:
         return nodeobj[attribute]
     elif 'cryptvalue' in nodeobj[attribute] and decrypt:
-        retdict = copy.deepcopy(nodeobj[attribute])
+        retdict = dict(nodeobj[attribute])
         retdict['value'] = decrypt_value(nodeobj[attribute]['cryptvalue'])
         return retdict
     return nodeobj[attribute]
@@ -1097,6 +1569,67 @@ def _addchange(changeset, node, attrname):
         changeset[node][attrname] = 1
 
 
+class _AttributeIndex(object):
+    """Inverted index of node attribute values
+
+    Maps each attribute name to the distinct values in use and the nodes
+    having each value, so that filters need only consider distinct values
+    rather than every node.  Only plain 'value' entries are indexed, which
+    is all that filter_node_attributes ever considers.
+    """
+
+    def __init__(self, nodes):
+        self.byattr = {}
+        self.present = {}
+        self.nodevals = {}
+        for node in nodes:
+            self.update_node(node, nodes[node])
+
+    def _remove(self, node, attr):
+        val = self.nodevals[node].pop(attr)
+        valnodes = self.byattr[attr][val]
+        valnodes.discard(node)
+        if not valnodes:
+            del self.byattr[attr][val]
+        self.present[attr].discard(node)
+        if not self.present[attr]:
+            del self.byattr[attr]
+            del self.present[attr]
+
+    def _add(self, node, attr, val):
+        self.nodevals[node][attr] = val
+        if attr not in self.byattr:
+            self.byattr[attr] = {}
+            self.present[attr] = set([])
+        if val not in self.byattr[attr]:
+            self.byattr[attr][val] = set([])
+        self.byattr[attr][val].add(node)
+        self.present[attr].add(node)
+
+    def update_node(self, node, nodecfg, attributes=None):
+        if node not in self.nodevals:
+            self.nodevals[node] = {}
+        if attributes is None:
+            attributes = set(nodecfg) | set(self.nodevals[node])
+        for attr in attributes:
+            try:
+                val = nodecfg[attr]['value']
+                hash(val)
+            except (KeyError, TypeError):
+                val = None
+            if attr in self.nodevals[node]:
+                if val is not None and self.nodevals[node][attr] == val:
+                    continue
+                self._remove(node, attr)
+            if val is not None:
+                self._add(node, attr, val)
+
+    def remove_node(self, node):
+        for attr in list(self.nodevals.get(node, ())):
+            self._remove(node, attr)
+        self.nodevals.pop(node, None)
+
+
 def hook_new_configmanagers(callback):
     """Register callback for new tenants
 
@@ -1175,6 +1708,16 @@ class ConfigManager(object):
     def get_collective_member(self, name):
         return get_collective_member(name)
 
+    @property
+    def generation(self):
+        """A counter that changes whenever configuration is modified"""
+        return _cfggeneration
+
+    def get_node_generation(self, node):
+        """Give a counter that changes whenever the given node is modified"""
+        return max(_nodegenerations.get((self.tenant, node), 0),
+                   _replacedgeneration)
+
     @classmethod
     def check_quorum(cls):
         return check_quorum()
@@ -1217,34 +1760,50 @@ class ConfigManager(object):
             raise Exception('Invalid Expression')
         if attribute.startswith('secret.'):
             raise Exception('Filter by secret attributes is not supported')
-        for node in nodes:
-            try:
-                currvals = [self._cfgstore['nodes'][node][attribute]['value']]
-            except KeyError:
-                # Let's treat 'not set' as being an empty string for this path
-                currvals = list(
-                    [self._cfgstore['nodes'][node][x].get('value', '') 
-                    for x in fnmatch.filter(self._cfgstore['nodes'][node], attribute)])
-                currvals.append('')
-            for currval in currvals:
-                if exmatch:
-                    if yieldmatches:
-                        if exmatch.search(currval):
-                            yield node
-                            break
-                    else:
-                        if not exmatch.search(currval):
-                            yield node
-                            break
-                else:
-                    if yieldmatches:
-                        if match == currval:
-                            yield node
-                            break
-                    else:
-                        if match != currval:
-                            yield node
-                            break
+
+        def ismatch(currval):
+            if exmatch:
+                return (isinstance(currval, (str, unicode)) and
+                        exmatch.search(currval) is not None)
+            return match == currval
+
+        index = self._get_attrib_index()
+        candidates = set(nodes) & set(self._cfgstore['nodes'])
+        found = set([])
+        # Only distinct values need to be checked, each one bringing along
+        # every node that has it
+        for attr in fnmatch.filter(list(index.byattr), attribute):
+            for currval in index.byattr[attr]:
+                if ismatch(currval) == yieldmatches:
+                    found |= index.byattr[attr][currval]
+        if ismatch('') == yieldmatches:
+            # Let's treat 'not set' as being an empty string for this path
+            if '*' in attribute or '?' in attribute or '[' in attribute:
+                # a wildcard always considers the empty string
+                found = candidates
+            else:
+                found |= candidates - index.present.get(attribute, set([]))
+        for node in found & candidates:
+            yield node
+
+    def _get_attrib_index(self):
+        try:
+            return _attribindexes[self.tenant]
+        except KeyError:
+            index = _AttributeIndex(self._cfgstore['nodes'])
+            _attribindexes[self.tenant] = index
+            return index
+
+    def _update_attrib_index(self, changeset):
+        if self.tenant not in _attribindexes:
+            return  # index will be built fresh on first use
+        index = _attribindexes[self.tenant]
+        for node in changeset:
+            if node not in self._cfgstore['nodes']:
+                index.remove_node(node)
+            else:
+                index.update_node(node, self._cfgstore['nodes'][node],
+                                  changeset[node])
 
     def filter_nodenames(self, expression, nodes=None):
         """Filter nodenames by regular expression
@@ -1295,6 +1854,8 @@ class ConfigManager(object):
                     currglobs = attribwatchers[node].get('_attrglobs', set([]))
                     currglobs.add(attribute)
                     attribwatchers[node]['_attrglobs'] = currglobs
+                    attribwatchers[node]['_globmatchers'] = \
+                        _get_glob_matchers(sorted(currglobs))
         return notifierid
 
     def watch_nodecollection(self, callback):
@@ -1334,6 +1895,7 @@ class ConfigManager(object):
             for nodeattrib in self._notifierids[watcher]['attriblist']:
                 node, attrib = nodeattrib
                 del attribwatchers[node][attrib][watcher]
+            _get_notifier_dispatch().cancel(watcher)
         elif 'nodecollection' in self._notifierids[watcher]:
             del self._nodecollwatchers[self.tenant][watcher]
         else:
@@ -1689,12 +2251,12 @@ class ConfigManager(object):
                 if srcgroup is not None and group != srcgroup:
                     # skip needless deepcopy
                     return
-                nodecfg[attrib] = \
-                    copy.deepcopy(self._cfgstore['nodegroups'][group][attrib])
-                nodecfg[attrib]['inheritedfrom'] = group
+                nodecfg[_intern_name(attrib)] = _shared_inherited(
+                    self.tenant, self._cfgstore['nodegroups'][group], group,
+                    attrib)
                 self._refresh_nodecfg(nodecfg, attrib, nodename,
                                       changeset=changeset)
-                _mark_dirtykey('nodes', nodename, self.tenant)
+                _mark_dirtykey('nodes', nodename, self.tenant, attrib)
                 return
             if srcgroup is not None and group == srcgroup:
                 # break out
@@ -1739,20 +2301,7 @@ class ConfigManager(object):
         self.set_group_attributes(attribmap, autocreate=True)
 
     def set_group_attributes(self, attribmap, autocreate=False):
-        for group in attribmap:
-            curr = attribmap[group]
-            for attrib in curr:
-                if attrib.startswith('crypted.'):
-                    if not isinstance(curr[attrib], dict):
-                        curr[attrib] = {'value': curr[attrib]}
-                    if 'hashvalue' not in curr[attrib]:
-                        curr[attrib]['hashvalue'] = hashcrypt_value(
-                            curr[attrib]['value'])
-                        if 'grubhashvalue' not in curr[attrib]:
-                            curr[attrib]['grubhashvalue'] = grub_hashcrypt_value(
-                                curr[attrib]['value'])
-                    if 'value' in curr[attrib]:
-                        del curr[attrib]['value']
+        _hash_crypted_attributes(attribmap)
         if cfgleader:  # currently config slave to another
             return exec_on_leader('_rpc_master_set_group_attributes',
                                   self.tenant, attribmap, autocreate)
@@ -1900,6 +2449,7 @@ class ConfigManager(object):
                             del groupentry[attrib]
                         except KeyError:
                             pass
+                        _forget_shared_inherited(self.tenant, group, attrib)
                         for node in groupentry['nodes']:
                             nodecfg = self._cfgstore['nodes'][node]
                             try:
@@ -1912,7 +2462,8 @@ class ConfigManager(object):
                                 self._do_inheritance(nodecfg, attrib, node,
                                                      changeset)
                                 _addchange(changeset, node, attrib)
-                                _mark_dirtykey('nodes', node, self.tenant)
+                                _mark_dirtykey('nodes', node, self.tenant,
+                                               attrib)
                 _mark_dirtykey('nodegroups', group, self.tenant)
         self._notif_attribwatchers(changeset)
         self._bg_sync_to_file()
@@ -1928,10 +2479,14 @@ class ConfigManager(object):
                 attrname in cfgobj['_expressionkeys']):
             if exprmgr is None:
                 exprmgr = _ExpressionFormat(cfgobj, node)
-            self._recalculate_expressions(cfgobj, formatter=exprmgr, node=node,
-                                          changeset=changeset)
+            self._recalculate_dependents(cfgobj, (attrname,),
+                                         formatter=exprmgr, node=node,
+                                         changeset=changeset)
 
     def _notif_attribwatchers(self, nodeattrs):
+        # all attribute changes funnel through here, so keep the value index
+        # current before notifying anyone
+        self._update_attrib_index(nodeattrs)
         if self.tenant not in self._attribwatchers:
             return
         notifdata = {}
@@ -1949,19 +2504,18 @@ class ConfigManager(object):
                 # to deletion, to make all watchers aware of the removed
                 # node and take appropriate action
                 checkattrs = attribwatcher
-            globattrs = {}
-            for attrglob in attribwatcher.get('_attrglobs', []):
-                for matched in fnmatch.filter(list(checkattrs), attrglob):
-                    globattrs[matched] = attrglob
+            globmatchers = attribwatcher.get('_globmatchers', ())
             for attrname in checkattrs:
-                if attrname == '_attrglobs':
+                if attrname in ('_attrglobs', '_globmatchers'):
                     continue
                 watchkey = attrname
                 # the attrib watcher could still have a glob
                 if attrname not in attribwatcher:
-                    if attrname in globattrs:
-                        watchkey = globattrs[attrname]
-                    else:
+                    watchkey = None
+                    for attrglob, matcher in globmatchers:
+                        if matcher(attrname):
+                            watchkey = attrglob
+                    if watchkey is None:
                         continue
                 for notifierid in attribwatcher[watchkey]:
                     if notifierid in notifdata:
@@ -1976,10 +2530,11 @@ class ConfigManager(object):
                             'nodeattrs': {node: [attrname]},
                             'callback': attribwatcher[watchkey][notifierid]
                         }
-        for watcher in notifdata:
-            watcher = notifdata[watcher]
-            callback = watcher['callback']
-            eventlet.spawn_n(_do_notifier, self, watcher, callback)
+        dispatch = _get_notifier_dispatch()
+        for notifierid in notifdata:
+            watcher = notifdata[notifierid]
+            dispatch.queue(notifierid, self, watcher['nodeattrs'],
+                           watcher['callback'])
 
     def del_nodes(self, nodes):
         if isinstance(nodes, set):
@@ -2025,6 +2580,7 @@ class ConfigManager(object):
                 self._sync_nodes_to_group(group=group, nodes=[],
                                           changeset=changeset)
                 del self._cfgstore['nodegroups'][group]
+                _forget_shared_inherited(self.tenant, group)
                 _mark_dirtykey('nodegroups', group, self.tenant)
         self._notif_attribwatchers(changeset)
         self._bg_sync_to_file()
@@ -2041,6 +2597,11 @@ class ConfigManager(object):
     def _true_clear_node_attributes(self, nodes, attributes):
         # accumulate all changes into a changeset and push in one go
         changeset = {}
+        self._apply_clear_node_attributes(nodes, attributes, changeset)
+        self._notif_attribwatchers(changeset)
+        self._bg_sync_to_file()
+
+    def _apply_clear_node_attributes(self, nodes, attributes, changeset):
         realattributes = []
         for attrname in list(attributes):
             if attrname in _attraliases:
@@ -2054,7 +2615,7 @@ class ConfigManager(object):
                 nodek = self._cfgstore['nodes'][node]
             except KeyError:
                 continue
-            recalcexpressions = False
+            recalcexpressions = []
             for attrib in attributes:
                 if attrib in nodek and 'inheritedfrom' not in nodek[attrib]:
                     # if the attribute is set and not inherited,
@@ -2062,16 +2623,15 @@ class ConfigManager(object):
                     del nodek[attrib]
                     self._do_inheritance(nodek, attrib, node, changeset)
                     _addchange(changeset, node, attrib)
-                    _mark_dirtykey('nodes', node, self.tenant)
+                    _mark_dirtykey('nodes', node, self.tenant, attrib)
                 if ('_expressionkeys' in nodek and
                         attrib in nodek['_expressionkeys']):
-                    recalcexpressions = True
+                    recalcexpressions.append(attrib)
             if recalcexpressions:
                 exprmgr = _ExpressionFormat(nodek, node)
-                self._recalculate_expressions(nodek, formatter=exprmgr,
-                                              node=node, changeset=changeset)
-        self._notif_attribwatchers(changeset)
-        self._bg_sync_to_file()
+                self._recalculate_dependents(nodek, recalcexpressions,
+                                             formatter=exprmgr, node=node,
+                                             changeset=changeset)
 
     def add_node_attributes(self, attribmap):
         for node in attribmap:
@@ -2106,6 +2666,10 @@ class ConfigManager(object):
         for name in renamemap:
             self._cfgstore['nodes'][renamemap[name]] = self._cfgstore['nodes'][name]
             del self._cfgstore['nodes'][name]
+            if self.tenant in _attribindexes:
+                _attribindexes[self.tenant].remove_node(name)
+                _attribindexes[self.tenant].update_node(
+                    renamemap[name], self._cfgstore['nodes'][renamemap[name]])
             _mark_dirtykey('nodes', name, self.tenant)
             _mark_dirtykey('nodes', renamemap[name], self.tenant)
             for group in self._cfgstore['nodes'][renamemap[name]].get('groups', []):
@@ -2118,6 +2682,7 @@ class ConfigManager(object):
             if exprmgr is None:
                 exprmgr = _ExpressionFormat(cfgobj, node)
             self._recalculate_expressions(cfgobj, formatter=exprmgr, node=renamemap[name], changeset=changeset)
+            self._update_attrib_index(changeset)
         if self.tenant in self._nodecollwatchers:
             nodecollwatchers = self._nodecollwatchers[self.tenant]
             for watcher in nodecollwatchers:
@@ -2150,6 +2715,7 @@ class ConfigManager(object):
         for name in renamemap:
             self._cfgstore['nodegroups'][renamemap[name]] = self._cfgstore['nodegroups'][name]
             del self._cfgstore['nodegroups'][name]
+            _forget_shared_inherited(self.tenant, name)
             _mark_dirtykey('nodegroups', name, self.tenant)
             _mark_dirtykey('nodegroups', renamemap[name], self.tenant)
             for node in self._cfgstore['nodegroups'][renamemap[name]].get('nodes', []):
@@ -2161,20 +2727,7 @@ class ConfigManager(object):
 
 
     def set_node_attributes(self, attribmap, autocreate=False):
-        for node in attribmap:
-            curr = attribmap[node]
-            for attrib in curr:
-                if attrib.startswith('crypted.'):
-                    if not isinstance(curr[attrib], dict):
-                        curr[attrib] = {'value': curr[attrib]}
-                    if 'hashvalue' not in curr[attrib]:
-                        curr[attrib]['hashvalue'] = hashcrypt_value(
-                            curr[attrib]['value'])
-                        if 'grubhashvalue' not in curr[attrib]:
-                            curr[attrib]['grubhashvalue'] = grub_hashcrypt_value(
-                                curr[attrib]['value'])
-                    if 'value' in curr[attrib]:
-                        del curr[attrib]['value']
+        _hash_crypted_attributes(attribmap)
         if cfgleader:  # currently config slave to another
             return exec_on_leader('_rpc_master_set_node_attributes',
                                         self.tenant, attribmap, autocreate)
@@ -2183,14 +2736,79 @@ class ConfigManager(object):
                                    self.tenant, attribmap, autocreate)
         self._true_set_node_attributes(attribmap, autocreate)
 
+    def batch_node_attributes(self, attribmaps, autocreate=False):
+        """Apply a sequence of node attribute changes as one transaction
+
+        Each entry is an attribute map as given to set_node_attributes,
+        except that a value of None clears the attribute.  Entries are
+        applied in order, with one request to the collective leader and one
+        replication message to each follower for the whole sequence.
+
+        :param attribmaps: List of dicts of node names to attribute maps
+        :param autocreate: Whether to create nodes that do not yet exist
+        """
+        for attribmap in attribmaps:
+            _hash_crypted_attributes(attribmap)
+        if cfgleader:  # currently config slave to another
+            return exec_on_leader('_rpc_master_batch_node_attributes',
+                                  self.tenant, attribmaps, autocreate)
+        if cfgstreams:
+            exec_on_followers('_rpc_batch_node_attributes',
+                              self.tenant, attribmaps, autocreate)
+        self._true_batch_node_attributes(attribmaps, autocreate)
+
+    def _true_batch_node_attributes(self, attribmaps, autocreate=False):
+        steps = []
+        for attribmap in attribmaps:
+            clearsets = {}
+            setmap = {}
+            for node in attribmap:
+                clearattribs = []
+                setattribs = {}
+                for attrname in attribmap[node]:
+                    if attribmap[node][attrname] is None:
+                        clearattribs.append(attrname)
+                    else:
+                        setattribs[attrname] = attribmap[node][attrname]
+                if clearattribs:
+                    clearattribs = tuple(sorted(clearattribs))
+                    clearsets.setdefault(clearattribs, []).append(node)
+                if setattribs or not clearattribs:
+                    setmap[node] = setattribs
+            # every entry is checked before any is applied, so an invalid
+            # one leaves the configuration untouched
+            if setmap:
+                self._check_node_attributes(setmap, autocreate)
+            steps.append((clearsets, setmap))
+        changeset = {}
+        newnodes = []
+        for clearsets, setmap in steps:
+            # clear before set, as if the attribute map had been given to
+            # clear_node_attributes and then set_node_attributes
+            for clearattribs in clearsets:
+                self._apply_clear_node_attributes(
+                    clearsets[clearattribs], clearattribs, changeset)
+            if setmap:
+                newnodes.extend(self._apply_node_attributes(setmap, changeset))
+        self._notif_node_changes(changeset, newnodes)
+        self._bg_sync_to_file()
+
     def _true_set_node_attributes(self, attribmap, autocreate):
         # TODO(jbjohnso): multi mgr support, here if we have peers,
         # pickle the arguments and fire them off in eventlet
         # flows to peers, all should have the same result
-        newnodes = []
         changeset = {}
         # first do a sanity check of the input upfront
         # this mitigates risk of arguments being partially applied
+        self._check_node_attributes(attribmap, autocreate)
+        newnodes = self._apply_node_attributes(attribmap, changeset)
+        self._notif_node_changes(changeset, newnodes)
+        self._bg_sync_to_file()
+        #TODO: wait for synchronization to suceed/fail??)
+
+    def _check_node_attributes(self, attribmap, autocreate):
+        # validate and normalize an attribute map in place, raising
+        # ValueError before anything is changed
         for node in attribmap:
             node = confluent.util.stringify(node)
             if node == '':
@@ -2247,6 +2865,11 @@ class ConfigManager(object):
                             attrname, node)
                         raise ValueError(errstr)
                     attribmap[node][attrname] = attrval
+
+    def _apply_node_attributes(self, attribmap, changeset):
+        # apply an attribute map checked by _check_node_attributes, giving
+        # the nodes it created
+        newnodes = []
         for node in attribmap:
             node = confluent.util.stringify(node)
             exprmgr = None
@@ -2254,7 +2877,7 @@ class ConfigManager(object):
                 newnodes.append(node)
                 self._cfgstore['nodes'][node] = {}
             cfgobj = self._cfgstore['nodes'][node]
-            recalcexpressions = False
+            recalcexpressions = []
             for attrname in attribmap[node]:
                 if (isinstance(attribmap[node][attrname], str) or
                         isinstance(attribmap[node][attrname], unicode) or
@@ -2270,14 +2893,14 @@ class ConfigManager(object):
                     newdict['grubhashvalue'] = grub_hashcrypt_value(
                         newdict['value'])
                     del newdict['value']
-                cfgobj[attrname] = newdict
+                cfgobj[_intern_name(attrname)] = newdict
                 if attrname == 'groups':
                     self._sync_groups_to_node(node=node,
                                               groups=attribmap[node]['groups'],
                                               changeset=changeset)
                 if ('_expressionkeys' in cfgobj and
                         attrname in cfgobj['_expressionkeys']):
-                    recalcexpressions = True
+                    recalcexpressions.append(attrname)
                 if 'expression' in cfgobj[attrname]:  # evaluate now
                     if exprmgr is None:
                         exprmgr = _ExpressionFormat(cfgobj, node)
@@ -2286,12 +2909,16 @@ class ConfigManager(object):
                 # if any code is watching these attributes, notify
                 # them of the change
                 _addchange(changeset, node, attrname)
-                _mark_dirtykey('nodes', node, self.tenant)
+                _mark_dirtykey('nodes', node, self.tenant, attrname)
             if recalcexpressions:
                 if exprmgr is None:
                     exprmgr = _ExpressionFormat(cfgobj, node)
-                self._recalculate_expressions(cfgobj, formatter=exprmgr,
-                                              node=node, changeset=changeset)
+                self._recalculate_dependents(cfgobj, recalcexpressions,
+                                             formatter=exprmgr, node=node,
+                                             changeset=changeset)
+        return newnodes
+
+    def _notif_node_changes(self, changeset, newnodes):
         self._notif_attribwatchers(changeset)
         if newnodes:
             if self.tenant in self._nodecollwatchers:
@@ -2299,8 +2926,6 @@ class ConfigManager(object):
                 for watcher in nodecollwatchers:
                     watcher = nodecollwatchers[watcher]
                     eventlet.spawn_n(_do_add_watcher, watcher, newnodes, self)
-        self._bg_sync_to_file()
-        #TODO: wait for synchronization to suceed/fail??)
 
     def _load_from_json(self, jsondata, sync=True):
         """Load fresh configuration data from jsondata
@@ -2347,15 +2972,19 @@ class ConfigManager(object):
         # We made it through above section without an exception, go ahead and
         # replace
         # Start by erasing the dbm files if present
-        for confarea in _config_areas:
-            try:
-                os.unlink(os.path.join(self._cfgdir, confarea))
-            except OSError as e:
-                if e.errno == 2:
-                    pass
+        with _synclock:
+            for confarea in _config_areas + (_journalname,):
+                try:
+                    os.unlink(os.path.join(self._cfgdir, confarea))
+                except OSError as e:
+                    if e.errno == 2:
+                        pass
+            _journaledkeys.clear()
         # Now we have to iterate through each fixed up element, using the
         # set attribute to flesh out inheritence and expressions
         _cfgstore['main']['idmap'] = {}
+        _bump_generation(replaced=True)
+        _attribindexes.pop(self.tenant, None)
         for confarea in _config_areas:
             self._cfgstore[confarea] = {}
             if confarea not in tmpconfig:
@@ -2433,6 +3062,8 @@ class ConfigManager(object):
         global _cfgstore
         global _txcount
         _cfgstore = {}
+        _bump_generation(replaced=True)
+        _clear_attrib_indexes()
         rootpath = cls._cfgdir
         try:
             with open(os.path.join(rootpath, 'transactioncount'), 'rb') as f:
@@ -2441,19 +3072,28 @@ class ConfigManager(object):
                     _txcount = struct.unpack('!Q', txbytes)[0]
         except IOError:
             pass
+        loadstart = confluent.util.monotonic_time()
+        lazy = bool(conf.get_boolean_option('config', 'lazy_load'))
         _load_dict_from_dbm(['collective'], os.path.join(rootpath,
                                                          "collective"))
         _load_dict_from_dbm(['globals'], os.path.join(rootpath, "globals"))
         for confarea in _config_areas:
-            _load_dict_from_dbm(['main', confarea], os.path.join(rootpath, confarea))
+            _load_dict_from_dbm(['main', confarea], os.path.join(rootpath, confarea),
+                                lazy=lazy and confarea in _lazy_areas)
         try:
             for tenant in os.listdir(os.path.join(rootpath, 'tenants')):
                 for confarea in _config_areas:
                     _load_dict_from_dbm(
                         ['main', tenant, confarea],
-                        os.path.join(rootpath, tenant, confarea))
+                        os.path.join(rootpath, tenant, confarea),
+                        lazy=lazy and confarea in _lazy_areas)
         except OSError:
             pass
+        cls._replay_journal()
+        _compact_loaded_records()
+        _loadstats['lazy'] = lazy
+        _loadstats['loadtime'] = confluent.util.monotonic_time() - loadstart
+        _loadstats['nodes'] = len(_cfgstore.get('main', {}).get('nodes', ()))
 
     @classmethod
     def wait_for_sync(cls, fullsync=False):
@@ -2501,8 +3141,7 @@ class ConfigManager(object):
                     dirtyglobals = _cfgstore['globals']
                 else:
                     with _dirtylock:
-                        dirtyglobals = copy.deepcopy(_cfgstore['dirtyglobals'])
-                        del _cfgstore['dirtyglobals']
+                        dirtyglobals = _cfgstore.pop('dirtyglobals')
                 globalf = dbm.open(os.path.join(cls._cfgdir, "globals"), 'c', 384)  # 0600
                 try:
                     for globalkey in dirtyglobals:
@@ -2523,8 +3162,7 @@ class ConfigManager(object):
                             colls = _cfgstore['collective']
                         else:
                             with _dirtylock:
-                                colls = copy.deepcopy(_cfgstore['collectivedirty'])
-                                del _cfgstore['collectivedirty']
+                                colls = _cfgstore.pop('collectivedirty')
                         for coll in colls:
                             if coll in _cfgstore['collective']:
                                 collectivef[coll] = cPickle.dumps(
@@ -2550,30 +3188,16 @@ class ConfigManager(object):
                             dbf[ck] = cPickle.dumps(currdict[category][ck], protocol=cPickle.HIGHEST_PROTOCOL)
                     finally:
                         dbf.close()
+                    _fsync_dbm(os.path.join(pathname, category))
+                # fold in anything journaled outside of main before
+                # discarding the journal
+                cls._compact_journal()
             elif 'dirtykeys' in _cfgstore:
                 with _dirtylock:
-                    currdirt = copy.deepcopy(_cfgstore['dirtykeys'])
-                    del _cfgstore['dirtykeys']
-                for tenant in currdirt:
-                    dkdict = currdirt[tenant]
-                    if tenant is None:
-                        pathname = cls._cfgdir
-                        currdict = _cfgstore['main']
-                    else:
-                        pathname = os.path.join(cls._cfgdir, 'tenants', tenant)
-                        currdict = _cfgstore['tenant'][tenant]
-                    for category in dkdict:
-                        _mkpath(pathname)
-                        dbf = dbm.open(os.path.join(pathname, category), 'c', 384)  # 0600
-                        try:
-                            for ck in dkdict[category]:
-                                if ck not in currdict[category]:
-                                    if ck in dbf:
-                                        del dbf[ck]
-                                else:
-                                    dbf[ck] = cPickle.dumps(currdict[category][ck], protocol=cPickle.HIGHEST_PROTOCOL)
-                        finally:
-                            dbf.close()
+                    currdirt = _cfgstore.pop('dirtykeys')
+                journalsize = cls._append_journal(currdirt)
+                if journalsize > _journal_compact_size():
+                    cls._compact_journal()
         willrun = False
         with cls._syncstate:
             if cls._writepending:
@@ -2584,6 +3208,198 @@ class ConfigManager(object):
         if willrun:
             return cls._sync_to_file()
 
+    @classmethod
+    def _append_journal(cls, currdirt):
+        """Append the current state of dirty keys to the journal
+
+        Rather than rewriting dbm files, changes are appended as records
+        to be replayed over the dbm snapshot on the next start.  Records
+        where only some attributes changed are journaled as
+        (tenant, category, key, attribute, exists, value) for each of those
+        attributes, others whole as (tenant, category, key, exists, value).
+
+        :returns: The size of the journal after the append
+        """
+        records = []
+        for tenant in currdirt:
+            if tenant is None:
+                currdict = _cfgstore['main']
+            else:
+                currdict = _cfgstore['tenant'][tenant]
+            if tenant not in _journaledkeys:
+                _journaledkeys[tenant] = {}
+            for category in currdirt[tenant]:
+                if category not in _journaledkeys[tenant]:
+                    _journaledkeys[tenant][category] = set([])
+                for ck in currdirt[tenant][category]:
+                    attribs = currdirt[tenant][category][ck]
+                    if ck not in currdict.get(category, {}):
+                        changes = [(tenant, category, ck, False, None)]
+                    elif attribs is None:
+                        changes = [(tenant, category, ck, True,
+                                    currdict[category][ck])]
+                    else:
+                        cfgobj = currdict[category][ck]
+                        if '_expressionkeys' in cfgobj:
+                            # only ever grows, with any attribute
+                            attribs = attribs | set(['_expressionkeys'])
+                        changes = []
+                        for attrib in attribs:
+                            if attrib in cfgobj:
+                                changes.append((tenant, category, ck, attrib,
+                                                True, cfgobj[attrib]))
+                            else:
+                                changes.append((tenant, category, ck, attrib,
+                                                False, None))
+                    for record in changes:
+                        record = cPickle.dumps(
+                            record, protocol=cPickle.HIGHEST_PROTOCOL)
+                        records.append(struct.pack('!I', len(record)))
+                        records.append(record)
+                    _journaledkeys[tenant][category].add(ck)
+        _mkpath(cls._cfgdir)
+        jfd = os.open(os.path.join(cls._cfgdir, _journalname),
+                      os.O_WRONLY | os.O_APPEND | os.O_CREAT, 384)
+        try:
+            os.write(jfd, b''.join(records))
+            os.fsync(jfd)
+            return os.fstat(jfd).st_size
+        finally:
+            os.close(jfd)
+
+    @classmethod
+    def _compact_journal(cls):
+        """Fold journaled keys into the dbm snapshot and empty the journal
+
+        Only keys that have been journaled since the last compaction are
+        written, whole and with any attribute changes applied, so the work
+        scales with the amount of change rather than with the size of the
+        database.
+        """
+        for tenant in _journaledkeys:
+            if tenant is None:
+                pathname = cls._cfgdir
+                currdict = _cfgstore['main']
+            else:
+                pathname = os.path.join(cls._cfgdir, 'tenants', tenant)
+                currdict = _cfgstore['tenant'][tenant]
+            for category in _journaledkeys[tenant]:
+                _mkpath(pathname)
+                dbf = dbm.open(os.path.join(pathname, category), 'c', 384)  # 0600
+                try:
+                    for ck in _journaledkeys[tenant][category]:
+                        if ck not in currdict.get(category, {}):
+                            if ck in dbf:
+                                del dbf[ck]
+                        else:
+                            dbf[ck] = cPickle.dumps(currdict[category][ck], protocol=cPickle.HIGHEST_PROTOCOL)
+                finally:
+                    dbf.close()
+                # the snapshot must be on disk before the journal goes
+                _fsync_dbm(os.path.join(pathname, category))
+        cls._truncate_journal()
+
+    @classmethod
+    def _truncate_journal(cls):
+        _journaledkeys.clear()
+        try:
+            os.remove(os.path.join(cls._cfgdir, _journalname))
+        except OSError:
+            pass
+
+    @classmethod
+    def _replay_journal(cls):
+        """Apply journaled changes on top of the freshly loaded snapshot
+
+        A record cut short by an interrupted write, or one that cannot be
+        read, ends the replay, and the journal is truncated to the records
+        before it so that later appends are not lost behind it.
+        """
+        journalname = os.path.join(cls._cfgdir, _journalname)
+        try:
+            with open(journalname, 'rb') as jf:
+                journal = jf.read()
+        except IOError:
+            return
+        offset = 0
+        while offset < len(journal):
+            if offset + 4 > len(journal):
+                break
+            reclen = struct.unpack('!I', journal[offset:offset + 4])[0]
+            if offset + 4 + reclen > len(journal):
+                break  # a write was interrupted, the rest is not usable
+            try:
+                record = cPickle.loads(journal[offset + 4:offset + 4 + reclen])
+                if len(record) == 6:
+                    tenant, category, ck, attrib, exists, value = record
+                else:
+                    tenant, category, ck, exists, value = record
+                    attrib = None
+            except Exception:
+                confluent.log.logtrace()
+                break
+            offset += 4 + reclen
+            if tenant is None:
+                currdict = _cfgstore.setdefault('main', {})
+            else:
+                currdict = _cfgstore.setdefault('tenant', {}).setdefault(
+                    tenant, {})
+            currdict = currdict.setdefault(category, {})
+            if attrib is not None:
+                cfgobj = currdict.setdefault(ck, {})
+                if exists:
+                    cfgobj[attrib] = value
+                else:
+                    cfgobj.pop(attrib, None)
+            elif exists:
+                currdict[ck] = value
+            else:
+                currdict.pop(ck, None)
+            # remember what the snapshot is missing for the next compaction
+            _journaledkeys.setdefault(tenant, {}).setdefault(
+                category, set([])).add(ck)
+        if offset < len(journal):
+            confluent.log.log({'error': 'Discarding {0} bytes of unreadable '
+                                        'configuration journal'.format(
+                                            len(journal) - offset)})
+            with open(journalname, 'r+b') as jf:
+                jf.truncate(offset)
+                jf.flush()
+                os.fsync(jf.fileno())
+
+    def _recalculate_dependents(self, cfgobj, changed, formatter, node,
+                                changeset):
+        """Recalculate only the expressions affected by changed attributes
+
+        :param cfgobj: The node configuration to update
+        :param changed: The attribute names that have changed
+        :param formatter: An _ExpressionFormat for the node
+        :param node: The name of the node
+        :param changeset: Changes to notify watchers about
+        """
+        expressions = {}
+        for key in cfgobj:
+            if isinstance(cfgobj[key], dict) and 'expression' in cfgobj[key]:
+                expressions[key] = _expression_dependencies(
+                    cfgobj[key]['expression'])
+        recalc = set([])
+        pending = list(changed)
+        while pending:
+            changedkey = pending.pop()
+            for key in expressions:
+                if key in recalc:
+                    continue
+                deps = expressions[key]
+                if deps is None or changedkey in deps:
+                    # an expression referring to a recalculated expression
+                    # may change as well
+                    recalc.add(key)
+                    pending.append(key)
+        for key in recalc:
+            cfgobj[key] = _decode_attribute(key, cfgobj, formatter=formatter)
+            _addchange(changeset, node, key)
+            _mark_dirtykey('nodes', node, self.tenant, key)
+
     def _recalculate_expressions(self, cfgobj, formatter, node, changeset):
         for key in cfgobj:
             if not isinstance(cfgobj[key], dict):
@@ -2729,6 +3545,8 @@ def init(stateless=False):
     global _cfgstore
     if stateless:
         _cfgstore = {}
+        _bump_generation(replaced=True)
+        _clear_attrib_indexes()
         return
     try:
         ConfigManager._read_from_path()
@@ -24,6 +24,7 @@
 import codecs
 import collections
 import confluent.collective.manager as collective
+import confluent.config.conf as conf
 import confluent.config.configmanager as configmodule
 import confluent.exceptions as exc
 import confluent.interface.console as conapi
@@ -44,6 +45,10 @@ _handled_consoles = {}
 
 _tracelog = None
 
+# output not yet fed to the terminal emulation of a console is fed anyway
+# once it grows beyond this many bytes
+_maxunrendered = 262144
+
 try:
     range = xrange
 except NameError:
@@ -142,6 +147,56 @@ def pytechars2line(chars, maxlen=None):
     return line, hasdata
 
 
+def _batch_window():
+    window = conf.get_int_option('console', 'batch_window')
+    if window is None:
+        window = 10
+    return window / 1000.0
+
+
+def _replay_size():
+    size = conf.get_int_option('console', 'replay_size')
+    if size is None:
+        size = 16384
+    return size
+
+
+class ReplayBuffer(object):
+    """Recent output of a console, to reconstruct its screen from
+
+    Only output from the last clear screen on is kept, and no more than
+    size bytes of it.
+    """
+    clearsequences = (b'\x1bc', b'\x1b[2J')
+
+    def __init__(self, size):
+        self.size = size
+        self.data = bytearray()
+        # whether data begins with a clear screen, rather than being cut
+        self.complete = False
+
+    def append(self, data):
+        clearoffset = max(data.rfind(seq) for seq in self.clearsequences)
+        if clearoffset >= 0:
+            del self.data[:]
+            data = data[clearoffset:]
+            self.complete = True
+        self.data += data
+        if len(self.data) > self.size:
+            del self.data[:len(self.data) - self.size]
+            self.complete = False
+
+    def render(self):
+        screen = pyte.Screen(100, 31)
+        stream = pyte.ByteStream()
+        stream.attach(screen)
+        try:
+            stream.feed(bytes(self.data))
+        except StopIteration:  # corrupt parser state, settle for what is there
+            pass
+        return screen
+
+
 class ConsoleHandler(object):
     _plugin_path = '/nodes/{0}/_console/session'
     _logtobuffer = True
@@ -161,9 +216,20 @@ class ConsoleHandler(object):
         self.node = node
         self.connectstate = 'unconnected'
         self._isalive = True
-        self.buffer = pyte.Screen(100, 31)
-        self.termstream = pyte.ByteStream()
-        self.termstream.attach(self.buffer)
+        # With lazy_screen, there is no terminal emulation until the screen
+        # is wanted, only the output needed to reconstruct it
+        self._replay = None
+        if conf.get_boolean_option('console', 'lazy_screen'):
+            self._replay = ReplayBuffer(_replay_size())
+            self.buffer = None
+        else:
+            self.buffer = pyte.Screen(100, 31)
+            self.termstream = pyte.ByteStream()
+            self.termstream.attach(self.buffer)
+        self._unrendered = []
+        self._unrenderedsize = 0
+        self._pendingoutput = []
+        self._outputflush = None
         self.livesessions = set([])
         self.utf8decoder = codecs.getincrementaldecoder('utf-8')()
         if self._logtobuffer:
@@ -213,8 +279,24 @@ class ConsoleHandler(object):
         return retrytime + (retrytime * random.random())
 
     def feedbuffer(self, data):
+        # the terminal emulation is only brought up to date when the screen
+        # is wanted, see _render
         if not isinstance(data, bytes):
             data = data.encode('utf-8')
+        if self._replay is not None:
+            self._replay.append(data)
+            return
+        self._unrendered.append(data)
+        self._unrenderedsize += len(data)
+        if self._unrenderedsize > _maxunrendered:
+            self._render()
+
+    def _render(self):
+        if not self._unrendered:
+            return
+        data = b''.join(self._unrendered)
+        self._unrendered = []
+        self._unrenderedsize = 0
         try:
             self.termstream.feed(data)
         except StopIteration:  # corrupt parser state, start over
@@ -480,9 +562,31 @@ class ConsoleHandler(object):
             self._attribwatcher = None
 
     def get_console_output(self, data):
-        # Spawn as a greenthread, return control as soon as possible
-        # to the console object
-        eventlet.spawn(self._handle_console_output, data)
+        # Gather output for a short while and handle it as one batch in a
+        # greenthread, returning control as soon as possible to the console
+        # object
+        self._pendingoutput.append(data)
+        if self._outputflush is None:
+            self._outputflush = eventlet.spawn_after(_batch_window(),
+                                                     self._flush_output)
+
+    def _flush_output(self):
+        self._outputflush = None
+        pending = self._pendingoutput
+        self._pendingoutput = []
+        chunks = []
+        for data in pending:
+            if type(data) == int:
+                if chunks:
+                    self._handle_console_output(b''.join(chunks))
+                    chunks = []
+                self._handle_console_output(data)
+            elif data not in (b'', u''):
+                if not isinstance(data, bytes):
+                    data = data.encode('utf-8')
+                chunks.append(data)
+        if chunks:
+            self._handle_console_output(b''.join(chunks))
 
     def attachsession(self, session):
         edata = 1
@@ -557,7 +661,12 @@ class ConsoleHandler(object):
             self.clearerror = False
             self.feedbuffer(b'\x1bc\x1b[2J\x1b[1;1H')
             self._send_rcpts(b'\x1bc\x1b[2J\x1b[1;1H')
-        self._send_rcpts(_utf8_normalize(data, self.shiftin, self.utf8decoder))
+        if self.livesessions:
+            self._send_rcpts(
+                _utf8_normalize(data, self.shiftin, self.utf8decoder))
+        else:
+            # nobody to decode for, start clean for the next to attach
+            self.utf8decoder.reset()
         self.log(data, eventdata=eventdata)
         self.lasttime = util.monotonic_time()
         self.feedbuffer(data)
@@ -571,6 +680,34 @@ class ConsoleHandler(object):
                 _tracelog.log(traceback.format_exc(), ltype=log.DataTypes.event,
                           event=log.Events.stacktrace)
 
+    def _get_screen(self):
+        if self._replay is None:
+            self._render()
+            return self.buffer
+        replay = self._replay
+        if not replay.complete:
+            # the last clear screen has been cut from the replay buffer, look
+            # further back in the log for it
+            replay = self._replay_from_log() or replay
+        return replay.render()
+
+    def _replay_from_log(self):
+        if not self._dologging or not self._logtobuffer:
+            return None
+        replay = ReplayBuffer(self._replay.size * 16)
+        try:
+            if self.logger.logentries:
+                self.logger.writedata()
+            text = self.logger.read_recent_text(replay.size)[0]
+        except Exception:
+            return None
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        replay.append(text)
+        if len(replay.data) <= len(self._replay.data):
+            return None
+        return replay
+
     def get_recent(self):
         """Retrieve 'recent' data
 
@@ -579,6 +716,7 @@ class ConsoleHandler(object):
         # For now, just try to seek back in buffer to find a clear screen
         # If that fails, just return buffer
         # a scheme always tracking the last clear screen would be too costly
+        screen = self._get_screen()
         connstate = {
             'connectstate': self.connectstate,
             'clientcount': len(self.livesessions),
@@ -586,12 +724,12 @@ class ConsoleHandler(object):
         retdata = b'\x1b[H\x1b[J'  # clear screen
         pendingbl = b''  # pending blank lines
         maxlen = 0
-        for line in self.buffer.display:
+        for line in screen.display:
             line = line.rstrip()
             if len(line) > maxlen:
                 maxlen = len(line)
-        for line in range(self.buffer.lines):
-            nline, notblank = pytechars2line(self.buffer.buffer[line], maxlen)
+        for line in range(screen.lines):
+            nline, notblank = pytechars2line(screen.buffer[line], maxlen)
             if notblank:
                 if pendingbl:
                     retdata += pendingbl
@@ -601,8 +739,8 @@ class ConsoleHandler(object):
                 pendingbl += nline + b'\r\n'
         if len(retdata) >  6:
             retdata = retdata[:-2]  # remove the last \r\n
-        cursordata = '\x1b[{0};{1}H'.format(self.buffer.cursor.y + 1,
-                                            self.buffer.cursor.x + 1)
+        cursordata = '\x1b[{0};{1}H'.format(screen.cursor.y + 1,
+                                            screen.cursor.x + 1)
         if not isinstance(cursordata, bytes):
             cursordata = cursordata.encode('utf-8')
         retdata += cursordata
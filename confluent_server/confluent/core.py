@@ -57,9 +57,11 @@ except ImportError:
     # Only required for collective mode
     crypto = None
 import confluent.util as util
+import eventlet
 import eventlet.greenpool as greenpool
 import eventlet.green.ssl as ssl
 import eventlet.queue as queue
+import eventlet.semaphore as semaphore
 import itertools
 import msgpack
 import os
@@ -68,6 +70,12 @@ import struct
 import sys
 
 pluginmap = {}
+_startuptime = None
+# long lived connections to collective members, shared by all dispatches
+_dispatchchannels = {}
+_dispatchchannellocks = {}
+# members found not to support dispatch channels, and when that was noted
+_legacydispatch = {}
 dispatch_plugins = (b'ipmi', u'ipmi', b'redfish', u'redfish', b'tsmsol', u'tsmsol')
 
 try:
@@ -204,6 +212,7 @@ def _init_core():
     # be enumerated in any collection
     noderesources = {
         'attributes': {
+            'batch': PluginRoute({'handler': 'attributes'}),
             'rename': PluginRoute({'handler': 'attributes'}),
             'all': PluginRoute({'handler': 'attributes'}),
             'current': PluginRoute({'handler': 'attributes'}),
@@ -450,7 +459,10 @@ def _init_core():
                     'default': 'ipmi',
                 }),
             },
-
+            'history': PluginCollection({
+                'pluginattrs': ['hardwaremanagement.method'],
+                'default': 'ipmi',
+            }),
         },
         'support': {
             'servicedata': PluginCollection({
@@ -750,12 +762,62 @@ def handle_dispatch(connection, cert, dispatch, peername):
             cfm.get_collective_member(peername)['fingerprint'], cert):
         connection.close()
         return
+    if not _run_dispatch(dispatch,
+                         lambda res: _forward_rsp(connection, res)):
+        connection.close()
+        return
+    connection.sendall('\x00\x00\x00\x00\x00\x00\x00\x00')
+
+
+def handle_dispatch_stream(connection, cert, peername):
+    """Serve multiplexed dispatch requests from a collective member
+
+    Each request and response frame is prefixed by a request id and length,
+    with an empty response frame marking the end of a request.  Requests are
+    served concurrently, and the connection stays up for further requests.
+    """
+    cert = crypto.dump_certificate(crypto.FILETYPE_ASN1, cert)
+    if not util.cert_matches(
+            cfm.get_collective_member(peername)['fingerprint'], cert):
+        connection.close()
+        return
+    tlvdata.send(connection, {'dispatchstream': {'version': 1}})
+    writelock = semaphore.Semaphore()
+    reader = _FrameReader(connection)
+    while True:
+        try:
+            reqid, rlen = struct.unpack('!QQ', reader.read(16))
+            dispatch = reader.read(rlen)
+        except Exception:
+            break
+        eventlet.spawn_n(_handle_stream_request, connection, writelock, reqid,
+                         dispatch)
+
+
+def _handle_stream_request(connection, writelock, reqid, dispatch):
+    def send_frame(data):
+        with writelock:
+            connection.sendall(struct.pack('!QQ', reqid, len(data)) + data)
+
+    def send_rsp(res):
+        r = _serialize_rsp(res)
+        if r:
+            send_frame(r)
+
+    try:
+        _run_dispatch(dispatch, send_rsp)
+        send_frame(b'')
+    except Exception:
+        # the requesting member went away, nothing left to do
+        pass
+
+
+def _run_dispatch(dispatch, sendrsp):
     if dispatch[0:2] != b'\x01\x03':  # magic value to indicate msgpack
         # We only support msgpack now
         # The magic should preclude any pickle, as the first byte can never be
         # under 0x20 or so.
-        connection.close()
-        return
+        return False
     dispatch = msgpack.unpackb(dispatch[2:], raw=False)
     configmanager = cfm.ConfigManager(dispatch['tenant'])
     nodes = dispatch['nodes']
@@ -795,13 +857,13 @@ def handle_dispatch(connection, cert, dispatch, peername):
                 configmanager=configmanager,
                 inputdata=inputdata))
         for res in itertools.chain(*passvalues):
-            _forward_rsp(connection, res)
+            sendrsp(res)
     except Exception as res:
-        _forward_rsp(connection, res)
-    connection.sendall('\x00\x00\x00\x00\x00\x00\x00\x00')
+        sendrsp(res)
+    return True
 
 
-def _forward_rsp(connection, res):
+def _serialize_rsp(res):
     try:
        r = res.serialize()
     except AttributeError:
@@ -815,6 +877,11 @@ def _forward_rsp(connection, res):
         r = msgpack.packb(
                 ['Exception', 'Unable to serialize response ' + repr(res) + ' due to ' + str(e)],
                 use_bin_type=False)
+    return r
+
+
+def _forward_rsp(connection, res):
+    r = _serialize_rsp(res)
     rlen = len(r)
     if not rlen:
         return
@@ -1018,31 +1085,270 @@ def addtoqueue(theq, fun, kwargs):
         theq.put('theend')
 
 
-def dispatch_request(nodes, manager, element, configmanager, inputdata,
-                     operation, isnoderange):
-    a = configmanager.get_collective_member(manager)
+class _FrameReader(object):
+    """Buffered reader for length prefixed frames
+
+    Reads from the socket in large chunks, so that a frame and its header
+    usually arrive in one or two reads rather than many small ones.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            chunk = self.sock.recv(max(size - len(self.buffer), 65536))
+            if not chunk:
+                raise IOError('Connection closed')
+            self.buffer.extend(chunk)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def _set_keepalive(sock):
+    # a channel may be idle for long, so have the kernel notice a member
+    # that is gone rather than wait on it forever
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for opt, val in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 10),
+                     ('TCP_KEEPCNT', 6), ('TCP_USER_TIMEOUT', 180000)):
+        if hasattr(socket, opt):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), val)
+
+
+class _DispatchChannel(object):
+    """A connection to a collective member shared by concurrent dispatches
+
+    Requests are tagged with an id, and responses are routed back to the
+    requester by a single reader.
+    """
+
+    def __init__(self, member, sock):
+        self.name = member['name']
+        self.address = member['address']
+        self.fingerprint = member['fingerprint']
+        self.sock = sock
+        self.reader = _FrameReader(sock)
+        self.writelock = semaphore.Semaphore()
+        self.pending = {}
+        self.nextid = 0
+        self.alive = False
+        self.lastread = util.monotonic_time()
+
+    def open(self):
+        """Ask the member for a dispatch channel
+
+        Returns False if the member does not support dispatch channels.
+        """
+        try:
+            tlvdata.recv(self.sock)  # banner
+            tlvdata.recv(self.sock)
+            tlvdata.send(self.sock, {'dispatchstream': {
+                'name': collective.get_myname()}})
+            rsp = tlvdata.recv(self.sock)
+        except Exception:
+            rsp = None
+        if not rsp or 'dispatchstream' not in rsp:
+            self.sock.close()
+            return False
+        self.sock.settimeout(None)  # idle is normal for a shared channel
+        try:
+            _set_keepalive(self.sock)
+        except Exception:
+            pass
+        self.alive = True
+        eventlet.spawn_n(self._read_responses)
+        return True
+
+    def matches(self, member):
+        return (self.address == member['address'] and
+                self.fingerprint == member['fingerprint'])
+
+    def dispatch(self, dreq):
+        """Send a request, returning its id and a queue of responses
+
+        The queue gets the raw responses, None when the request completes, or
+        False if the channel is lost.
+        """
+        self.nextid += 1
+        reqid = self.nextid
+        rspq = queue.Queue()
+        if not self.alive:
+            rspq.put(False)
+            return reqid, rspq
+        self.pending[reqid] = rspq
+        try:
+            with self.writelock:
+                self.sock.sendall(struct.pack('!QQ', reqid, len(dreq)) + dreq)
+        except Exception:
+            self.close()
+        return reqid, rspq
+
+    def abandon(self, reqid):
+        self.pending.pop(reqid, None)
+
+    def _read_responses(self):
+        try:
+            while True:
+                reqid, rlen = struct.unpack('!QQ', self.reader.read(16))
+                rsp = self.reader.read(rlen) if rlen else None
+                self.lastread = util.monotonic_time()
+                rspq = self.pending.get(reqid, None)
+                if rspq is None:  # requester lost interest
+                    continue
+                if rsp is None:
+                    del self.pending[reqid]
+                rspq.put(rsp)
+        except Exception:
+            pass
+        self.close()
+
+    def close(self):
+        if not self.alive:
+            return
+        self.alive = False
+        if _dispatchchannels.get(self.name, None) is self:
+            del _dispatchchannels[self.name]
+        pending = self.pending
+        self.pending = {}
+        for reqid in pending:
+            pending[reqid].put(False)
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+
+def _connect_member(member):
     try:
-        remote = socket.create_connection((a['address'], 13001))
+        remote = socket.create_connection((member['address'], 13001))
         remote.settimeout(180)
         remote = ssl.wrap_socket(remote, cert_reqs=ssl.CERT_NONE,
                                  keyfile='/etc/confluent/privkey.pem',
                                  certfile='/etc/confluent/srvcert.pem')
     except Exception:
+        return None
+    if not util.cert_matches(member['fingerprint'], remote.getpeercert(
+            binary_form=True)):
+        raise Exception("Invalid certificate on peer")
+    return remote
+
+
+def _get_dispatch_channel(member):
+    """Get the shared dispatch channel for a collective member
+
+    Returns None if the member must be reached with a connection per request,
+    and raises IOError if it is unreachable.
+    """
+    name = member['name']
+    channel = _dispatchchannels.get(name, None)
+    if channel is not None and channel.alive and channel.matches(member):
+        return channel
+    if name in _legacydispatch:
+        if util.monotonic_time() - _legacydispatch[name] < 600:
+            return None
+        del _legacydispatch[name]  # check again in case it was updated
+    if name not in _dispatchchannellocks:
+        _dispatchchannellocks[name] = semaphore.Semaphore()
+    with _dispatchchannellocks[name]:
+        channel = _dispatchchannels.get(name, None)
+        if channel is not None and channel.alive and channel.matches(member):
+            return channel
+        if channel is not None:
+            channel.close()
+        remote = _connect_member(member)
+        if remote is None:
+            raise IOError('Unable to connect to {0}'.format(name))
+        channel = _DispatchChannel(member, remote)
+        if not channel.open():
+            _legacydispatch[name] = util.monotonic_time()
+            return None
+        _dispatchchannels[name] = channel
+        return channel
+
+
+def _decode_dispatch_rsp(rsp):
+    try:
+        rsp = msg.msg_deserialize(rsp)
+    except Exception:
+        rsp = exc.deserialize_exc(rsp)
+    if isinstance(rsp, Exception):
+        raise rsp
+    if not rsp:
+        raise Exception('Error in cross-collective serialize/deserialze, see remote logs')
+    return rsp
+
+
+def _unreachable(nodes, member):
+    for node in nodes:
+        yield msg.ConfluentResourceUnavailable(
+            node, 'Collective member {0} is unreachable'.format(
+                member['name']))
+
+
+def _went_unreachable(nodes, member):
+    for node in nodes:
+        yield msg.ConfluentResourceUnavailable(
+            node, 'Collective member {0} went unreachable'.format(
+                member['name']))
+
+
+def dispatch_request(nodes, manager, element, configmanager, inputdata,
+                     operation, isnoderange):
+    a = configmanager.get_collective_member(manager)
+    if not a:
         for node in nodes:
-            if a:
-                yield msg.ConfluentResourceUnavailable(
-                    node, 'Collective member {0} is unreachable'.format(
-                        a['name']))
-            else:
-                yield msg.ConfluentResourceUnavailable(
-                    node,
-                    '"{0}" is not recognized as a collective member'.format(
-                        manager))
+            yield msg.ConfluentResourceUnavailable(
+                node,
+                '"{0}" is not recognized as a collective member'.format(
+                    manager))
+        return
+    myname = collective.get_myname()
+    dreq =  b'\x01\x03' + msgpack.packb(
+        {'name': myname, 'nodes': list(nodes),
+        'path': element,'tenant': configmanager.tenant,
+        'operation': operation, 'inputdata': inputdata, 'isnoderange': isnoderange}, use_bin_type=False)
+    try:
+        channel = _get_dispatch_channel(a)
+    except IOError:
+        for rsp in _unreachable(nodes, a):
+            yield rsp
+        return
+    if channel is None:
+        for rsp in _dispatch_connection(nodes, a, dreq):
+            yield rsp
+        return
+    reqid, rspq = channel.dispatch(dreq)
+    try:
+        while True:
+            try:
+                rsp = rspq.get(timeout=180)
+            except queue.Empty:
+                # a request may legitimately be slow, but if nothing at all
+                # came over the channel meanwhile, the member is gone and
+                # later requests must not wait on the channel as well
+                if util.monotonic_time() - channel.lastread >= 180:
+                    channel.close()
+                rsp = False
+            if rsp is None:
+                break
+            if rsp is False:
+                for rsp in _went_unreachable(nodes, a):
+                    yield rsp
+                return
+            yield _decode_dispatch_rsp(rsp)
+    finally:
+        channel.abandon(reqid)
 
+
+def _dispatch_connection(nodes, a, dreq):
+    # for members that predate dispatch channels, a connection per request
+    remote = _connect_member(a)
+    if remote is None:
+        for rsp in _unreachable(nodes, a):
+            yield rsp
         return
-    if not util.cert_matches(a['fingerprint'], remote.getpeercert(
-            binary_form=True)):
-        raise Exception("Invalid certificate on peer")
     banner = tlvdata.recv(remote)
     vers = banner.split()[2]
     if vers == b'v0':
@@ -1053,71 +1359,45 @@ def dispatch_request(nodes, manager, element, configmanager, inputdata,
         pvers = 2
     tlvdata.recv(remote)
     myname = collective.get_myname()
-    dreq =  b'\x01\x03' + msgpack.packb(
-        {'name': myname, 'nodes': list(nodes),
-        'path': element,'tenant': configmanager.tenant,
-        'operation': operation, 'inputdata': inputdata, 'isnoderange': isnoderange}, use_bin_type=False)
     tlvdata.send(remote, {'dispatch': {'name': myname, 'length': len(dreq)}})
     remote.sendall(dreq)
+    reader = _FrameReader(remote)
     while True:
         try:
-            rlen = remote.recv(8)
-        except Exception:
-            for node in nodes:
-                yield msg.ConfluentResourceUnavailable(
-                    node, 'Collective member {0} went unreachable'.format(
-                        a['name']))
-            return
-        while len(rlen) < 8:
-            try:
-                nlen = remote.recv(8 - len(rlen))
-            except Exception:
-                nlen = 0
-            if not nlen:
-                for node in nodes:
-                    yield msg.ConfluentResourceUnavailable(
-                        node, 'Collective member {0} went unreachable'.format(
-                            a['name']))
-                return
-            rlen += nlen
-        rlen = struct.unpack('!Q', rlen)[0]
-        if rlen == 0:
-            break
-        try:
-            rsp = remote.recv(rlen)
+            rlen = struct.unpack('!Q', reader.read(8))[0]
+            if rlen == 0:
+                break
+            rsp = reader.read(rlen)
         except Exception:
-            for node in nodes:
-                yield msg.ConfluentResourceUnavailable(
-                    node, 'Collective member {0} went unreachable'.format(
-                        a['name']))
+            for rsp in _went_unreachable(nodes, a):
+                yield rsp
             return
-        while len(rsp) < rlen:
-            try:
-                nrsp = remote.recv(rlen - len(rsp))
-            except Exception:
-                nrsp = 0
-            if not nrsp:
-                for node in nodes:
-                    yield msg.ConfluentResourceUnavailable(
-                        node, 'Collective member {0} went unreachable'.format(
-                            a['name']))
-                return
-            rsp += nrsp
-        try:
-            rsp = msg.msg_deserialize(rsp)
-        except Exception:
-            rsp = exc.deserialize_exc(rsp)
-        if isinstance(rsp, Exception):
-            raise rsp
-        if not rsp:
-            raise Exception('Error in cross-collective serialize/deserialze, see remote logs')
-        yield rsp
+        yield _decode_dispatch_rsp(rsp)
 
 
 def handle_discovery(pathcomponents, operation, configmanager, inputdata):
     if pathcomponents[0] == 'detected':
         pass
 
+def mark_startup():
+    """Note the start of the service, to report time to first request"""
+    global _startuptime
+    _startuptime = util.monotonic_time()
+
+
+def _report_first_request():
+    global _startuptime
+    elapsed = util.monotonic_time() - _startuptime
+    _startuptime = None
+    loadstats = cfm.get_load_stats()
+    log.log({'info': 'First request handled {0:.2f} seconds after start, '
+                     'configuration of {1} nodes loaded in {2:.2f} seconds '
+                     '({3}), resident memory {4} kB'.format(
+        elapsed, loadstats.get('nodes', 0), loadstats.get('loadtime', 0),
+        'lazy' if loadstats.get('lazy', False) else 'full',
+        util.get_resident_memory())})
+
+
 def handle_path(path, operation, configmanager, inputdata=None, autostrip=True):
     """Given a full path request, return an object.
 
@@ -1125,6 +1405,8 @@ def handle_path(path, operation, configmanager, inputdata=None, autostrip=True):
     An exception is made for console/session, which should return
     a class with connect(), read(), write(bytes), and close()
     """
+    if _startuptime is not None:
+        _report_first_request()
     pathcomponents = path.split('/')
     del pathcomponents[0]  # discard the value from leading /
     if pathcomponents[-1] == '':
@@ -22,14 +22,26 @@
 
 # option 97 = UUID (wireformat)
 
+# Requests are received into buffers allocated once, up to 'batch' (64) of
+# them each time the socket is readable.  Replies are built by
+# 'reply_workers' (8) greenthreads from a queue holding at most
+# 'reply_queue' (1024) requests, all in the [pxe] section of service.cfg.
+# Requests arriving to a full queue are dropped; get_stats reports the
+# drops and latency of each stage, and is written out with the traces dumped
+# on SIGUSR1.  The deployment attributes of a node are kept until the
+# node changes.
+
+import confluent.config.conf as conf
 import confluent.config.configmanager as cfm
 import confluent.collective.manager as collective
 import confluent.noderange as noderange
 import confluent.log as log
 import confluent.netutil as netutil
+import confluent.util as util
 import ctypes
 import ctypes.util
 import eventlet
+import eventlet.queue
 import eventlet.green.socket as socket
 import eventlet.green.select as select
 import netifaces
@@ -106,7 +118,7 @@ sendto.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
 sendto.restype = ctypes.c_size_t
 recvmsg = libc.recvmsg
 recvmsg.argtypes = [ctypes.c_int, ctypes.POINTER(msghdr), ctypes.c_int]
-recvmsg.restype = ctypes.c_size_t
+recvmsg.restype = ctypes.c_ssize_t
 
 pkttype = ctypes.c_char * 2048
 
@@ -158,7 +170,45 @@ pxearchs = {
 
 uuidmap = {}
 macmap = {}
-attribwatcher = None
+# The uuids and macs mapped to each node, so a node is cleared without
+# searching the maps
+_uuidsbynode = {}
+_macsbynode = {}
+# Attribute watches are kept by node name and outlive deleting the node, so
+# a name once watched stays watched
+_watchednodes = set([])
+# The node generation and deployment.* attributes of nodes, as given by
+# get_node_attributes
+_deploycache = {}
+_stats = {
+    'receive': {'packets': 0, 'batches': 0, 'maxbatch': 0, 'runts': 0},
+    'reply': {'queued': 0, 'dropped': 0, 'handled': 0, 'errors': 0,
+              'wait': 0.0, 'maxwait': 0.0, 'time': 0.0, 'maxtime': 0.0},
+}
+_lastdropped = 0
+_lastdropreport = 0
+_rawsock = None
+
+
+def get_stats():
+    """Report the packets handled by each stage, drops and latency
+
+    Latencies are in seconds.  'wait' is how long requests waited for a
+    reply worker, 'time' how long the workers took to reply.
+    """
+    stats = {'receive': dict(_stats['receive']),
+             'reply': dict(_stats['reply'])}
+    handled = stats['reply']['handled']
+    stats['reply']['avgwait'] = stats['reply']['wait'] / handled if handled else 0.0
+    stats['reply']['avgtime'] = stats['reply']['time'] / handled if handled else 0.0
+    return stats
+
+
+def _get_pxe_option(option, default):
+    value = conf.get_int_option('pxe', option)
+    if value is None:
+        value = default
+    return value
 
 def stringify(value):
     string = bytes(value)
@@ -266,7 +316,8 @@ def proxydhcp():
         if not myipn:
             continue
         if opts.get(77, None) == b'iPXE':
-            profile = get_deployment_profile(node, cfg)
+            profile = get_deployment_profile(
+                node, cfg, get_deployment_attributes(node, cfg))
             if not profile:
                 continue
             myip = socket.inet_ntoa(myipn)
@@ -290,106 +341,203 @@ def start_proxydhcp():
     eventlet.spawn_n(proxydhcp)
 
 
+class _Receiver(object):
+    """Buffers for receiving requests with their IP_PKTINFO
+
+    The buffers and the structures pointing at them are allocated once and
+    reused for every packet.
+    """
+
+    def __init__(self, sock):
+        self.fileno = sock.fileno()
+        self.rawbuffer = bytearray(2048)
+        self.view = memoryview(self.rawbuffer)
+        self.data = pkttype.from_buffer(self.rawbuffer)
+        self.cmsgarr = bytearray(cmsgsize)
+        self.cmsg = cmsgtype.from_buffer(self.cmsgarr)
+        self.clientaddr = sockaddr_in()
+        self.iov = iovec()
+        self.iov.iov_base = ctypes.addressof(self.data)
+        self.iov.iov_len = 2048
+        self.msg = msghdr()
+        self.msg.msg_iov = ctypes.pointer(self.iov)
+        self.msg.msg_iovlen = 1
+        self.msg.msg_control = ctypes.addressof(self.cmsg)
+        self.msg.msg_name = ctypes.addressof(self.clientaddr)
+        self.msgptr = ctypes.pointer(self.msg)
+
+    def recv(self):
+        """Receive a waiting packet, returning its length, or -1 if none"""
+        # the kernel updates these to what it filled in
+        self.msg.msg_controllen = ctypes.sizeof(self.cmsg)
+        self.msg.msg_namelen = ctypes.sizeof(self.clientaddr)
+        return recvmsg(self.fileno, self.msgptr, socket.MSG_DONTWAIT)
+
+    def pktinfo(self):
+        _, level, typ = struct.unpack('QII', self.cmsgarr[:16])
+        if level == socket.IPPROTO_IP and typ == IP_PKTINFO:
+            idx, recv, targ = struct.unpack('III', self.cmsgarr[16:28])
+            return idx, ipfromint(recv), ipfromint(targ)
+        return None, None, None
+
+
+def _wants_reply(info, packet):
+    # the same checks as consider_discover, to queue only what it acts on
+    if info['hwaddr'] in macmap and info['uuid']:
+        return True
+    if info['uuid'] in uuidmap:
+        return True
+    return packet.get(53, None) == b'\x03'
+
+
+def _queue_reply(replyqueue, info, packet, reqview):
+    try:
+        replyqueue.put_nowait((util.monotonic_time(), info, packet, reqview))
+    except eventlet.queue.Full:
+        _stats['reply']['dropped'] += 1
+        return
+    _stats['reply']['queued'] += 1
+
+
+def _reply_worker(replyqueue, sock, cfg):
+    stats = _stats['reply']
+    while True:
+        queued, info, packet, reqview = replyqueue.get()
+        start = util.monotonic_time()
+        try:
+            consider_discover(info, packet, sock, cfg, reqview)
+        except Exception:
+            stats['errors'] += 1
+            log.logtrace()
+        done = util.monotonic_time()
+        stats['handled'] += 1
+        stats['wait'] += start - queued
+        stats['maxwait'] = max(stats['maxwait'], start - queued)
+        stats['time'] += done - start
+        stats['maxtime'] = max(stats['maxtime'], done - start)
+
+
+def _report_drops():
+    global _lastdropped
+    global _lastdropreport
+    dropped = _stats['reply']['dropped']
+    if dropped == _lastdropped:
+        return
+    now = util.monotonic_time()
+    if now - _lastdropreport < 60:
+        return
+    log.log({'error': 'PXE reply queue full, dropped {0} requests '
+                      '(see reply_queue and reply_workers in the [pxe] '
+                      'section of service.cfg)'.format(
+                          dropped - _lastdropped)})
+    _lastdropped = dropped
+    _lastdropreport = now
+
+
+def _handle_request(rq, idx, recv, handler, replyqueue):
+    if rq[0] != 1:  # Boot request
+        return
+    addrlen = rq[2]
+    if addrlen > 16 or addrlen == 0:
+        return
+    rawnetaddr = rq[28:28+addrlen]
+    netaddr = ':'.join(['{0:02x}'.format(x) for x in rawnetaddr])
+    optidx = 0
+    try:
+        optidx = rq.index(b'\x63\x82\x53\x63') + 4
+    except ValueError:
+        return
+    txid = rq[4:8] # struct.unpack('!I', rq[4:8])[0]
+    rqinfo, disco = opts_to_dict(rq, optidx)
+    vivso = disco.get('vivso', None)
+    if vivso:
+        # info['modelnumber'] = info['attributes']['enclosure-machinetype-model'][0]
+        info = {'hwaddr': netaddr, 'uuid': disco['uuid'],
+                'architecture': vivso.get('arch', ''),
+                'services': (vivso['service-type'],),
+                'netinfo': {'ifidx': idx, 'recvip': recv, 'txid': txid},
+                'attributes': {'enclosure-machinetype-model': [vivso.get('machine', '')]}}
+        handler(info)
+        #consider_discover(info, rqinfo, net4, cfg, rqv)
+        return
+    # We will fill out service to have something to byte into,
+    # but the nature of the beast is that we do not have peers,
+    # so that will not be present for a pxe snoop
+    info = {'hwaddr': netaddr, 'uuid': disco['uuid'],
+            'architecture': disco['arch'],
+            'netinfo': {'ifidx': idx, 'recvip': recv, 'txid': txid},
+            'services': ('pxe-client',)}
+    if disco['uuid']:  #TODO(jjohnson2): need to explictly check for
+                    # discover, so that the parser can go ahead and
+                    # parse the options including uuid to enable
+                    # ACK
+        handler(info)
+    if _wants_reply(info, rqinfo):
+        _queue_reply(replyqueue, info, rqinfo, memoryview(rq))
+
+
 def snoop(handler, protocol=None):
     #TODO(jjohnson2): ipv6 socket and multicast for DHCPv6, should that be
     #prominent
     #TODO(jjohnson2): enable unicast replies. This would suggest either
     # injection into the neigh table before OFFER or using SOCK_RAW.
     tracelog = log.Logger('trace')
-    global attribwatcher
     cfg = cfm.ConfigManager(None)
-    remap_nodes(cfg.list_nodes(), cfg)
-    attribwatcher = cfg.watch_attributes(cfg.list_nodes(), ('id.uuid', 'net.*hwaddr'), remap_nodes)
+    watch_nodes(cfg.list_nodes(), cfg)
     cfg.watch_nodecollection(new_nodes)
     net4 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     net4.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     net4.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
     net4.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
     net4.bind(('', 67))
+    batch = _get_pxe_option('batch', 64)
+    replyqueue = eventlet.queue.LightQueue(_get_pxe_option('reply_queue', 1024))
+    for _ in range(_get_pxe_option('reply_workers', 8)):
+        eventlet.spawn_n(_reply_worker, replyqueue, net4, cfg)
+    receiver = _Receiver(net4)
+    stats = _stats['receive']
     while True:
         try:
-            # Just need some delay, picked a prime number so that overlap with other
-            # timers might be reduced, though it really is probably nothing
             ready = select.select([net4], [], [], None)
             if not ready or not ready[0]:
                 continue
-            clientaddr = sockaddr_in()
-            rawbuffer = bytearray(2048)
-            data = pkttype.from_buffer(rawbuffer)
-            msg = msghdr()
-            cmsgarr = bytearray(cmsgsize)
-            cmsg = cmsgtype.from_buffer(cmsgarr)
-            iov = iovec()
-            iov.iov_base = ctypes.addressof(data)
-            iov.iov_len = 2048
-            msg.msg_iov = ctypes.pointer(iov)
-            msg.msg_iovlen = 1
-            msg.msg_control = ctypes.addressof(cmsg)
-            msg.msg_controllen = ctypes.sizeof(cmsg)
-            msg.msg_name = ctypes.addressof(clientaddr)
-            msg.msg_namelen = ctypes.sizeof(clientaddr)
-            # We'll leave name and namelen blank for now
-            i = recvmsg(net4.fileno(), ctypes.pointer(msg), 0)
-            # if we have a small packet, just skip, it can't possible hold enough
-            # data and avoids some downstream IndexErrors that would be messy
-            # with try/except
-            if i < 64:
-                continue
-            #peer = ipfromint(clientaddr.sin_addr.s_addr)
-            # We don't need peer yet, generally it's 0.0.0.0
-            _, level, typ = struct.unpack('QII', cmsgarr[:16])
-            if level == socket.IPPROTO_IP and typ == IP_PKTINFO:
-                idx, recv, targ = struct.unpack('III', cmsgarr[16:28])
-                recv = ipfromint(recv)
-                targ = ipfromint(targ)
-            # peer is the source ip (in dhcpdiscover, 0.0.0.0)
-            # recv is the 'ip' that recevied the packet, regardless of target
-            # targ is the ip in the destination ip of the header.
-            # idx is the ip link number of the receiving nic
-            # For example, a DHCPDISCOVER will probably have:
-            # peer of 0.0.0.0
-            # targ of 255.255.255.255
-            # recv of <actual ip address that could reply>
-            # idx correlated to the nic
-            rqv = memoryview(rawbuffer)
-            rq = bytearray(rqv[:i])
-            if rq[0] == 1:  # Boot request
-                addrlen = rq[2]
-                if addrlen > 16 or addrlen == 0:
-                    continue
-                rawnetaddr = rq[28:28+addrlen]
-                netaddr = ':'.join(['{0:02x}'.format(x) for x in rawnetaddr])
-                optidx = 0
-                try:
-                    optidx = rq.index(b'\x63\x82\x53\x63') + 4
-                except ValueError:
+            received = 0
+            while received < batch:
+                i = receiver.recv()
+                if i < 0:
+                    break
+                received += 1
+                # if we have a small packet, just skip, it can't possible hold enough
+                # data and avoids some downstream IndexErrors that would be messy
+                # with try/except
+                if i < 64:
+                    stats['runts'] += 1
                     continue
-                txid = rq[4:8] # struct.unpack('!I', rq[4:8])[0]
-                rqinfo, disco = opts_to_dict(rq, optidx)
-                vivso = disco.get('vivso', None)
-                if vivso:
-                    # info['modelnumber'] = info['attributes']['enclosure-machinetype-model'][0]
-                    info = {'hwaddr': netaddr, 'uuid': disco['uuid'],
-                            'architecture': vivso.get('arch', ''),
-                            'services': (vivso['service-type'],),
-                            'netinfo': {'ifidx': idx, 'recvip': recv, 'txid': txid},
-                            'attributes': {'enclosure-machinetype-model': [vivso.get('machine', '')]}}
-                    handler(info)
-                    #consider_discover(info, rqinfo, net4, cfg, rqv)
+                #peer = ipfromint(clientaddr.sin_addr.s_addr)
+                # We don't need peer yet, generally it's 0.0.0.0
+                idx, recv, targ = receiver.pktinfo()
+                # peer is the source ip (in dhcpdiscover, 0.0.0.0)
+                # recv is the 'ip' that recevied the packet, regardless of target
+                # targ is the ip in the destination ip of the header.
+                # idx is the ip link number of the receiving nic
+                # For example, a DHCPDISCOVER will probably have:
+                # peer of 0.0.0.0
+                # targ of 255.255.255.255
+                # recv of <actual ip address that could reply>
+                # idx correlated to the nic
+                if idx is None:
                     continue
-                # We will fill out service to have something to byte into,
-                # but the nature of the beast is that we do not have peers,
-                # so that will not be present for a pxe snoop
-                info = {'hwaddr': netaddr, 'uuid': disco['uuid'],
-                        'architecture': disco['arch'],
-                        'netinfo': {'ifidx': idx, 'recvip': recv, 'txid': txid},
-                        'services': ('pxe-client',)}
-                if disco['uuid']:  #TODO(jjohnson2): need to explictly check for
-                                # discover, so that the parser can go ahead and
-                                # parse the options including uuid to enable
-                                # ACK
-                    handler(info)
-                consider_discover(info, rqinfo, net4, cfg, rqv)
+                # a copy, the buffer is reused for the next packet
+                rq = bytearray(receiver.view[:i])
+                try:
+                    _handle_request(rq, idx, recv, handler, replyqueue)
+                except Exception:
+                    tracelog.log(traceback.format_exc(), ltype=log.DataTypes.event,
+                                 event=log.Events.stacktrace)
+            stats['packets'] += received
+            stats['batches'] += 1
+            stats['maxbatch'] = max(stats['maxbatch'], received)
+            _report_drops()
         except Exception as e:
             tracelog.log(traceback.format_exc(), ltype=log.DataTypes.event,
                             event=log.Events.stacktrace)
@@ -398,34 +546,65 @@ def snoop(handler, protocol=None):
 
 def clear_nodes(nodes):
     for nodename in nodes:
-        for ent in list(macmap):
-            if macmap[ent] == nodename:
+        for ent in _macsbynode.pop(nodename, ()):
+            if macmap.get(ent, None) == nodename:
                 del macmap[ent]
-        for ent in list(uuidmap):
-            if uuidmap[ent] == nodename:
+        for ent in _uuidsbynode.pop(nodename, ()):
+            if uuidmap.get(ent, None) == nodename:
                 del uuidmap[ent]
 
 
+def watch_nodes(nodes, configmanager):
+    """Map the given nodes and watch them for changes"""
+    nodes = set(nodes)
+    remap_nodes(nodes, configmanager)
+    unwatched = nodes - _watchednodes
+    if unwatched:
+        configmanager.watch_attributes(unwatched, ('id.uuid', 'net.*hwaddr'),
+                                       remap_nodes)
+        _watchednodes.update(unwatched)
+
+
 def new_nodes(added, deleting, renamed, configmanager):
-    global attribwatcher
-    configmanager.remove_watcher(attribwatcher)
-    alldeleting = set(deleting) | set(renamed)
-    clear_nodes(alldeleting)
-    attribwatcher = configmanager.watch_attributes(configmanager.list_nodes(),
-                                                   ('id.uuid', 'net.*hwaddr'), remap_nodes)
+    clear_nodes(set(deleting) | set(renamed))
+    _forget_deployment(set(deleting) | set(renamed))
+    watch_nodes(set(added) | set(renamed.values() if renamed else ()),
+                configmanager)
 
 
 def remap_nodes(nodeattribs, configmanager):
-    global macmap
-    global uuidmap
     updates = configmanager.get_node_attributes(nodeattribs, ('id.uuid', 'net.*hwaddr'))
     clear_nodes(nodeattribs)
     for node in updates:
         for attrib in updates[node]:
+            value = updates[node][attrib].get('value', None)
+            if not value:
+                continue
+            value = value.lower()
             if attrib == 'id.uuid':
-                uuidmap[updates[node][attrib]['value'].lower()] = node
+                uuidmap[value] = node
+                _uuidsbynode.setdefault(node, set([])).add(value)
             elif 'hwaddr' in attrib:
-                macmap[updates[node][attrib]['value'].lower()] = node
+                macmap[value] = node
+                _macsbynode.setdefault(node, set([])).add(value)
+
+
+def get_deployment_attributes(node, cfg):
+    """Give the deployment attributes of a node, kept until they change"""
+    # checking the generation rather than waiting on a watch notification,
+    # which is dispatched later, means a reply never uses stale values
+    generation = cfg.get_node_generation(node)
+    cached = _deploycache.get(node, None)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+    cfd = cfg.get_node_attributes(node, ('deployment.*'))
+    _deploycache[node] = (generation, cfd)
+    return cfd
+
+
+def _forget_deployment(nodes):
+    for node in nodes:
+        _deploycache.pop(node, None)
 
 
 def get_deployment_profile(node, cfg, cfd=None):
@@ -446,7 +625,7 @@ myipbypeer = {}
 def check_reply(node, info, packet, sock, cfg, reqview):
     httpboot = info['architecture'] == 'uefi-httpboot'
     replen = 275  # default is going to be 286
-    cfd = cfg.get_node_attributes(node, ('deployment.*'))
+    cfd = get_deployment_attributes(node, cfg)
     profile = get_deployment_profile(node, cfg, cfd)
     if not profile:
         return
@@ -560,9 +739,11 @@ def check_reply(node, info, packet, sock, cfg, reqview):
     send_raw_packet(repview, replen + 28, reqview, info)
 
 def send_raw_packet(repview, replen, reqview, info):
+    global _rawsock
     ifidx = info['netinfo']['ifidx']
-    tsock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM,
-                          socket.htons(0x800))
+    if _rawsock is None:
+        _rawsock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM,
+                                 socket.htons(0x800))
     targ = sockaddr_ll()
     bcastaddr = get_bcastaddr(ifidx)
     hwlen = len(bcastaddr)
@@ -579,7 +760,7 @@ def send_raw_packet(repview, replen, reqview, info):
         # Python 2....
         pkt = ctypes.byref((ctypes.c_char * (replen)).from_buffer_copy(
             repview[:replen].tobytes()))
-    sendto(tsock.fileno(), pkt, replen, 0, ctypes.byref(targ),
+    sendto(_rawsock.fileno(), pkt, replen, 0, ctypes.byref(targ),
            ctypes.sizeof(targ))
 
 def ack_request(pkt, rq, info):
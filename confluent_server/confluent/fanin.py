@@ -0,0 +1,171 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2019 Lenovo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This gathers the results of per-node workers into a single stream of
+# responses for a noderange request.  Two modes are offered, selected by
+# 'fanin' in the [hardwaremanagement] section of service.cfg:
+# - stream: results are passed along as soon as they arrive
+# - ordered (the default): results are passed along in natural node order,
+#   but no result is held back waiting for slower nodes for longer than
+#   reorder_window milliseconds
+# How long each node took, to its first result and to being done, is kept
+# for the most recent requests and written out with the traces dumped on
+# SIGUSR1.
+
+import collections
+import confluent.config.conf as conf
+import confluent.util as util
+import eventlet
+import eventlet.queue as queue
+import time
+
+_recentrequests = collections.deque(maxlen=16)
+
+
+class NodeDone(object):
+    """Marks the end of results from a worker for a node"""
+
+    def __init__(self, node):
+        self.node = node
+
+
+def _fanin_mode():
+    mode = conf.get_option('hardwaremanagement', 'fanin')
+    if mode not in ('stream', 'ordered'):
+        mode = 'ordered'
+    return mode
+
+
+def _reorder_window():
+    window = conf.get_int_option('hardwaremanagement', 'reorder_window')
+    if window is None:
+        window = 500
+    return window / 1000.0
+
+
+def get_recent_latencies():
+    """Report how long nodes took to respond to the most recent requests
+
+    :returns: A list of dicts, oldest first, with 'started', the time the
+              request started, and 'latencies', mapping each node to a dict
+              with 'first', the seconds until its first result, and 'total',
+              the seconds until it was done (None if it never got there)
+    """
+    return [{'started': req['started'],
+             'latencies': dict((node, dict(latency)) for node, latency
+                               in req['latencies'].items())}
+            for req in list(_recentrequests)]
+
+
+def _result_node(datum):
+    kvpairs = getattr(datum, 'kvpairs', None)
+    if kvpairs and len(kvpairs) == 1:
+        return list(kvpairs)[0]
+    return None
+
+
+def gather(nodes, spawn):
+    """Collect results of per-node workers
+
+    :param nodes: The nodes to work on
+    :param spawn: Function given a node and a results queue, returning the
+                  greenthread started to handle that node.  The worker puts
+                  its results on the queue followed by a NodeDone.
+    """
+    mode = _fanin_mode()
+    window = _reorder_window()
+    resultdata = queue.LightQueue()
+    start = util.monotonic_time()
+    latencies = dict((node, {'first': None, 'total': None}) for node in nodes)
+    _recentrequests.append({'started': time.time(), 'latencies': latencies})
+    livingthreads = set([])
+    spawning = [True]
+
+    def spawn_workers():
+        # spawning waits while the worker pool is full, so do it apart from
+        # the gathering to let early results through
+        try:
+            for node in nodes:
+                livingthreads.add(spawn(node, resultdata))
+        finally:
+            spawning[0] = False
+    eventlet.spawn_n(spawn_workers)
+    order = sorted(set(nodes), key=util.naturalize_string)
+    inorder = set(order)
+    head = 0
+    done = set([])
+    buffered = {}
+    heldsince = None
+    while len(done) < len(order):
+        if heldsince is not None:
+            timeout = max(heldsince + window - util.monotonic_time(), 0)
+        else:
+            timeout = 10
+        try:
+            datum = resultdata.get(timeout=timeout)
+        except queue.Empty:
+            datum = None
+        now = util.monotonic_time()
+        if isinstance(datum, NodeDone):
+            done.add(datum.node)
+            if datum.node in latencies:
+                latencies[datum.node]['total'] = now - start
+        elif isinstance(datum, Exception):
+            raise datum
+        elif datum is not None:
+            node = _result_node(datum)
+            if node in latencies and latencies[node]['first'] is None:
+                latencies[node]['first'] = now - start
+            if (mode == 'stream' or node not in inorder or
+                    node == order[head]):
+                yield datum
+            else:
+                buffered.setdefault(node, []).append(datum)
+                if heldsince is None:
+                    heldsince = now
+        # pass along anything no longer waiting on an earlier node
+        while head < len(order):
+            for held in buffered.pop(order[head], ()):
+                yield held
+            if order[head] not in done:
+                break
+            head += 1
+        if not buffered:
+            heldsince = None
+        elif now - heldsince >= window:
+            # stop waiting on slower nodes
+            for node in sorted(buffered, key=util.naturalize_string):
+                for held in buffered[node]:
+                    yield held
+            buffered = {}
+            heldsince = None
+        if datum is None:
+            for t in list(livingthreads):
+                if t.dead:
+                    livingthreads.discard(t)
+            if not livingthreads and not spawning[0]:
+                break
+    for node in sorted(buffered, key=util.naturalize_string):
+        for held in buffered[node]:
+            yield held
+    try:
+        # drain queue if a thread put something on the queue and died
+        while True:
+            datum = resultdata.get_nowait()
+            if not isinstance(datum, NodeDone):
+                yield datum
+    except queue.Empty:
+        pass
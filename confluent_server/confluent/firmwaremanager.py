@@ -19,6 +19,7 @@
 # the time comes
 
 import confluent.exceptions as exc
+import confluent.inventorycache as inventorycache
 import confluent.log as log
 import confluent.messages as msg
 import eventlet
@@ -87,12 +88,17 @@ def execupdate(handler, filename, updateobj, type, owner, node):
         _tracelog.log(traceback.format_exc(), ltype=log.DataTypes.event, event=log.Events.stacktrace)
         updateobj.handle_progress({'phase': 'error', 'progress': 0.0,
                                    'detail': str(e)})
+    finally:
+        if type == 'firmware':
+            # even a failed update may have changed the firmware
+            inventorycache.invalidate(node, updateobj.tenant)
 
 class Updater(object):
     def __init__(self, node, handler, filename, tenant=None, name=None,
                  bank=None, type='firmware', owner=None):
         self.bank = bank
         self.node = node
+        self.tenant = tenant
         self.phase = 'initializing'
         self.detail = ''
         self.percent = 0.0
@@ -0,0 +1,152 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2019 Lenovo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Health of nodes as read by the hardware management plugins.  A health
+# read of a BMC is reused for 'max_age' seconds in the [health] section of
+# service.cfg (5), and callers asking while a read is under way wait for it
+# rather than reading again.
+# The health state of nodes is also tracked, so that a client may retrieve
+# health/hardware with a 'token' parameter, at first empty, to be told only
+# about nodes whose health changed since the request that gave that token.
+# Each response carries the token for the next request, marking when that
+# request started, so changes recorded by other requests while it ran are
+# reported again rather than missed.  If a noderange is served by several
+# collective members, the earliest of their tokens is the one to keep.
+
+import confluent.config.conf as conf
+import confluent.messages as msg
+import confluent.util as util
+import eventlet.event
+import time
+
+_states = {}
+_watchedtenants = set([])
+_laststamp = 0.0
+
+
+def _max_age():
+    maxage = conf.get_int_option('health', 'max_age')
+    if maxage is None:
+        maxage = 5
+    return maxage
+
+
+class HealthReader(object):
+    """Share the health reads of a BMC among concurrent callers"""
+
+    def __init__(self):
+        self.pending = None
+        self.last = None
+        self.lastread = None
+
+    def read(self, fetch):
+        """Give the health of the BMC, reading it only if needed
+
+        :param fetch: Function to read the health from the BMC
+        """
+        if self.pending is not None:
+            return self.pending.wait()
+        if (self.last is not None and
+                util.monotonic_time() - self.lastread < _max_age()):
+            return self.last
+        pending = eventlet.event.Event()
+        self.pending = pending
+        try:
+            result = fetch()
+        except Exception as e:
+            self.pending = None
+            pending.send_exception(e)
+            raise
+        self.last = result
+        self.lastread = util.monotonic_time()
+        self.pending = None
+        pending.send(result)
+        return result
+
+
+def _stamp():
+    # wall clock, to compare with tokens of other collective members, but
+    # never the same twice, so a change is always after a token taken
+    # before it
+    global _laststamp
+    _laststamp = max(time.time(), _laststamp + 0.000001)
+    return _laststamp
+
+
+def _record(tenant, node, health):
+    state = _states.get((tenant, node), None)
+    if state is None or state[0] != health:
+        state = (health, _stamp())
+        _states[(tenant, node)] = state
+    return state[1]
+
+
+def _nodes_changed(added, deleting, renamed, configmanager):
+    for node in list(deleting) + list(renamed):
+        _states.pop((configmanager.tenant, node), None)
+
+
+def _watch_nodes(configmanager):
+    if configmanager.tenant not in _watchedtenants:
+        _watchedtenants.add(configmanager.tenant)
+        configmanager.watch_nodecollection(_nodes_changed)
+
+
+def _parse_token(token):
+    try:
+        return float(token)
+    except (TypeError, ValueError):
+        return None
+
+
+def retrieve_health(nodes, configmanager, inputdata, fetch):
+    """Read health of nodes, reporting only changes if a token was given
+
+    :param nodes: The nodes requested
+    :param configmanager: The configuration manager of the request
+    :param inputdata: The input message of the request, if any
+    :param fetch: Function to read the health of a list of nodes
+    """
+    _watch_nodes(configmanager)
+    tenant = configmanager.tenant
+    if not hasattr(inputdata, 'token'):
+        for rsp in fetch(nodes):
+            if isinstance(rsp, msg.HealthSummary) and not rsp.notnode:
+                for node in rsp.kvpairs:
+                    _record(tenant, node, rsp.kvpairs[node]['health']['value'])
+            yield rsp
+        return
+    since = _parse_token(inputdata.token)
+    nexttoken = _stamp()
+    unchanged = set([])
+    for rsp in fetch(nodes):
+        if isinstance(rsp, msg.ConfluentNodeError):
+            changed = _record(tenant, rsp.node,
+                              'error: {0}'.format(rsp.error))
+            if since is None or changed > since:
+                yield rsp
+            continue
+        kvpairs = getattr(rsp, 'kvpairs', None) or {}
+        node = list(kvpairs)[0] if len(kvpairs) == 1 else None
+        if isinstance(rsp, msg.HealthSummary) and node is not None:
+            changed = _record(tenant, node, kvpairs[node]['health']['value'])
+            if since is not None and changed <= since:
+                unchanged.add(node)
+                continue
+        elif node in unchanged:
+            continue  # the details that follow a health summary
+        yield rsp
+    yield msg.ChangeToken(repr(nexttoken))
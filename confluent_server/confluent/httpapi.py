@@ -269,6 +269,7 @@ def _authorize_request(env, operation):
     authdata = None
     name = ''
     sessionid = None
+    sessiontoken = None
     cookie = Cookie.SimpleCookie()
     element = env['PATH_INFO']
     if element.startswith('/sessions/current/'):
@@ -304,9 +305,21 @@ def _authorize_request(env, operation):
                 # of a CSRF
                 return {'code': 401}
             return ('logout',)
-        name, passphrase = base64.b64decode(
-            env['HTTP_AUTHORIZATION'].replace('Basic ', '')).split(b':', 1)
-        authdata = auth.check_user_passphrase(name, passphrase, operation=operation, element=element)
+        if env['HTTP_AUTHORIZATION'].startswith('Bearer '):
+            # a token from an earlier authentication stands in for the
+            # passphrase
+            name = auth.check_session_token(env['HTTP_AUTHORIZATION'][7:])
+            if name is None:
+                return {'code': 401}
+            authdata = auth.authorize(name, element=element,
+                                      operation=operation)
+        else:
+            name, passphrase = base64.b64decode(
+                env['HTTP_AUTHORIZATION'].replace('Basic ', '')).split(
+                    b':', 1)
+            authdata = auth.check_user_passphrase(name, passphrase, operation=operation, element=element)
+            if authdata:
+                sessiontoken = auth.make_session_token(name)
         if authdata is False:
             return {'code': 403}
         elif not authdata:
@@ -341,6 +354,8 @@ def _authorize_request(env, operation):
         auditmsg['user'] = util.stringify(authdata[2])
         if sessid is not None:
             authinfo['sessionid'] = sessid
+        if sessiontoken is not None:
+            authinfo['sessiontoken'] = sessiontoken
         if not skiplog:
             auditlog.log(auditmsg)
         if 'csrftoken' in httpsessions[sessid]:
@@ -440,6 +455,8 @@ def resourcehandler_backend(env, start_response):
     headers.extend(
         ("Set-Cookie", m.OutputString())
         for m in authorized['cookie'].values())
+    if 'sessiontoken' in authorized:
+        headers.append(('ConfluentSessionToken', authorized['sessiontoken']))
     cfgmgr = authorized['cfgmgr']
     if (operation == 'create') and env['PATH_INFO'] == '/sessions/current/async':
         pagecontent = ""
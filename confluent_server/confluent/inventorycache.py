@@ -0,0 +1,252 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2019 Lenovo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This caches the hardware inventory and firmware information read from
+# BMCs by the hardware management plugins, as it rarely changes and is slow
+# to read.  Settings in the [inventory] section of service.cfg:
+# - hardware_ttl: seconds hardware inventory is kept, 0 to disable (3600)
+# - firmware_ttl: seconds firmware information is kept, 0 to disable (600)
+# - persist: keep the cache in /var/cache/confluent/inventory/ so it
+#   survives a restart (false)
+# The cache of a node is dropped when its firmware is updated, its
+# hardwaremanagement.manager changes or it is deleted, and a request may
+# bypass and renew the cache by passing 'refresh'.  Persisted files are
+# written by a background greenthread, with the file I/O done in a native
+# thread.
+
+import confluent.config.conf as conf
+import confluent.config.configmanager as configmanager
+import confluent.log as log
+import confluent.messages as msg
+import errno
+import eventlet
+import eventlet.tpool
+import msgpack
+import os
+import time
+
+_cachedir = '/var/cache/confluent/inventory/'
+_cache = {}
+_loaded = set([])
+_watchers = {}
+_watchedtenants = set([])
+_unsaved = set([])
+_saver = None
+
+
+def _ttl(kind):
+    ttl = conf.get_int_option('inventory', kind + '_ttl')
+    if ttl is None:
+        ttl = 3600 if kind == 'hardware' else 600
+    return ttl
+
+
+def _persist():
+    return conf.get_boolean_option('inventory', 'persist')
+
+
+def _cachefile(node, tenant):
+    return os.path.join(_cachedir, tenant or '', node)
+
+
+def _load(node, tenant):
+    if (node, tenant) in _loaded:
+        return
+    _loaded.add((node, tenant))
+    if not _persist():
+        return
+    try:
+        with open(_cachefile(node, tenant), 'rb') as cachein:
+            entries = msgpack.unpackb(cachein.read(), raw=False)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            log.logtrace()
+        return
+    except Exception:
+        log.logtrace()
+        return
+    nodecache = _cache.setdefault((node, tenant), {})
+    for path in entries:
+        if path not in nodecache:
+            nodecache[path] = (entries[path][0], entries[path][1])
+
+
+def _write(cachefile, data):
+    try:
+        if data is None:
+            os.remove(cachefile)
+            return
+        try:
+            os.makedirs(os.path.dirname(cachefile))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        with open(cachefile + '.new', 'wb') as cacheout:
+            cacheout.write(data)
+        os.rename(cachefile + '.new', cachefile)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            log.logtrace()
+
+
+def _save_unsaved():
+    global _saver
+    try:
+        while _unsaved:
+            node, tenant = _unsaved.pop()
+            entries = _cache.get((node, tenant), None)
+            data = None
+            if entries:
+                data = msgpack.packb(
+                    dict((path, list(entries[path])) for path in entries),
+                    use_bin_type=True)
+            eventlet.tpool.execute(_write, _cachefile(node, tenant), data)
+    except Exception:
+        log.logtrace()
+    finally:
+        _saver = None
+        if _unsaved:
+            _saver = eventlet.spawn(_save_unsaved)
+
+
+def _save(node, tenant):
+    global _saver
+    if not _persist():
+        return
+    _unsaved.add((node, tenant))
+    if _saver is None:
+        _saver = eventlet.spawn(_save_unsaved)
+
+
+def invalidate(node, tenant=None):
+    """Discard the cached inventory and firmware information of a node
+
+    :param node: The node to discard
+    :param tenant: The tenant of the node
+    """
+    _loaded.add((node, tenant))
+    _cache.pop((node, tenant), None)
+    _save(node, tenant)
+
+
+def _manager_changed(nodeattribs, configmanager, **kwargs):
+    for node in nodeattribs:
+        invalidate(node, configmanager.tenant)
+
+
+def _nodes_changed(added, deleting, renamed, configmanager):
+    watchers = _watchers.get(configmanager.tenant, {})
+    for node in list(deleting) + list(renamed):
+        watcher = watchers.pop(node, None)
+        if watcher is not None:
+            configmanager.remove_watcher(watcher)
+        invalidate(node, configmanager.tenant)
+
+
+def _watch(node, tenant):
+    if tenant not in _watchers:
+        _watchers[tenant] = {}
+    if node in _watchers[tenant]:
+        return
+    cfg = configmanager.ConfigManager(tenant)
+    if tenant not in _watchedtenants:
+        _watchedtenants.add(tenant)
+        cfg.watch_nodecollection(_nodes_changed)
+    _watchers[tenant][node] = cfg.watch_attributes(
+        (node,), ('hardwaremanagement.manager',), _manager_changed)
+
+
+def _cached(node, tenant, path, ttl):
+    _load(node, tenant)
+    entry = _cache.get((node, tenant), {}).get(path, None)
+    if entry is None:
+        return None
+    if time.time() - entry[0] > ttl:
+        return None
+    return entry[1]
+
+
+def _store(node, tenant, path, responses):
+    _cache.setdefault((node, tenant), {})[path] = (time.time(), responses)
+    _watch(node, tenant)
+    _save(node, tenant)
+
+
+def _response_node(rsp, nodes):
+    if isinstance(rsp, msg.ConfluentNodeError):
+        return rsp.node
+    kvpairs = getattr(rsp, 'kvpairs', None)
+    if kvpairs and len(kvpairs) == 1 and list(kvpairs)[0] in nodes:
+        return list(kvpairs)[0]
+    if len(nodes) == 1:
+        return nodes[0]
+    return None
+
+
+def retrieve_inventory(nodes, element, configmanager, inputdata, fetch):
+    """Answer an inventory or firmware request from cache where possible
+
+    :param nodes: The nodes requested
+    :param element: The path of the request
+    :param configmanager: The configmanager of the request
+    :param inputdata: The input message of the request, if any
+    :param fetch: Function to read from the BMCs of a list of nodes
+    """
+    if element[-1] == '':
+        element = element[:-1]
+    if (len(element) not in (3, 4) or
+            element[1] not in ('hardware', 'firmware') or
+            element[2] == 'updates'):
+        for rsp in fetch(nodes):
+            yield rsp
+        return
+    ttl = _ttl(element[1])
+    if not ttl:
+        for rsp in fetch(nodes):
+            yield rsp
+        return
+    tenant = configmanager.tenant
+    path = '/'.join(element)
+    refresh = getattr(inputdata, 'refresh', False)
+    missing = []
+    for node in nodes:
+        responses = None if refresh else _cached(node, tenant, path, ttl)
+        if responses is None:
+            missing.append(node)
+            continue
+        for rsp in responses:
+            yield msg.msg_deserialize(rsp)
+    if not missing:
+        return
+    fetched = dict((node, []) for node in missing)
+    failed = set([])
+    for rsp in fetch(missing):
+        node = _response_node(rsp, missing)
+        if node is None or isinstance(rsp, msg.ConfluentNodeError):
+            failed.add(node)
+        elif node in fetched:
+            try:
+                fetched[node].append(rsp.serialize())
+            except Exception:
+                # not cached, but the response itself is still good
+                log.logtrace()
+                failed.add(node)
+        yield rsp
+    if None in failed:
+        return  # some response could not be attributed to a node
+    for node in missing:
+        if node not in failed and fetched[node]:
+            _store(node, tenant, path, fetched[node])
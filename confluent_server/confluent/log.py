@@ -63,17 +63,20 @@
 #    (a future extended version might include suport for Forward Secure Sealing
 #    or other fields)
 
+import bisect
 import collections
 import confluent.config.configmanager
 import confluent.config.conf as conf
 import confluent.exceptions as exc
-import eventlet
+import eventlet.tpool
 import glob
 import json
+import mmap
 import os
 import re
 import stat
 import struct
+import threading
 import time
 import traceback
 try:
@@ -99,19 +102,24 @@ except ImportError:
     else:
         raise
 
-# on conserving filehandles:
-# upon write, if file not open, open it for append
-# upon write, schedule/reschedule closing filehandle in 15 seconds
-# this way, idle log files get closed, mitigating risk of running afoul
-# of uname type limts, but the filehandle stays open under load and
-# buffering and such work when things are busy
-# perhaps test with very low ulimit and detect shortage and
-# switch to aggressive handle reclaim, tanking performance
-# if that happens, warn to have user increase ulimit for optimal
-# performance
+# on writing and conserving filehandles:
+# records of buffered loggers are written by a single thread outside of the
+# eventlet hub, every 'flush_interval' milliseconds in the [log] section of
+# service.cfg (2000).  Each pass writes all records pending for a log at
+# once, taking one lock and making one write per file.  Unbuffered loggers
+# write as they log, in the same way.  Work on the files asked for from the
+# eventlet hub is done on the hub only if the writer thread is not busy with
+# them, otherwise it waits in a tpool thread, leaving greenthreads to run.
+# Log files are kept open once written, up to 'max_open_files' logs (512),
+# past which those least recently written are closed, mitigating the risk
+# of running afoul of ulimit without reopening busy logs.
 
 MIDNIGHT = 24 * 60 * 60
 _loggers = {}
+_writer = None
+_datecache = {}
+# the thread running the eventlet hub, the one importing this module
+_hubthread = threading.current_thread()
 
 class Events(object):
     (
@@ -153,26 +161,6 @@ class BaseRotatingHandler(object):
             self.binfile.seek(0, 2)
         return self.textfile, self.binfile
 
-    def try_emit(self, binrecord, textrecord):
-        """
-        Emit a record.
-
-        Output the record to the file, catering for rollover as described
-        in doRollover().
-        """
-        global logfull
-        try:
-            rolling_type = self.shouldRollover(binrecord, textrecord)
-            if rolling_type:
-                flock(self.textfile, LOCK_UN)
-                return self.doRollover(rolling_type)
-            return None
-        except (IOError, OSError) as e:
-            if not daemonized:
-                raise
-            logfull = True
-
-
     def emit(self, binrecord, textrecord):
         global logfull
         try:
@@ -348,15 +336,21 @@ class TimedAndSizeRotatingFileHandler(BaseRotatingHandler):
         Determine if rollover should occur.
         Just compare times.
         """
+        self.open()
+        return self.rollingType(self.textfile.tell() + len(textrecord),
+                                self.binfile.tell() + len(binrecord))
+
+    def rollingType(self, textsize, binsize, now=None):
+        """
+        Determine the rollover due for files grown to the given sizes.
+        """
         # time rolling first
-        t = int(time.time())
-        if t >= self.rolloverAt:
+        if now is None:
+            now = int(time.time())
+        if now >= self.rolloverAt:
             return RollingTypes.time_rolling
-        self.open()
         if self.maxBytes > 0:                   # are we rolling over?
-            if self.textfile.tell() + len(textrecord) >= self.maxBytes:
-                return RollingTypes.size_rolling
-            if self.binfile.tell() + len(binrecord) >= self.maxBytes:
+            if textsize >= self.maxBytes or binsize >= self.maxBytes:
                 return RollingTypes.size_rolling
         return RollingTypes.no_rolling
 
@@ -518,6 +512,194 @@ class TimedAndSizeRotatingFileHandler(BaseRotatingHandler):
             return self._timeRoll()
 
 
+def _format_date(fmt, tstamp):
+    # the records of a pass mostly share their second, format it once
+    cached = _datecache.get(fmt, None)
+    if cached is None or cached[0] != tstamp:
+        cached = (tstamp, time.strftime(fmt, time.localtime(tstamp)))
+        _datecache[fmt] = cached
+    return cached[1]
+
+
+class _LogWriter(object):
+    """Thread writing the records of all buffered loggers"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = set([])
+        self.openlogs = collections.OrderedDict()
+        self.interval = conf.get_int_option('log', 'flush_interval')
+        if self.interval is None:
+            self.interval = 2000
+        self.maxopen = conf.get_int_option('log', 'max_open_files')
+        if self.maxopen is None:
+            self.maxopen = 512
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, logger):
+        with self.lock:
+            self.pending.add(logger)
+
+    def opened(self, logger):
+        with self.lock:
+            self.openlogs.pop(logger, None)
+            self.openlogs[logger] = True
+
+    def close_idle(self):
+        """Close the least recently written logs past max_open_files"""
+        with self.lock:
+            idle = []
+            while len(self.openlogs) > self.maxopen:
+                idle.append(self.openlogs.popitem(last=False)[0])
+        for logger in idle:
+            # a log being written is not idle, and waiting for it could
+            # deadlock with its writer waiting for another log
+            if logger.writelock.acquire(False):
+                try:
+                    logger.handler.close()
+                finally:
+                    logger.writelock.release()
+            else:
+                self.opened(logger)
+
+    def flush(self):
+        """Write all pending records now"""
+        with self.lock:
+            loggers = self.pending
+            self.pending = set([])
+        for logger in loggers:
+            try:
+                logger.writedata()
+            except Exception:
+                logtrace()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval / 1000.0)
+            try:
+                self.flush()
+            except Exception:
+                pass  # keep writing the logs that can be written
+
+
+def _get_writer():
+    global _writer
+    if _writer is None:
+        _writer = _LogWriter()
+    return _writer
+
+
+def flush():
+    """Write the pending records of all buffered loggers"""
+    if _writer is not None:
+        _writer.flush()
+
+
+def _size_rolled_before(textpath, binpath):
+    # Size rolling renames each rolled log from .1 to .2 and so on, so the
+    # rollover event of a rolled log names what the log before it was called
+    # then rather than now
+    textbase, _, textnum = textpath.rpartition('.')
+    binbase, _, binnum = binpath.rpartition('.')
+    if not textnum.isdigit() or textnum != binnum:
+        return None
+    num = int(textnum) + 1
+    return ('{0}.{1}'.format(textbase, num), '{0}.{1}'.format(binbase, num))
+
+
+class _Timestamps(object):
+    # The timestamps of an index as a sequence, for bisect
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        return self.index.timestamp(idx)
+
+
+class LogIndex(object):
+    """Memory mapped view of a log and its binary index
+
+    The files are mapped as they are when opened, so records written after
+    are not seen.  As the text of a record is written before its index
+    entry, every record seen has its text.  Records are expected to be 16
+    bytes and in order of time, as written by Logger.
+
+    :param textpath: Path of the text log
+    :param binpath: Path of the binary index
+    """
+
+    def __init__(self, textpath, binpath):
+        self.textpath = textpath
+        self.binpath = binpath
+        self.bindata = self._map(binpath)
+        self.textdata = self._map(textpath)
+        self.count = len(self.bindata) // 16 if self.bindata else 0
+
+    @staticmethod
+    def _map(path):
+        with open(path, 'rb') as logfile:
+            if os.fstat(logfile.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(logfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def record(self, idx):
+        """Give type, offset, length, timestamp, event and event data"""
+        return struct.unpack_from('>BBIHIBBH', self.bindata, idx * 16)[1:7]
+
+    def timestamp(self, idx):
+        return struct.unpack_from('>I', self.bindata, idx * 16 + 8)[0]
+
+    def find_time(self, timestamp, after=False):
+        """Give the index of the first record at or after a time
+
+        :param timestamp: Seconds since epoch
+        :param after: Give the first record after the time instead
+        """
+        if after:
+            return bisect.bisect_right(_Timestamps(self), timestamp)
+        return bisect.bisect_left(_Timestamps(self), timestamp)
+
+    def text(self, offset, datalen):
+        if self.textdata is None:
+            return b''
+        return self.textdata[offset:offset + datalen]
+
+    def previous_log(self):
+        """Give text and index paths of the log rolled before this one
+
+        A log begins with the rollover event naming the log before it.
+        """
+        if not self.count:
+            return None
+        ltype, offset, datalen, _, evtdata, _ = self.record(0)
+        if ltype != DataTypes.event or evtdata != Events.logrollover:
+            return None
+        try:
+            textpath = json.loads(self.text(offset, datalen).decode(
+                'utf-8'))['previouslogfile']
+        except (ValueError, KeyError):
+            return None
+        dir_name, base_name = os.path.split(textpath)
+        temp = base_name.split('.')
+        temp.insert(1, 'cbl')
+        return textpath, os.path.join(dir_name, '.'.join(temp))
+
+    def close(self):
+        for mapped in (self.bindata, self.textdata):
+            if mapped is not None:
+                mapped.close()
+        self.bindata = self.textdata = None
+        self.count = 0
+
+
 class Logger(object):
     """
     :param console:  If true, [] will be used to denote non-text events.  If
@@ -554,48 +736,70 @@ class Logger(object):
             self.filepath = os.path.join(self.filepath, "consoles")
         if not os.path.isdir(self.filepath):
             os.makedirs(self.filepath, 448)
-        self.writer = None
-        self.closer = None
         self.handler = TimedAndSizeRotatingFileHandler(self.filepath, logname,
                                                        interval=1)
         self.lockfile = None
         self.logname = logname
+        # lock guards logentries, writelock the files of the handler
+        self.lock = threading.Lock()
+        self.writelock = threading.RLock()
         self.logentries = collections.deque()
 
+    def _with_writelock(self, function):
+        if threading.current_thread() is not _hubthread:
+            with self.writelock:
+                return function()
+        if not self.writelock.acquire(False):
+            # do not block the hub while the writer thread has the files
+            return eventlet.tpool.execute(self._with_writelock, function)
+        try:
+            return function()
+        finally:
+            self.writelock.release()
+
     def writedata(self):
-        while self.logentries:
-            textfile, binfile = self.handler.open()
-            entry = self.logentries.popleft()
-            ltype = entry[0]
-            tstamp = entry[1]
-            data = entry[2]
-            evtdata = entry[3]
-            if len(data) > 65535:
-                # our max log entry is 65k, take only the first 65k and put
-                # rest back on as a continuation
-                entry[2] = data[65535:]
-                self.logentries.appendleft(entry)
-                data = data[:65535]
-            textdate = ''
-            if self.isconsole and ltype != 2:
-                textdate = time.strftime(
-                    '[%m/%d %H:%M:%S ', time.localtime(tstamp))
-                if ltype == DataTypes.event and evtdata in Events.logstr:
-                    textdate += Events.logstr[evtdata]
-            elif not self.isconsole:
-                textdate = time.strftime(
-                    '%b %d %H:%M:%S ', time.localtime(tstamp))
-            flock(textfile, LOCK_EX)
-            try:
-                offset = textfile.tell() + len(textdate)
-                datalen = len(data)
-                eventaux = entry[4]
-                if eventaux is None:
-                    eventaux = 0
-                # metadata length is always 16 for this code at the moment
-                binrecord = struct.pack(
-                    ">BBIHIBBH", 16, ltype, offset, datalen, tstamp, evtdata,
-                    eventaux, 0)
+        self._with_writelock(self._writedata)
+
+    def _writedata(self):
+        with self.lock:
+            entries = self.logentries
+            self.logentries = collections.deque()
+        if entries:
+            self._write_entries(entries)
+
+    def _write_entries(self, entries):
+        global logfull
+        textfile, binfile = self.handler.open()
+        writer = _get_writer()
+        writer.opened(self)
+        writer.close_idle()
+        flock(textfile, LOCK_EX)
+        try:
+            textpos = textfile.tell()
+            binpos = binfile.tell()
+            textrecords = []
+            binrecords = []
+            now = int(time.time())
+            while entries:
+                entry = entries.popleft()
+                ltype = entry[0]
+                tstamp = entry[1]
+                data = entry[2]
+                evtdata = entry[3]
+                if len(data) > 65535:
+                    # our max log entry is 65k, take only the first 65k and
+                    # put rest back on as a continuation
+                    entries.appendleft(
+                        [ltype, tstamp, data[65535:], evtdata, entry[4]])
+                    data = data[:65535]
+                    entry = [ltype, tstamp, data, evtdata, entry[4]]
+                textdate = ''
+                if self.isconsole and ltype != 2:
+                    textdate = _format_date('[%m/%d %H:%M:%S ', tstamp)
+                    if ltype == DataTypes.event and evtdata in Events.logstr:
+                        textdate += Events.logstr[evtdata]
+                elif not self.isconsole:
+                    textdate = _format_date('%b %d %H:%M:%S ', tstamp)
                 if self.isconsole:
                     if ltype == 2:
                         textrecord = data
@@ -609,129 +813,154 @@ class Logger(object):
                     textrecord = textdate + data
                     if not textrecord.endswith('\n'):
                         textrecord += '\n'
-                files = self.handler.try_emit(binrecord, textrecord)
-            except struct.error:
-                files = self.handler.doRollover(RollingTypes.size_rolling)
-            finally:
+                if not isinstance(textrecord, bytes):
+                    textrecord = textrecord.encode('utf-8')
+                eventaux = entry[4]
+                if eventaux is None:
+                    eventaux = 0
+                offset = textpos + len(textdate)
+                binrecord = None
                 try:
+                    # metadata length is always 16 for this code at the
+                    # moment
+                    binrecord = struct.pack(
+                        ">BBIHIBBH", 16, ltype, offset, len(data), tstamp,
+                        evtdata, eventaux, 0)
+                    rolling = self.handler.rollingType(
+                        textpos + len(textrecord), binpos + 16, now)
+                except struct.error:
+                    if not textpos:
+                        continue  # not for want of room, can not be indexed
+                    rolling = RollingTypes.size_rolling
+                files = None
+                if rolling:
+                    if textrecords:
+                        self.handler.emit(b''.join(binrecords),
+                                          b''.join(textrecords))
+                        textrecords = []
+                        binrecords = []
                     flock(textfile, LOCK_UN)
-                except Exception:
-                    pass
-            if not files:
-                self.handler.emit(binrecord, textrecord)
-            else:
-                # Log the rolling event at first, then log the last data
-                # which cause the rolling event.
-                to_bfile, to_tfile = files
-                self.logentries.appendleft(entry)
-                roll_data = json.dumps({'previouslogfile': to_tfile})
-                self.logentries.appendleft([DataTypes.event, tstamp, roll_data,
-                                            Events.logrollover, None])
-        if self.closer is None:
-            self.closer = eventlet.spawn_after(15, self.closelog)
-        self.writer = None
+                    try:
+                        files = self.handler.doRollover(rolling)
+                    except (IOError, OSError):
+                        if not daemonized:
+                            raise
+                        logfull = True
+                    textfile, binfile = self.handler.open()
+                    flock(textfile, LOCK_EX)
+                    textpos = textfile.tell()
+                    binpos = binfile.tell()
+                if files:
+                    # Log the rolling event at first, then log the last data
+                    # which cause the rolling event.
+                    to_bfile, to_tfile = files
+                    entries.appendleft(entry)
+                    roll_data = json.dumps({'previouslogfile': to_tfile})
+                    entries.appendleft([DataTypes.event, tstamp, roll_data,
+                                        Events.logrollover, None])
+                    continue
+                if binrecord is None:
+                    continue  # the roll failed, the record can not be indexed
+                textrecords.append(textrecord)
+                binrecords.append(binrecord)
+                textpos += len(textrecord)
+                binpos += 16
+            if textrecords:
+                self.handler.emit(b''.join(binrecords), b''.join(textrecords))
+        finally:
+            try:
+                flock(textfile, LOCK_UN)
+            except Exception:
+                pass
 
-    def read_recent_text(self, size):
+    def _indexes(self, start=None):
+        """Map the index of the log and of the logs rolled before it
 
-        def parse_last_rolling_files(textfile, offset, datalen):
-            textfile.seek(offset, 0)
-            textpath = json.loads(textfile.read(datalen))['previouslogfile']
-            dir_name, base_name = os.path.split(textpath)
-            temp = base_name.split('.')
-            temp.insert(1,'cbl')
-            # find the recent bin file
-            binpath = os.path.join(dir_name, ".".join(temp))
-            return textpath, binpath
+        Indexes are given newest first, following the rollover events, and
+        the caller is to close them.
 
+        :param start: Stop at the log that began before this time
+        """
         textpath = self.handler.textpath
         binpath = self.handler.binpath
+        seen = set([])
+        while textpath not in seen and binpath not in seen:
+            seen.add(textpath)
+            seen.add(binpath)
+            try:
+                index = LogIndex(textpath, binpath)
+            except (IOError, OSError, ValueError):
+                return
+            previous = None
+            if start is None or not index or index.timestamp(0) >= start:
+                previous = index.previous_log()
+                if previous is not None and previous[0] in seen:
+                    previous = _size_rolled_before(textpath, binpath)
+            yield index
+            if previous is None:
+                return
+            textpath, binpath = previous
+
+    def iter_records(self, start=None, end=None):
+        """Iterate over the written records of the log, oldest first
+
+        Records of logs rolled before the current one are included.  Each
+        is given as a tuple of type, timestamp, data, event and event data.
+
+        :param start: Seconds since epoch of the first record to give
+        :param end: Seconds since epoch of the last record to give
+        """
+        indexes = list(self._indexes(start))
         try:
-            textfile = open(textpath, mode='r')
-            binfile = open(binpath, mode='r')
-        except IOError:
-            return '', 0, 0
-        flock(binfile, LOCK_SH)
-        binfile.seek(0, 2)
-        binidx = binfile.tell()
+            for index in reversed(indexes):
+                first = 0 if start is None else index.find_time(start)
+                last = len(index) if end is None else index.find_time(
+                    end, after=True)
+                for idx in range(first, last):
+                    (ltype, offset, datalen, tstamp, evtdata,
+                     eventaux) = index.record(idx)
+                    yield (ltype, tstamp, index.text(offset, datalen),
+                           evtdata, eventaux)
+        finally:
+            for index in indexes:
+                index.close()
+
+    def read_between(self, start, end):
+        """Read the console data logged from start through end
+
+        :param start: Seconds since epoch
+        :param end: Seconds since epoch
+        :returns: The console data as bytes
+        """
+        return b''.join(rec[2] for rec in self.iter_records(start, end)
+                        if rec[0] == DataTypes.console)
+
+    def read_recent_text(self, size):
+        chunks = []
         currsize = 0
-        offsets = []
         termstate = None
         recenttimestamp = 0
-        flock(textfile, LOCK_SH)
-        while binidx > 0 and currsize < size:
-            binidx -= 16
-            binfile.seek(binidx, 0)
-            recbytes = binfile.read(16)
-            (_, ltype, offset, datalen, tstamp, evtdata, eventaux, _) = \
-                struct.unpack(">BBIHIBBH", recbytes)
-            # rolling events found.
-            if ltype == DataTypes.event and evtdata == Events.logrollover:
-                txtpath, bpath = parse_last_rolling_files(textfile, offset,
-                                                          datalen)
-                if txtpath == textpath:
-                    break
-                if bpath == binpath:
-                    break
-                textpath = txtpath
-                binpath = bpath
-                # Rolling event detected, close the current bin file, then open
-                # the renamed bin file.
-                flock(binfile, LOCK_UN)
-                flock(textfile, LOCK_UN)
-                binfile.close()
-                textfile.close()
-                try:
-                    binfile = open(binpath, mode='r')
-                    textfile = open(textpath, mode='r')
-                except IOError:
-                    binfile = None
-                    textfile = None
-                    break
-                flock(binfile, LOCK_SH)
-                flock(textfile, LOCK_SH)
-                binfile.seek(0, 2)
-                binidx = binfile.tell()
-                # things have been set up for next iteration to dig to
-                # previous log file, go to next iteration
-                continue
-            elif ltype != 2:
-                continue
-            if tstamp > recenttimestamp:
-                recenttimestamp = tstamp
-            currsize += datalen
-            offsets.append((offset, datalen, textpath))
-            if termstate is None:
-                termstate = eventaux
-        try:
-            flock(binfile, LOCK_UN)
-            binfile.close()
-        except:
-            pass
-        textdata = ''
-        while offsets:
-            (offset, length, textpath) = offsets.pop()
-            if textfile is None:
-                textfile = open(textpath, mode='r')
-                flock(textfile, LOCK_SH)
-            if textfile.name != textpath:
-                try:
-                    flock(textfile, LOCK_UN)
-                    textfile.close()
-                    textfile = open(textpath, mode='r')
-                    flock(textfile, LOCK_SH)
-                except (ValueError, IOError) as e:
-                    break
+        for index in self._indexes():
             try:
-                textfile.seek(offset, 0)
-            except ValueError:
-                # file was closed, settle with what we have and continue
+                idx = len(index)
+                while idx > 0 and currsize < size:
+                    idx -= 1
+                    (ltype, offset, datalen, tstamp, evtdata,
+                     eventaux) = index.record(idx)
+                    if ltype != DataTypes.console:
+                        continue
+                    if tstamp > recenttimestamp:
+                        recenttimestamp = tstamp
+                    currsize += datalen
+                    chunks.append(index.text(offset, datalen))
+                    if termstate is None:
+                        termstate = eventaux
+            finally:
+                index.close()
+            if currsize >= size:
                 break
-            textdata += textfile.read(length)
-        try:
-            flock(textfile, LOCK_UN)
-            textfile.close()
-        except:
-            pass
+        chunks.reverse()
+        textdata = b''.join(chunks).decode('utf-8', 'replace')
         if termstate is None:
             termstate = 0
         return textdata, termstate, recenttimestamp
@@ -762,28 +991,24 @@ class Logger(object):
                 ltype = 2
             else:
                 ltype = 0
-        if self.closer is not None:
-            self.closer.cancel()
-            self.closer = None
         timestamp = int(time.time())
-        if (len(self.logentries) > 0 and ltype == 2 and
-                event == 0 and self.logentries[-1][0] == 2 and
-                self.logentries[-1][1] == timestamp):
-            self.logentries[-1][2] += logdata
-            if eventdata is not None:
-                self.logentries[-1][4] = eventdata
-        else:
-            self.logentries.append(
-                [ltype, timestamp, logdata, event, eventdata])
+        with self.lock:
+            if (len(self.logentries) > 0 and ltype == 2 and
+                    event == 0 and self.logentries[-1][0] == 2 and
+                    self.logentries[-1][1] == timestamp):
+                self.logentries[-1][2] += logdata
+                if eventdata is not None:
+                    self.logentries[-1][4] = eventdata
+            else:
+                self.logentries.append(
+                    [ltype, timestamp, logdata, event, eventdata])
         if self.buffered:
-            if self.writer is None:
-                self.writer = eventlet.spawn_after(2, self.writedata)
+            _get_writer().schedule(self)
         else:
             self.writedata()
 
     def closelog(self):
-        self.handler.close()
-        self.closer = None
+        self._with_writelock(self.handler.close)
 
 globaleventlog = None
 tracelog = None
@@ -31,10 +31,13 @@ import confluent.config.conf as conf
 import confluent.config.configmanager as configmanager
 import confluent.consoleserver as consoleserver
 import confluent.core as confluentcore
+import confluent.fanin as fanin
 import confluent.httpapi as httpapi
 import confluent.log as log
 import confluent.collective.manager as collective
 import confluent.discovery.protocols.pxe as pxe
+import confluent.sensorcache as sensorcache
+import confluent.util as util
 try:
     import confluent.sockapi as sockapi
 except ImportError:
@@ -173,9 +176,30 @@ def dumptrace(signalname, frame):
             continue
         ht.write('Thread trace: ({0})\n'.format(id(o)))
         ht.write(''.join(traceback.format_stack(o.gr_frame)))
+    for request in fanin.get_recent_latencies():
+        ht.write('Request latency for request started {0}:\n'.format(
+            time.strftime('%X %x', time.localtime(request['started']))))
+        for node in sorted(request['latencies'], key=util.naturalize_string):
+            latency = request['latencies'][node]
+            ht.write('    {0}: first {1} total {2}\n'.format(
+                node, _format_latency(latency['first']),
+                _format_latency(latency['total'])))
+    pxestats = pxe.get_stats()
+    for stage in sorted(pxestats):
+        ht.write('PXE {0}: {1}\n'.format(stage, ', '.join(
+            '{0} {1}'.format(stat, pxestats[stage][stat])
+            for stat in sorted(pxestats[stage]))))
     ht.close()
 
+
+def _format_latency(latency):
+    if latency is None:
+        return 'never'
+    return '{0:.3f}s'.format(latency)
+
+
 def doexit():
+    log.flush()
     if not havefcntl:
         return
     try:
@@ -211,6 +235,7 @@ def setlimits():
 
 
 def run(args):
+    confluentcore.mark_startup()
     setlimits()
     try:
         signal.signal(signal.SIGUSR1, dumptrace)
@@ -272,6 +297,7 @@ def run(args):
     atexit.register(doexit)
     eventlet.sleep(1)
     consoleserver.start_console_sessions()
+    sensorcache.start_sampler()
     while 1:
         eventlet.sleep(100)
 
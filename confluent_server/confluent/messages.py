@@ -457,6 +457,8 @@ def get_input_message(path, operation, inputdata, nodes=None, multinode=False,
         return InputExpression(path, inputdata, nodes)
     elif path == ['attributes', 'rename']:
         return InputConfigChangeSet(path, inputdata, nodes, configmanager)
+    elif path == ['attributes', 'batch'] and operation != 'retrieve':
+        return InputBatchAttributes(path, inputdata, nodes)
     elif path[0] in ('attributes', 'users', 'usergroups') and operation != 'retrieve':
         return InputAttributes(path, inputdata, nodes)
     elif path == ['boot', 'nextdevice'] and operation != 'retrieve':
@@ -520,10 +522,28 @@ def get_input_message(path, operation, inputdata, nodes=None, multinode=False,
     elif '/'.join(path).startswith(
             'configuration/management_controller/licenses') and inputdata:
         return InputLicense(path, nodes, inputdata, configmanager)
+    elif (path[0] == 'inventory' and operation == 'retrieve' and
+            inputdata and 'refresh' in inputdata):
+        return InputRefresh(path, nodes, inputdata)
+    elif (path == ['health', 'hardware'] and operation == 'retrieve' and
+            inputdata and 'token' in inputdata):
+        return InputChangeToken(path, nodes, inputdata)
     elif inputdata:
         raise exc.InvalidArgumentException(
             'No known input handler for request')
 
+
+class InputRefresh(ConfluentMessage):
+    def __init__(self, path, nodes, inputdata):
+        self.refresh = str(inputdata['refresh']).lower() not in (
+            '', '0', 'false', 'no')
+
+
+class InputChangeToken(ConfluentMessage):
+    def __init__(self, path, nodes, inputdata):
+        self.token = inputdata['token']
+
+
 class InputFirmwareUpdate(ConfluentMessage):
 
     def __init__(self, path, nodes, inputdata, configmanager):
@@ -743,6 +763,27 @@ class InputAttributes(ConfluentMessage):
                         )
         return nodeattr
 
+class InputBatchAttributes(InputAttributes):
+    # Unlike InputAttributes, each node gets its own set of attributes,
+    # given as a dictionary of node names to attribute dictionaries
+    def __init__(self, path, inputdata, nodes=None):
+        self.nodeattribs = {}
+        if not inputdata:
+            raise exc.InvalidArgumentException('no request data provided')
+        if nodes is None:
+            raise exc.InvalidArgumentException(
+                'Batch attribute changes are only supported for nodes')
+        for node in inputdata:
+            if node not in nodes:
+                raise exc.InvalidArgumentException(
+                    '{0} is not in the requested noderange'.format(node))
+            if not isinstance(inputdata[node], dict):
+                raise exc.InvalidArgumentException(
+                    'Attributes for {0} must be given as a dictionary'.format(
+                        node))
+            self.nodeattribs[node] = inputdata[node]
+
+
 def checkPassword(password, username):
     lowercase = set('abcdefghijklmnopqrstuvwxyz')
     uppercase = set('abcdefghijklmnopqrstuvwxyz'.upper())
@@ -1514,6 +1555,19 @@ class SensorReadings(ConfluentMessage):
             self.kvpairs = {name: {'sensors': readings}}
 
 
+class SensorHistory(ConfluentMessage):
+    readonly = True
+
+    def __init__(self, sensor, units, samples, name=None):
+        self.myargs = (sensor, units, samples, name)
+        self.notnode = name is None
+        history = {'name': sensor, 'units': units, 'samples': samples}
+        if self.notnode:
+            self.kvpairs = {'history': history}
+        else:
+            self.kvpairs = {name: {'history': history}}
+
+
 class Firmware(ConfluentMessage):
     readonly = True
 
@@ -1673,6 +1727,18 @@ class HealthSummary(ConfluentMessage):
             self.kvpairs = {name: {'health': {'value': health}}}
 
 
+class ChangeToken(ConfluentMessage):
+    readonly = True
+
+    def __init__(self, token):
+        self.myargs = (token,)
+        self.notnode = True
+        self.kvpairs = {'token': {'value': token}}
+
+    def strip_node(self, node):
+        pass
+
+
 class Attributes(ConfluentMessage):
     def __init__(self, name=None, kv=None, desc=''):
         self.myargs = (name, kv, desc)
@@ -15,8 +15,15 @@
 # limitations under the License.
 # this will implement noderange grammar
 
+# The addresses of local interfaces and the route table are read at most
+# once a second and reindexed only when they have changed.  Results of
+# get_nic_config are kept per node until a net.* attribute of the node
+# changes, the local addresses or routes change, or _nodecachettl seconds
+# pass, as the address a node name resolves to may change.
+
 
 import confluent.exceptions as exc
+import confluent.util as util
 import codecs
 import netifaces
 import struct
@@ -25,6 +32,12 @@ import eventlet.support.greendns
 import os
 getaddrinfo = eventlet.support.greendns.getaddrinfo
 
+_tablecheckinterval = 1
+_nodecachettl = 60
+_nodecachemax = 16  # distinct requests kept per node
+_nodeconfigs = {}
+_netwatched = {}
+
 
 def mask_to_cidr(mask):
     maskn = socket.inet_pton(socket.AF_INET, mask)
@@ -39,21 +52,28 @@ def cidr_to_mask(cidr):
     return socket.inet_ntop(
         socket.AF_INET, struct.pack('!I', (2**32 - 1) ^ (2**(32 - cidr) - 1)))
 
+def _address_to_int(address):
+    # give family and integer value of an address, skipping the resolver
+    # for the usual case of an address literal
+    fam = socket.AF_INET6 if ':' in address else socket.AF_INET
+    try:
+        ip = socket.inet_pton(fam, address.split('%')[0])
+    except (socket.error, ValueError):
+        addrinf = socket.getaddrinfo(address, None, 0, socket.SOCK_STREAM)[0]
+        fam = addrinf[0]
+        ip = socket.inet_pton(fam, addrinf[-1][0].split('%')[0])
+    return fam, int(codecs.encode(bytes(ip), 'hex'), 16)
+
+
 def ip_on_same_subnet(first, second, prefix):
     if first.startswith('::ffff:') and '.' in first:
         first = first.replace('::ffff:', '')
     if second.startswith('::ffff:') and '.' in second:
         second = second.replace('::ffff:', '')
-    addrinf = socket.getaddrinfo(first, None, 0, socket.SOCK_STREAM)[0]
-    fam = addrinf[0]
-    ip = socket.inet_pton(fam, addrinf[-1][0])
-    ip = int(codecs.encode(bytes(ip), 'hex'), 16)
-    addrinf = socket.getaddrinfo(second, None, 0, socket.SOCK_STREAM)[0]
-    if fam != addrinf[0]:
+    fam, ip = _address_to_int(first)
+    ofam, oip = _address_to_int(second)
+    if fam != ofam:
         return False
-    txtaddr = addrinf[-1][0].split('%')[0]
-    oip = socket.inet_pton(fam, txtaddr)
-    oip = int(codecs.encode(bytes(oip), 'hex'), 16)
     if fam == socket.AF_INET:
         addrlen = 32
     elif fam == socket.AF_INET6:
@@ -64,13 +84,107 @@ def ip_on_same_subnet(first, second, prefix):
     return ip & mask == oip & mask
 
 
+class _LocalTables(object):
+    """Addresses of the local interfaces and the route table, indexed"""
+
+    def __init__(self):
+        self.generation = 0
+        self.checked = None
+        self.ifaddrs = None
+        self.ifnames = {}
+        self.ipv4nets = {}
+        self.addrtoiface = {}
+        self.routetext = None
+        self.routes = []
+
+    def refresh(self):
+        """Reread the tables if due, noting if they changed"""
+        now = util.monotonic_time()
+        if (self.checked is not None and
+                now - self.checked < _tablecheckinterval):
+            return
+        self.checked = now
+        ifaddrs = dict((iface, netifaces.ifaddresses(iface))
+                       for iface in netifaces.interfaces())
+        if ifaddrs != self.ifaddrs:
+            self.ifaddrs = ifaddrs
+            self._index_interfaces()
+            self.generation += 1
+        try:
+            with open('/proc/net/route') as rf:
+                routetext = rf.read()
+        except IOError:
+            routetext = ''
+        if routetext != self.routetext:
+            self.routetext = routetext
+            self._index_routes()
+            self.generation += 1
+
+    def _index_interfaces(self):
+        self.ipv4nets = {}
+        self.addrtoiface = {}
+        for iface in self.ifaddrs:
+            self.ipv4nets[iface] = list(_addrstonets(
+                self.ifaddrs[iface].get(netifaces.AF_INET, [])))
+            for fam in (netifaces.AF_INET, netifaces.AF_INET6):
+                for addr in self.ifaddrs[iface].get(fam, []):
+                    addr = addr.get('addr', '').split('%')[0]
+                    try:
+                        addr = _normalize_address(addr)
+                    except (socket.error, ValueError):
+                        continue
+                    self.addrtoiface.setdefault(addr, iface)
+        self.ifnames = {}
+        try:
+            for iname in os.listdir('/sys/class/net'):
+                with open('/sys/class/net/{0}/ifindex'.format(iname)) as idxf:
+                    self.ifnames[int(idxf.read())] = iname
+        except (IOError, OSError, ValueError):
+            pass
+
+    def _index_routes(self):
+        # networks routed, grouped by mask, longest first
+        routes = {}
+        for rl in self.routetext.split('\n')[1:]:
+            if not rl:
+                continue
+            rd = rl.split('\t')
+            if rd[1] == '00000000':  # default gateway, not useful for this
+                continue
+            # don't have big endian to look at, assume that it is host endian
+            maskn = struct.unpack('I', struct.pack('>I', int(rd[7], 16)))[0]
+            netn = struct.unpack('I', struct.pack('>I', int(rd[1], 16)))[0]
+            nbits = 0
+            currmask = maskn
+            while currmask:
+                nbits += 1
+                currmask = currmask << 1 & 0xffffffff
+            routes.setdefault((nbits, maskn), set([])).add(netn)
+        self.routes = [(key[1], key[0], routes[key])
+                       for key in sorted(routes, reverse=True)]
+
+
+_localtables = _LocalTables()
+
+
+def _normalize_address(address):
+    # packed form of an address, with IPv4 in IPv6 notation as IPv4
+    fam = socket.AF_INET6 if ':' in address else socket.AF_INET
+    packed = socket.inet_pton(fam, address)
+    if fam == socket.AF_INET6 and packed[:12] == b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xff\xff':
+        packed = packed[-4:]
+    return packed
+
+
 def address_is_local(address):
-    for iface in netifaces.interfaces():
-        for i4 in netifaces.ifaddresses(iface).get(2, []):
+    _localtables.refresh()
+    for iface in _localtables.ifaddrs:
+        ifaddrs = _localtables.ifaddrs[iface]
+        for i4 in ifaddrs.get(2, []):
             cidr = mask_to_cidr(i4['netmask'])
             if ip_on_same_subnet(i4['addr'], address, cidr):
                 return True
-        for i6 in netifaces.ifaddresses(iface).get(10, []):
+        for i6 in ifaddrs.get(10, []):
             cidr = int(i6['netmask'].split('/')[1])
             laddr = i6['addr'].split('%')[0]
             if ip_on_same_subnet(laddr, address, cidr):
@@ -78,36 +192,38 @@ def address_is_local(address):
     return False
 
 
-_idxtoifnamemap = {}
-def _rebuildidxmap():
-    _idxtoifnamemap.clear()
-    for iname in os.listdir('/sys/class/net'):
-        ci = int(open('/sys/class/net/{0}/ifindex'.format(iname)).read())
-        _idxtoifnamemap[ci] = iname
-
-
 def myiptonets(svrip):
-    fam = netifaces.AF_INET
-    if ':' in svrip:
-        fam = netifaces.AF_INET6
+    _localtables.refresh()
     relevantnic = None
-    for iface in netifaces.interfaces():
-        for addr in netifaces.ifaddresses(iface).get(fam, []):
-            addr = addr.get('addr', '')
-            addr = addr.split('%')[0]
-            if addresses_match(addr, svrip):
-                relevantnic = iface
-                break
-        else:
-            continue
-        break
+    try:
+        relevantnic = _localtables.addrtoiface.get(
+            _normalize_address(svrip.split('%')[0]), None)
+    except (socket.error, ValueError):
+        # not an address literal, compare the hard way
+        fam = netifaces.AF_INET
+        if ':' in svrip:
+            fam = netifaces.AF_INET6
+        for iface in _localtables.ifaddrs:
+            for addr in _localtables.ifaddrs[iface].get(fam, []):
+                addr = addr.get('addr', '')
+                addr = addr.split('%')[0]
+                if addresses_match(addr, svrip):
+                    relevantnic = iface
+                    break
+            else:
+                continue
+            break
+    if relevantnic in _localtables.ipv4nets:
+        return iter(_localtables.ipv4nets[relevantnic])
     return inametonets(relevantnic)
 
 
 def _iftonets(ifidx):
+    _localtables.refresh()
     if isinstance(ifidx, int):
-        _rebuildidxmap()
-        ifidx = _idxtoifnamemap.get(ifidx, None)
+        ifidx = _localtables.ifnames.get(ifidx, None)
+    if ifidx in _localtables.ipv4nets:
+        return iter(_localtables.ipv4nets[ifidx])
     return inametonets(ifidx)
 
 def inametonets(iname):
@@ -116,6 +232,11 @@ def inametonets(iname):
         addrs = addrs[netifaces.AF_INET]
     except KeyError:
         return
+    for net in _addrstonets(addrs):
+        yield net
+
+
+def _addrstonets(addrs):
     for addr in addrs:
         ip = struct.unpack('!I', socket.inet_aton(addr['addr']))[0]
         mask = struct.unpack('!I', socket.inet_aton(addr['netmask']))[0]
@@ -132,6 +253,11 @@ def inametonets(iname):
 # that mac address
 # the ip as reported by recvmsg to match the subnet of that net.* interface
 # if switch and port available, that should match.
+def _net_changed(nodeattribs, configmanager, **kwargs):
+    for node in nodeattribs:
+        _nodeconfigs.pop((configmanager.tenant, node), None)
+
+
 def get_nic_config(configmanager, node, ip=None, mac=None, ifidx=None,
                    serverip=None):
     """Fetch network configuration parameters for a nic
@@ -149,6 +275,30 @@ def get_nic_config(configmanager, node, ip=None, mac=None, ifidx=None,
 
     :returns: A dict of parameters, 'ipv4_gateway', ....
     """
+    _localtables.refresh()
+    nodekey = (configmanager.tenant, node)
+    request = (ip, mac, ifidx, serverip)
+    nodeconfigs = _nodeconfigs.get(nodekey, {})
+    cached = nodeconfigs.get(request, None)
+    now = util.monotonic_time()
+    if (cached is not None and cached[0] == _localtables.generation and
+            now - cached[1] < _nodecachettl):
+        return dict(cached[2])
+    watched = _netwatched.setdefault(configmanager.tenant, set([]))
+    if node not in watched:
+        watched.add(node)
+        configmanager.watch_attributes((node,), ('net*',), _net_changed)
+    generation = _localtables.generation
+    cfgdata = _get_nic_config(configmanager, node, ip, mac, ifidx, serverip)
+    nodeconfigs = _nodeconfigs.setdefault(nodekey, {})
+    if len(nodeconfigs) >= _nodecachemax:
+        nodeconfigs.clear()
+    nodeconfigs[request] = (generation, now, dict(cfgdata))
+    return cfgdata
+
+
+def _get_nic_config(configmanager, node, ip=None, mac=None, ifidx=None,
+                    serverip=None):
     # ip parameter *could* be the result of recvmsg with cmsg to tell
     # pxe *our* ip address, or it could be the desired ip address
     #TODO(jjohnson2): ip address, prefix length, mac address,
@@ -276,24 +426,10 @@ def get_prefix_len_for_ip(ip):
         return 64
     # It comes out big endian, regardless of host arch
     ipn = struct.unpack('>I', ipn)[0]
-    rf = open('/proc/net/route')
-    ri = rf.read()
-    rf.close()
-    ri = ri.split('\n')[1:]
-    for rl in ri:
-        if not rl:
-            continue
-        rd = rl.split('\t')
-        if rd[1] == '00000000':  # default gateway, not useful for this
-            continue
-        # don't have big endian to look at, assume that it is host endian
-        maskn = struct.unpack('I', struct.pack('>I', int(rd[7], 16)))[0]
-        netn = struct.unpack('I', struct.pack('>I', int(rd[1], 16)))[0]
-        if ipn & maskn == netn:
-            nbits = 0
-            while maskn:
-                nbits += 1
-                maskn = maskn << 1 & 0xffffffff
+    _localtables.refresh()
+    # the most specific route wins, as it would for the kernel
+    for maskn, nbits, nets in _localtables.routes:
+        if ipn & maskn in nets:
             return nbits
     raise exc.NotImplementedException("Non local addresses not supported")
 
@@ -20,10 +20,12 @@
 # the middle of strings and use of @ for anything is not in their syntax
 
 
+import collections
 import copy
 import itertools
 import pyparsing as pp
 import re
+import threading
 
 try:
     range = xrange
@@ -46,6 +48,88 @@ numregex = re.compile('([0-9]+)')
 
 lastnoderange = None
 
+# Parsed noderange strings are independent of configuration, so they are
+# kept in an LRU for reuse.  Evaluated results depend on the configuration
+# and are keyed on the tenant and configuration generation, so any change
+# to nodes or groups naturally retires stale entries
+_cachesize = 256
+_cachelock = threading.RLock()
+_plancache = collections.OrderedDict()
+_rangecache = collections.OrderedDict()
+_candidatecache = collections.OrderedDict()
+_indexes = {}
+
+
+def _cache_get(cache, key):
+    with _cachelock:
+        try:
+            val = cache.pop(key)
+        except KeyError:
+            return None
+        cache[key] = val
+        return val
+
+
+def _cache_put(cache, key, val):
+    with _cachelock:
+        cache[key] = val
+        while len(cache) > _cachesize:
+            cache.popitem(last=False)
+
+
+def _get_generation(config):
+    if config is None:
+        return None
+    try:
+        return config.tenant, config.generation
+    except AttributeError:
+        # a config object that can not report changes can not be cached
+        return False
+
+
+def _compile(noderange):
+    plan = _cache_get(_plancache, noderange)
+    if plan is None:
+        try:
+            plan = _parser.parseString("(" + noderange + ")").asList()[0]
+        except pp.ParseException as pe:
+            raise Exception("Invalid syntax")
+        _cache_put(_plancache, noderange, plan)
+    return plan
+
+
+def _get_index(config, generation):
+    index = _indexes.get(generation[0], None)
+    if index is None or index.generation != generation:
+        index = _NodeIndex(config, generation)
+        _indexes[generation[0]] = index
+    return index
+
+
+class _NodeIndex(object):
+    """Snapshot of node and group membership for a config generation
+
+    Group expansions are memoized on first use, so that nested and repeated
+    group references share the work for as long as the generation holds.
+    """
+
+    def __init__(self, config, generation):
+        self.generation = generation
+        self.nodes = frozenset(config.list_nodes())
+        self.groups = {}
+
+    def expand_group(self, config, group):
+        nodes = self.groups.get(group, None)
+        if nodes is None:
+            grpcfg = config.get_nodegroup_attributes(group)
+            nodes = set(grpcfg.get('nodes', ()))
+            if 'noderange' in grpcfg and grpcfg['noderange']:
+                nodes |= NodeRange(grpcfg['noderange']['value'], config).nodes
+            nodes = frozenset(nodes)
+            self.groups[group] = nodes
+        return nodes
+
+
 def humanify_nodename(nodename):
     """Analyzes nodename in a human way to enable natural sort
 
@@ -105,16 +189,29 @@ class NodeRange(object):
         self.beginpage = None
         self.endpage = None
         self.cfm = config
-        try:
-            elements = _parser.parseString("(" + noderange + ")").asList()[0]
-        except pp.ParseException as pe:
-            raise Exception("Invalid syntax")
-        if noderange[0] in ('<', '>'):
-            # pagination across all nodes
-            self._evaluate(elements)
-            self._noderange = set(self.cfm.list_nodes())
+        self._index = None
+        generation = _get_generation(config)
+        cachekey = (noderange, generation)
+        cached = None
+        if generation is not False:
+            cached = _cache_get(_rangecache, cachekey)
+        if cached is not None:
+            nodes, self.beginpage, self.endpage = cached
+            self._noderange = set(nodes)
         else:
-            self._noderange = self._evaluate(elements)
+            elements = _compile(noderange)
+            if generation:
+                self._index = _get_index(config, generation)
+            if noderange[0] in ('<', '>'):
+                # pagination across all nodes
+                self._evaluate(elements)
+                self._noderange = set(self.cfm.list_nodes())
+            else:
+                self._noderange = self._evaluate(elements)
+            if generation is not False:
+                _cache_put(_rangecache, cachekey, (
+                    frozenset(self._noderange), self.beginpage,
+                    self.endpage))
         lastnoderange = {noderange: set(self._noderange)}
 
     @property
@@ -159,60 +256,41 @@ class NodeRange(object):
         return set([atom])
 
     def expandrange(self, seqrange, delimiter):
-        pieces = seqrange.split(delimiter)
-        if len(pieces) % 2 != 0:
+        candidates = _expand_candidates(seqrange, delimiter)
+        if candidates is None:
             return self.failorreturn(seqrange)
-        halflen = len(pieces) // 2
-        left = delimiter.join(pieces[:halflen])
-        right = delimiter.join(pieces[halflen:])
-        leftbits = _numextractor.parseString(left).asList()
-        rightbits = _numextractor.parseString(right).asList()
-        if len(leftbits) != len(rightbits):
-            return self.failorreturn(seqrange)
-        finalfmt = ''
-        iterators = []
-        for idx in range(len(leftbits)):
-            if leftbits[idx] == rightbits[idx]:
-                finalfmt += leftbits[idx]
-            elif leftbits[idx][0] in pp.alphas:
-                # if string portion unequal, not going to work
-                return self.failorreturn(seqrange)
-            else:
-                curseq = []
-                finalfmt += '{%d}' % len(iterators)
-                iterators.append(curseq)
-                leftnum = int(leftbits[idx])
-                rightnum = int(rightbits[idx])
-                if leftnum > rightnum:
-                    width = len(rightbits[idx])
-                    minnum = rightnum
-                    maxnum = leftnum + 1  # range goes to n-1...
-                elif rightnum > leftnum:
-                    width = len(leftbits[idx])
-                    minnum = leftnum
-                    maxnum = rightnum + 1
-                else:  # differently padded, but same number...
-                    return self.failorreturn(seqrange)
-                numformat = '{0:0%d}' % width
-                for num in range(minnum, maxnum):
-                    curseq.append(numformat.format(num))
-        results = set([])
-        for combo in itertools.product(*iterators):
-            entname = finalfmt.format(*combo)
-            results |= self.expand_entity(entname)
+        names, nameset = candidates
+        if self.cfm is None:
+            return set(nameset)
+        if self._index is None:
+            results = set([])
+            for entname in names:
+                results |= self.expand_entity(entname)
+            return results
+        results = set(nameset & self._index.nodes)
+        if len(results) != len(nameset):
+            # something other than a node, let groups have a look in order
+            for entname in names:
+                if entname not in self._index.nodes:
+                    results |= self.expand_entity(entname)
         return results
 
     def expand_entity(self, entname):
         if self.cfm is None or self.cfm.is_node(entname):
             return set([entname])
         if self.cfm.is_nodegroup(entname):
-            grpcfg = self.cfm.get_nodegroup_attributes(entname)
-            nodes = copy.copy(grpcfg['nodes'])
-            if 'noderange' in grpcfg and grpcfg['noderange']:
-                nodes |= NodeRange(
-                    grpcfg['noderange']['value'], self.cfm).nodes
-            return nodes
+            return self.expand_group(entname)
         raise Exception('Unknown node ' + entname)
+
+    def expand_group(self, group):
+        if self._index is not None:
+            return set(self._index.expand_group(self.cfm, group))
+        grpcfg = self.cfm.get_nodegroup_attributes(group)
+        nodes = copy.copy(grpcfg['nodes'])
+        if 'noderange' in grpcfg and grpcfg['noderange']:
+            nodes |= NodeRange(
+                grpcfg['noderange']['value'], self.cfm).nodes
+        return nodes
         
     def _expandstring(self, element, filternodes=None):
         prefix = ''
@@ -242,12 +320,7 @@ class NodeRange(object):
             if self.cfm.is_node(element):
                 return set([element])
             if self.cfm.is_nodegroup(element):
-                grpcfg = self.cfm.get_nodegroup_attributes(element)
-                nodes = copy.copy(grpcfg['nodes'])
-                if 'noderange' in grpcfg and grpcfg['noderange']:
-                    nodes |= NodeRange(
-                        grpcfg['noderange']['value'], self.cfm).nodes
-                return nodes
+                return self.expand_group(element)
         if ':' in element:  # : range for less ambiguity
             return self.expandrange(element, ':')
         elif '..' in element:
@@ -282,3 +355,58 @@ class NodeRange(object):
         if self.cfm is None:
             return set([element])
         raise Exception(element + ' not a recognized node, group, or alias')
+
+
+def _expand_candidates(seqrange, delimiter):
+    """Expand a sequential range into the names it could possibly describe
+
+    This is independent of configuration, so the result is cached for reuse
+    :returns: tuple of names in order and frozenset of same, or None if
+              the range is not valid
+    """
+    cachekey = (seqrange, delimiter)
+    candidates = _cache_get(_candidatecache, cachekey)
+    if candidates is not None:
+        return candidates
+    pieces = seqrange.split(delimiter)
+    if len(pieces) % 2 != 0:
+        return None
+    halflen = len(pieces) // 2
+    left = delimiter.join(pieces[:halflen])
+    right = delimiter.join(pieces[halflen:])
+    leftbits = _numextractor.parseString(left).asList()
+    rightbits = _numextractor.parseString(right).asList()
+    if len(leftbits) != len(rightbits):
+        return None
+    finalfmt = ''
+    iterators = []
+    for idx in range(len(leftbits)):
+        if leftbits[idx] == rightbits[idx]:
+            finalfmt += leftbits[idx]
+        elif leftbits[idx][0] in pp.alphas:
+            # if string portion unequal, not going to work
+            return None
+        else:
+            curseq = []
+            finalfmt += '{%d}' % len(iterators)
+            iterators.append(curseq)
+            leftnum = int(leftbits[idx])
+            rightnum = int(rightbits[idx])
+            if leftnum > rightnum:
+                width = len(rightbits[idx])
+                minnum = rightnum
+                maxnum = leftnum + 1  # range goes to n-1...
+            elif rightnum > leftnum:
+                width = len(leftbits[idx])
+                minnum = leftnum
+                maxnum = rightnum + 1
+            else:  # differently padded, but same number...
+                return None
+            numformat = '{0:0%d}' % width
+            for num in range(minnum, maxnum):
+                curseq.append(numformat.format(num))
+    names = tuple([finalfmt.format(*combo)
+                   for combo in itertools.product(*iterators)])
+    candidates = (names, frozenset(names))
+    _cache_put(_candidatecache, cachekey, candidates)
+    return candidates
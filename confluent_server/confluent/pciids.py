@@ -0,0 +1,235 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2019 Lenovo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Names of PCI vendors and devices, for adapters that the BMC reports only
+# by ID.  Names come from the local pci.ids database (the 'pci_ids' path in
+# the [inventory] section of service.cfg, otherwise the usual locations of
+# the system copy).  IDs not found there are looked up in the pci.id.ucw.cz
+# DNS service unless 'pci_dns' is set to false, and those answers, including
+# failures, are kept in /var/cache/confluent/pciids across restarts.  The
+# file is written in a native thread a few seconds after the first new
+# answer, so that a walk of an inventory writes it once.  Failed lookups are
+# retried after 'pci_dns_retry' seconds (86400).
+
+import confluent.config.conf as conf
+import confluent.log as log
+import errno
+import eventlet
+import eventlet.support.greendns
+import eventlet.tpool
+import msgpack
+import os
+import time
+
+_pciidpaths = ('/usr/share/hwdata/pci.ids', '/usr/share/misc/pci.ids',
+               '/usr/share/pci.ids')
+_dnscachefile = '/var/cache/confluent/pciids'
+_database = None
+_dnscache = None
+_dnssaver = None
+
+
+class _PciDatabase(object):
+    """Index of a pci.ids file
+
+    Vendors, devices and subsystems are each keyed by their IDs packed into
+    a single integer.
+    """
+
+    def __init__(self, filename):
+        self.vendors = {}
+        self.devices = {}
+        self.subsystems = {}
+        vendor = device = None
+        with open(filename, 'rb') as pciids:
+            for line in pciids:
+                line = line.decode('utf8', 'replace').rstrip()
+                if not line or line[0] == '#':
+                    continue
+                if line.startswith('C '):
+                    break  # device classes follow the vendors, not needed
+                try:
+                    if line.startswith('\t\t'):
+                        svid, sdid, name = line[2:].split(None, 2)
+                        if device is None:
+                            continue
+                        subsystem = (int(svid, 16) << 16) | int(sdid, 16)
+                        self.subsystems[(device << 32) | subsystem] = name
+                    elif line[0] == '\t':
+                        did, name = line[1:].split(None, 1)
+                        if vendor is None:
+                            continue
+                        device = (vendor << 16) | int(did, 16)
+                        self.devices[device] = name
+                    else:
+                        vid, name = line.split(None, 1)
+                        vendor = int(vid, 16)
+                        device = None
+                        self.vendors[vendor] = name
+                except (IndexError, ValueError):
+                    continue
+
+    def lookup(self, subdevice, subvendor, device, vendor):
+        vendorstr = devstr = None
+        devkey = (vendor << 16) | device
+        if subvendor is not None and subdevice is not None:
+            vendorstr = self.vendors.get(subvendor, None)
+            devstr = self.subsystems.get(
+                (devkey << 32) | (subvendor << 16) | subdevice, None)
+        if vendorstr is None:
+            vendorstr = self.vendors.get(vendor, None)
+        if devstr is None:
+            devstr = self.devices.get(devkey, None)
+        return vendorstr, devstr
+
+
+def _get_database():
+    global _database
+    if _database is None:
+        _database = False
+        paths = _pciidpaths
+        configured = conf.get_option('inventory', 'pci_ids')
+        if configured:
+            paths = (configured,)
+        for path in paths:
+            if os.path.exists(path):
+                try:
+                    _database = _PciDatabase(path)
+                except Exception:
+                    log.logtrace()
+                    continue
+                break
+    return _database
+
+
+def _load_dnscache():
+    global _dnscache
+    if _dnscache is None:
+        _dnscache = {}
+        try:
+            with open(_dnscachefile, 'rb') as cachein:
+                _dnscache = msgpack.unpackb(cachein.read(), raw=False)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                log.logtrace()
+        except Exception:
+            log.logtrace()
+    return _dnscache
+
+
+def _write_dnscache(data):
+    try:
+        try:
+            os.makedirs(os.path.dirname(_dnscachefile))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        with open(_dnscachefile + '.new', 'wb') as cacheout:
+            cacheout.write(data)
+        os.rename(_dnscachefile + '.new', _dnscachefile)
+    except (IOError, OSError):
+        log.logtrace()
+
+
+def _save_dnscache():
+    global _dnssaver
+    # answers arriving while writing get a save of their own
+    _dnssaver = None
+    eventlet.tpool.execute(_write_dnscache,
+                           msgpack.packb(_dnscache, use_bin_type=False))
+
+
+def _queue_save_dnscache():
+    global _dnssaver
+    if _dnssaver is None:
+        _dnssaver = eventlet.spawn_after(5, _save_dnscache)
+
+
+def get_dns_txt(qstring):
+    answer = eventlet.support.greendns.resolver.query(
+        qstring, 'TXT')[0].strings[0]
+    if not isinstance(answer, str):
+        answer = answer.decode('utf8')
+    return answer.replace('i=', '')
+
+
+def _cached_dns_txt(qstring):
+    cache = _load_dnscache()
+    if qstring in cache:
+        answer, when = cache[qstring]
+        if answer is not None:
+            return answer
+        retry = conf.get_int_option('inventory', 'pci_dns_retry')
+        if retry is None:
+            retry = 86400
+        if time.time() - when < retry:
+            return None
+    try:
+        answer = get_dns_txt(qstring)
+    except Exception:
+        answer = None
+    cache[qstring] = [answer, time.time()]
+    _queue_save_dnscache()
+    return answer
+
+
+def _dns_lookup(subdevice, subvendor, device, vendor):
+    vendorstr = devstr = None
+    if subvendor is not None and subdevice is not None:
+        vendorstr = _cached_dns_txt(
+            '{0:04x}.pci.id.ucw.cz'.format(subvendor))
+        devstr = _cached_dns_txt(
+            '{0:04x}.{1:04x}.{2:04x}.{3:04x}.pci.id.ucw.cz'.format(
+                subdevice, subvendor, device, vendor))
+    if vendorstr is None:
+        vendorstr = _cached_dns_txt('{0:04x}.pci.id.ucw.cz'.format(vendor))
+    if devstr is None:
+        devstr = _cached_dns_txt('{0:04x}.{1:04x}.pci.id.ucw.cz'.format(
+            device, vendor))
+    return vendorstr, devstr
+
+
+def _parse_id(pciid):
+    if pciid is None or isinstance(pciid, int):
+        return pciid
+    return int(pciid, 16)
+
+
+def get_pci_text_from_ids(subdevice, subvendor, device, vendor):
+    """Give the names of the vendor and device of a PCI adapter
+
+    :param subdevice: The subsystem device ID, in hex or as an int, if known
+    :param subvendor: The subsystem vendor ID, in hex or as an int, if known
+    :param device: The device ID, in hex or as an int
+    :param vendor: The vendor ID, in hex or as an int
+    :returns: Tuple of vendor name and device name, either None if unknown
+    """
+    try:
+        ids = [_parse_id(x) for x in (subdevice, subvendor, device, vendor)]
+    except (TypeError, ValueError):
+        return None, None
+    if ids[2] is None or ids[3] is None:
+        return None, None
+    vendorstr = devstr = None
+    database = _get_database()
+    if database:
+        vendorstr, devstr = database.lookup(*ids)
+    if vendorstr and devstr:
+        return vendorstr, devstr
+    if conf.get_boolean_option('inventory', 'pci_dns') is False:
+        return vendorstr, devstr
+    dnsvendor, dnsdev = _dns_lookup(*ids)
+    return vendorstr or dnsvendor, devstr or dnsdev
@@ -271,11 +271,43 @@ def update_nodes(nodes, element, configmanager, inputdata):
                                 foundattrib = True
                         if not foundattrib:
                             raise exc.InvalidArgumentException("No attribute matches '" + attrib + "' (try wildcard if trying to clear a group)")
-            if len(clearattribs) > 0:
+            if element[-1] == 'batch':
+                # clears ride along in the same transaction as the sets
+                for attrib in clearattribs:
+                    updatenode[attrib] = None
+            elif len(clearattribs) > 0:
                 configmanager.clear_node_attributes([node], clearattribs)
             updatedict[node] = updatenode
     try:
-        configmanager.set_node_attributes(updatedict)
+        if element[-1] == 'batch':
+            configmanager.batch_node_attributes([updatedict])
+        else:
+            configmanager.set_node_attributes(updatedict)
     except ValueError as e:
         raise exc.InvalidArgumentException(str(e))
+    if element[-1] == 'batch':
+        return retrieve_batch(updatedict, configmanager)
     return retrieve(nodes, element, configmanager, inputdata)
+
+
+def retrieve_batch(updatedict, configmanager):
+    for node in util.natural_sort(updatedict):
+        attributes = configmanager.get_node_attributes(
+            node, list(updatedict[node])).get(node, {})
+        for attribute in sorted(updatedict[node]):
+            val = attributes.get(attribute, {'value': None})
+            if attribute.startswith('secret.') or attribute.startswith('crypted.'):
+                yield msg.CryptedAttributes(
+                    node, {attribute: val},
+                    allattributes.node.get(
+                        attribute, {}).get('description', ''))
+            elif isinstance(val, list):
+                yield msg.ListAttributes(
+                    node, {attribute: val},
+                    allattributes.node.get(
+                        attribute, {}).get('description', ''))
+            else:
+                yield msg.Attributes(
+                    node, {attribute: val},
+                    allattributes.node.get(
+                        attribute, {}).get('description', ''))
@@ -15,9 +15,14 @@
 
 import atexit
 import confluent.exceptions as exc
+import confluent.fanin as fanin
 import confluent.firmwaremanager as firmwaremanager
+import confluent.healthcache as healthcache
+import confluent.inventorycache as inventorycache
 import confluent.interface.console as conapi
 import confluent.messages as msg
+import confluent.pciids as pciids
+import confluent.sensorcache as sensorcache
 import confluent.util as util
 import copy
 import errno
@@ -25,7 +30,6 @@ import eventlet
 import eventlet.event
 import eventlet.green.threading as threading
 import eventlet.greenpool as greenpool
-import eventlet.queue as queue
 import eventlet.support.greendns
 from fnmatch import fnmatch
 import os
@@ -48,38 +52,6 @@ try:
 except NameError:
     pass
 
-pci_cache = {}
-
-def get_dns_txt(qstring):
-    return eventlet.support.greendns.resolver.query(
-        qstring, 'TXT')[0].strings[0].replace('i=', '')
-
-def get_pci_text_from_ids(subdevice, subvendor, device, vendor):
-    fqpi = '{0}.{1}.{2}.{3}'.format(subdevice, subvendor, device, vendor)
-    if fqpi in pci_cache:
-        return pci_cache[fqpi]
-    vendorstr = None
-    try:
-        vendorstr = get_dns_txt('{0}.pci.id.ucw.cz'.format(subvendor))
-    except Exception:
-        try:
-            vendorstr = get_dns_txt('{0}.pci.id.ucw.cz'.format(vendor))
-        except Exception:
-            pass
-    devstr = None
-    try:
-        devstr = get_dns_txt(fqpi + '.pci.id.ucw.cz')
-    except Exception:
-        try:
-            devstr = get_dns_txt('{0}.{1}.pci.id.ucw.cz'.format(
-                device, vendor))
-        except Exception:
-            pass
-    if vendorstr and devstr:
-        pci_cache[fqpi] = vendorstr, devstr
-    return vendorstr, devstr
-
-
 # There is something not right with the RLocks used in pyghmi when
 # eventlet comes into play.  It seems like sometimes on acquire,
 # it calls _get_ident and it isn't the id(greenlet) and so
@@ -178,8 +150,7 @@ class IpmiCommandWrapper(ipmicommand.Command):
         self.cfm = cfm
         self.node = node
         self.sensormap = {}
-        self._inhealth = False
-        self._lasthealth = None
+        self._healthreader = healthcache.HealthReader()
         kwargs['keepalive'] = False
         self._attribwatcher = cfm.watch_attributes(
             (node,), ('secret.hardwaremanagementuser', 'collective.manager',
@@ -217,18 +188,8 @@ class IpmiCommandWrapper(ipmicommand.Command):
             pass
 
     def get_health(self):
-        if self._inhealth:
-            while self._inhealth:
-                eventlet.sleep(0.1)
-            return self._lasthealth
-        self._inhealth = True
-        try:
-            self._lasthealth = super(IpmiCommandWrapper, self).get_health()
-        except Exception:
-            self._inhealth = False
-            raise
-        self._inhealth = False
-        return self._lasthealth
+        return self._healthreader.read(
+            super(IpmiCommandWrapper, self).get_health)
 
 
 def _ipmi_evtloop():
@@ -384,46 +345,11 @@ def perform_requests(operator, nodes, element, cfg, inputdata, realop):
     cfg.decrypt = True
     configdata = cfg.get_node_attributes(nodes, _configattributes)
     cfg.decrypt = cryptit
-    resultdata = queue.LightQueue()
-    livingthreads = set([])
-    numnodes = len(nodes)
-    for node in nodes:
-        livingthreads.add(_ipmiworkers.spawn(
-            perform_request, operator, node, element, configdata, inputdata,
-            cfg, resultdata, realop))
-    while livingthreads:
-        try:
-            bundle = []
-            datum = resultdata.get(timeout=10)
-            while datum:
-                if datum != 'Done':
-                    if isinstance(datum, Exception):
-                        raise datum
-                    if (hasattr(datum, 'kvpairs') and datum.kvpairs and
-                            len(datum.kvpairs) == 1):
-                        bundle.append((list(datum.kvpairs)[0], datum))
-                        numnodes -= 1
-                    else:
-                        yield datum
-                timeout = 0.1 if numnodes else 0.001
-                datum = resultdata.get(timeout=timeout)
-        except queue.Empty:
-            pass
-        finally:
-            for datum in sorted(
-                    bundle, key=lambda x: util.naturalize_string(x[0])):
-                yield datum[1]
-        for t in list(livingthreads):
-            if t.dead:
-                livingthreads.discard(t)
-    try:
-        # drain queue if a thread put something on the queue and died
-        while True:
-            datum = resultdata.get_nowait()
-            if datum != 'Done':
-                yield datum
-    except queue.Empty:
-        pass
+    for datum in fanin.gather(
+            nodes, lambda node, results: _ipmiworkers.spawn(
+                perform_request, operator, node, element, configdata,
+                inputdata, cfg, results, realop)):
+        yield datum
 
 
 def perform_request(operator, node, element,
@@ -455,7 +381,7 @@ def perform_request(operator, node, element,
             results.put(msg.ConfluentNodeError(node, 'Unexpected Error: {0}'.format(str(e))))
             traceback.print_exc()
         finally:
-            results.put('Done')
+            results.put(fanin.NodeDone(node))
 
 persistent_ipmicmds = {}
 
@@ -1014,7 +940,7 @@ class IpmiHandler(object):
             svid = myinf.get('PCI Subsystem Vendor ID', None)
             did = myinf.get('PCI Device ID', None)
             vid = myinf.get('PCI Vendor ID', None)
-            vstr, dstr = get_pci_text_from_ids(sdid, svid, did, vid)
+            vstr, dstr = pciids.get_pci_text_from_ids(sdid, svid, did, vid)
             if vstr:
                 newinf['information']['PCI Vendor'] = vstr
             if dstr:
@@ -1287,6 +1213,8 @@ class IpmiHandler(object):
                 badsensors = []
                 for reading in response['badreadings']:
                     if hasattr(reading, 'health'):
+                        # the response may be shared with other requests
+                        reading = copy.copy(reading)
                         reading.health = _str_health(reading.health)
                     badsensors.append(reading)
                 self.output.put(msg.SensorReadings(badsensors, name=self.node))
@@ -1605,10 +1533,32 @@ def retrieve(nodes, element, configmanager, inputdata):
     elif '/'.join(element).startswith('support/servicedata'):
         return firmwaremanager.list_updates(nodes, configmanager.tenant,
                                             element, 'ffdc')
+    elif element[0] == 'sensors':
+        return sensorcache.retrieve_sensors(
+            nodes, element, configmanager, sensor_categories,
+            lambda nodes: perform_requests('read', nodes, element,
+                                           configmanager, inputdata, 'read'))
+    elif element == ['health', 'hardware']:
+        return healthcache.retrieve_health(
+            nodes, configmanager, inputdata,
+            lambda nodes: perform_requests('read', nodes, element,
+                                           configmanager, inputdata, 'read'))
+    elif element[0] == 'inventory':
+        return inventorycache.retrieve_inventory(
+            nodes, element, configmanager, inputdata,
+            lambda nodes: perform_requests('read', nodes, element,
+                                           configmanager, inputdata, 'read'))
     else:
         return perform_requests('read', nodes, element, configmanager,
                                 inputdata, 'read')
 
+
+def sample_sensors(nodes, category, configmanager):
+    initthread()
+    return perform_requests('read', nodes,
+                            ['sensors', 'hardware', category, 'all'],
+                            configmanager, None, 'read')
+
 def delete(nodes, element, configmanager, inputdata):
     initthread()
     if '/'.join(element).startswith('inventory/firmware/updates/active'):
@@ -1623,3 +1573,5 @@ def delete(nodes, element, configmanager, inputdata):
     return perform_requests(
         'delete', nodes, element, configmanager, inputdata, 'delete')
 
+
+sensorcache.register_sampler('ipmi', sample_sensors, simplify_name)
@@ -13,9 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import confluent.config.conf as conf
 import confluent.exceptions as exc
+import confluent.fanin as fanin
 import confluent.firmwaremanager as firmwaremanager
+import confluent.healthcache as healthcache
+import confluent.inventorycache as inventorycache
 import confluent.messages as msg
+import confluent.pciids as pciids
+import confluent.sensorcache as sensorcache
 import confluent.util as util
 import copy
 import errno
@@ -23,9 +30,10 @@ import eventlet
 import eventlet.event
 import eventlet.green.threading as threading
 import eventlet.greenpool as greenpool
-import eventlet.queue as queue
 import eventlet.support.greendns
 from fnmatch import fnmatch
+import functools
+import inspect
 import os
 import pwd
 import pyghmi.constants as pygconstants
@@ -35,42 +43,11 @@ ipmicommand = eventlet.import_patched('pyghmi.redfish.command')
 import socket
 import ssl
 import traceback
+import weakref
 
 if not hasattr(ssl, 'SSLEOFError'):
     ssl.SSLEOFError = None
 
-pci_cache = {}
-
-def get_dns_txt(qstring):
-    return eventlet.support.greendns.resolver.query(
-        qstring, 'TXT')[0].strings[0].replace('i=', '')
-
-def get_pci_text_from_ids(subdevice, subvendor, device, vendor):
-    fqpi = '{0}.{1}.{2}.{3}'.format(subdevice, subvendor, device, vendor)
-    if fqpi in pci_cache:
-        return pci_cache[fqpi]
-    vendorstr = None
-    try:
-        vendorstr = get_dns_txt('{0}.pci.id.ucw.cz'.format(subvendor))
-    except Exception:
-        try:
-            vendorstr = get_dns_txt('{0}.pci.id.ucw.cz'.format(vendor))
-        except Exception:
-            pass
-    devstr = None
-    try:
-        devstr = get_dns_txt(fqpi + '.pci.id.ucw.cz')
-    except Exception:
-        try:
-            devstr = get_dns_txt('{0}.{1}.pci.id.ucw.cz'.format(
-                device, vendor))
-        except Exception:
-            pass
-    if vendorstr and devstr:
-        pci_cache[fqpi] = vendorstr, devstr
-    return vendorstr, devstr
-
-
 # There is something not right with the RLocks used in pyghmi when
 # eventlet comes into play.  It seems like sometimes on acquire,
 # it calls _get_ident and it isn't the id(greenlet) and so
@@ -93,6 +70,93 @@ _ipmiworkers = greenpool.GreenPool()
 _ipmithread = None
 _ipmiwaiters = []
 
+# Requests to BMCs are issued in parallel, up to a limit per BMC that is
+# learned per model of BMC: it grows while requests succeed and is halved
+# when the BMC times out or reports itself busy.  The [redfish] section of
+# service.cfg sets where the limit starts and how far it may grow
+# (initial_concurrency and max_concurrency), and how often idle sessions
+# are refreshed (session_refresh) until they are dropped (session_idle).
+_requestpool = greenpool.GreenPool(512)
+_modelconcurrency = {}
+_bmclimiters = {}
+_sessionkeeper = None
+_overloaderrors = (socket.error, pygexc.TemporaryError)
+
+
+def _get_redfish_option(option, default):
+    value = conf.get_int_option('redfish', option)
+    if value is None:
+        return default
+    return value
+
+
+class _ModelConcurrency(object):
+    """Learned limit of concurrent requests for a model of BMC"""
+
+    def __init__(self):
+        self.limit = _get_redfish_option('initial_concurrency', 2)
+        self.successes = 0
+
+    def succeeded(self):
+        self.successes += 1
+        if (self.successes >= self.limit * 8 and
+                self.limit < _get_redfish_option('max_concurrency', 8)):
+            self.limit += 1
+            self.successes = 0
+
+    def overloaded(self):
+        self.limit = max(self.limit // 2, 1)
+        self.successes = 0
+
+
+class _BmcLimiter(object):
+    """Limit of concurrent requests to a BMC, shared by the nodes behind it"""
+
+    def __init__(self):
+        self.model = None
+        self.active = 0
+        self.waiters = collections.deque()
+
+    @property
+    def concurrency(self):
+        if self.model not in _modelconcurrency:
+            _modelconcurrency[self.model] = _ModelConcurrency()
+        return _modelconcurrency[self.model]
+
+    def acquire(self):
+        while self.active >= self.concurrency.limit:
+            waiter = eventlet.event.Event()
+            self.waiters.append(waiter)
+            waiter.wait()
+        self.active += 1
+
+    def release(self, overloaded):
+        self.active -= 1
+        if overloaded:
+            self.concurrency.overloaded()
+        else:
+            self.concurrency.succeeded()
+        for _ in range(self.concurrency.limit - self.active):
+            if not self.waiters:
+                break
+            self.waiters.popleft().send()
+
+
+class _BmcPool(object):
+    """Pool given to pyghmi for parallel requests to a BMC
+
+    The requests are limited as IpmiCommandWrapper hands out connections,
+    which single requests go through as well.
+    """
+
+    def __init__(self, bmc):
+        if bmc not in _bmclimiters:
+            _bmclimiters[bmc] = _BmcLimiter()
+        self.limiter = _bmclimiters[bmc]
+
+    def starmap(self, function, iterable):
+        return _requestpool.starmap(function, iterable)
+
 sensor_categories = {
     'temperature': frozenset(['Temperature']),
     'energy': frozenset(['Energy']),
@@ -151,15 +215,65 @@ def sanitize_invdata(indata):
                         format(x, '02x') for x in indata[k][idx])
 
 
+class _Checkout(object):
+    """A connection handed out to a greenthread, until returned or dropped"""
+
+    def __init__(self, reused):
+        self.reused = reused
+        self.ref = None
+        # held while a request of the wrapper is using it, to be kept
+        self.conn = None
+
+
+def _own_connection(conn):
+    # pyghmi requests on a connection get yet another connection from its
+    # dupe, use the connection itself so that it is the one kept alive.  It
+    # is only weakly referenced, to be dropped as soon as the caller does
+    connref = weakref.ref(conn)
+
+    def dupe(*args, **kwargs):
+        conn = connref()
+        if args or kwargs:
+            return type(conn).dupe(conn, *args, **kwargs)
+        return conn
+    return dupe
+
+
+def _stale_connection_error(error):
+    # pyghmi reports a connection closed before a response as unavailable
+    return (isinstance(error, _overloaderrors) or
+            'Target Unavailable' in str(error))
+
+
+def _retriable_request(args, kwargs):
+    # pyghmi's _do_web_request is private, only retry requests known to be
+    # a GET by its arguments
+    try:
+        callargs = inspect.getcallargs(
+            ipmicommand.Command._do_web_request, None, *args, **kwargs)
+    except TypeError:
+        return False
+    return ('payload' in callargs and 'method' in callargs and
+            callargs['payload'] is None and
+            callargs['method'] in (None, 'GET'))
+
+
 class IpmiCommandWrapper(ipmicommand.Command):
     def __init__(self, node, cfm, **kwargs):
-        #kwargs['pool'] = eventlet.greenpool.GreenPool(4)
-        #Some BMCs at the time of this writing crumble under the weight
-        #of 4 concurrent requests.  For now give up on this optimization.
+        # Some BMCs crumble under the weight of concurrent requests, so the
+        # pool only goes as far as the model of BMC proves to tolerate
+        self._bmcpool = _BmcPool(kwargs['bmc'])
+        kwargs['pool'] = self._bmcpool
+        self._newconnection = None
+        self._idle = []
+        self._inuse = {}
+        self._overloaded = set([])
+        self._requesting = set([])
         self.cfm = cfm
         self.node = node
-        self._inhealth = False
-        self._lasthealth = None
+        self._healthreader = healthcache.HealthReader()
+        self.lastused = util.monotonic_time()
+        self.lastrefreshed = self.lastused
         self._attribwatcher = cfm.watch_attributes(
             (node,), ('secret.hardwaremanagementuser', 'collective.manager',
                       'secret.hardwaremanagementpassword', 
@@ -185,6 +299,124 @@ class IpmiCommandWrapper(ipmicommand.Command):
             if 'Redfish not ready' in str(pe):
                 raise exc.TargetEndpointUnreachable('Redfish not yet ready')
             raise
+        self._keepalive_connections()
+        self._bmcpool.limiter.model = self._get_model()
+
+    def _get_model(self):
+        try:
+            root = self._do_web_request('/redfish/v1/')
+        except Exception:
+            return None
+        return (root.get('Vendor', None), root.get('Product', None))
+
+    def _keepalive_connections(self):
+        # pyghmi opens a new connection for every request, hand out idle
+        # connections to the BMC instead, kept alive between requests.  Every
+        # greenthread holding connections takes one place in the limit of
+        # the BMC, until it has returned or dropped all of them
+        wc = getattr(self, 'wc', None)
+        if wc is None or not hasattr(wc, 'dupe'):
+            return
+        self._newconnection = wc.dupe
+
+        def dupe(*args, **kwargs):
+            current = eventlet.getcurrent()
+            if current not in self._inuse:
+                self._bmcpool.limiter.acquire()
+                self._inuse[current] = []
+            try:
+                if args or kwargs:  # a custom timeout, not for general use
+                    conn = self._newconnection(*args, **kwargs)
+                    reused = False
+                else:
+                    reused = bool(self._idle)
+                    if reused:
+                        conn = self._idle.pop()
+                        conn.stdheaders = copy.deepcopy(wc.stdheaders)
+                    else:
+                        conn = self._newconnection()
+                        conn.dupe = _own_connection(conn)
+            except Exception:
+                if not self._inuse[current]:
+                    del self._inuse[current]
+                    self._bmcpool.limiter.release(False)
+                raise
+            checkout = _Checkout(reused)
+            checkout.ref = weakref.ref(
+                conn, functools.partial(self._dropped, current))
+            if current in self._requesting:
+                checkout.conn = conn
+            self._inuse[current].append(checkout)
+            return conn
+        wc.dupe = dupe
+
+    def _dropped(self, current, ref):
+        for checkout in list(self._inuse.get(current, ())):
+            if checkout.ref is ref:
+                self._checkin(current, checkout)
+
+    def _checkin(self, current, checkout, overloaded=False, keep=False):
+        held = self._inuse.get(current, [])
+        if checkout not in held:
+            return
+        held.remove(checkout)
+        if overloaded:
+            self._overloaded.add(current)
+        conn = checkout.conn
+        checkout.conn = None
+        if keep and conn is not None and len(self._idle) < 16:
+            self._idle.append(conn)
+        if not held:
+            del self._inuse[current]
+            overloaded = current in self._overloaded
+            self._overloaded.discard(current)
+            self._bmcpool.limiter.release(overloaded)
+
+    def _do_web_request(self, *args, **kwargs):
+        current = eventlet.getcurrent()
+        nested = current in self._requesting
+        for attempt in (0, 1):
+            before = list(self._inuse.get(current, ()))
+            self._requesting.add(current)
+            try:
+                res = super(IpmiCommandWrapper, self)._do_web_request(
+                    *args, **kwargs)
+            except Exception as e:
+                stale = _stale_connection_error(e)
+                reused = False
+                for checkout in list(self._inuse.get(current, ())):
+                    if checkout in before:
+                        continue
+                    reused = reused or checkout.reused
+                    # the BMC closing a connection kept alive is no sign
+                    # of overload
+                    self._checkin(current, checkout,
+                                  overloaded=stale and not checkout.reused)
+                if not (stale and reused):
+                    raise
+                # the other idle connections are suspect as well
+                del self._idle[:]
+                if attempt or not _retriable_request(args, kwargs):
+                    raise
+                continue
+            else:
+                # the connection is only reused once pyghmi is done with it
+                for checkout in list(self._inuse.get(current, ())):
+                    if checkout not in before:
+                        self._checkin(current, checkout, keep=True)
+            finally:
+                if not nested:
+                    self._requesting.discard(current)
+                # anything still held was interrupted, not to be reused
+                for checkout in list(self._inuse.get(current, ())):
+                    if checkout not in before:
+                        self._checkin(current, checkout)
+            return res
+
+    def refresh_session(self):
+        # keeps the session token alive, pyghmi logs in again if it expired
+        self.lastrefreshed = util.monotonic_time()
+        self._do_web_request('/redfish/v1/SessionService', cache=False)
 
     def close_confluent(self):
         if self._attribwatcher:
@@ -192,24 +424,13 @@ class IpmiCommandWrapper(ipmicommand.Command):
             self._attribwatcher = None
 
     def _attribschanged(self, nodeattribs, configmanager, **kwargs):
-        try:
-            del persistent_ipmicmds[(self.node, configmanager.tenant)]
-        except KeyError:
-            pass
+        if persistent_ipmicmds.get(
+                (self.node, configmanager.tenant), None) is self:
+            _discard_ipmicmd(self.node, configmanager.tenant)
 
     def get_health(self):
-        if self._inhealth:
-            while self._inhealth:
-                eventlet.sleep(0.1)
-            return self._lasthealth
-        self._inhealth = True
-        try:
-            self._lasthealth = super(IpmiCommandWrapper, self).get_health()
-        except Exception as e:
-            self._inhealth = False
-            raise
-        self._inhealth = False
-        return self._lasthealth
+        return self._healthreader.read(
+            super(IpmiCommandWrapper, self).get_health)
 
 
 def _ipmi_evtloop():
@@ -261,46 +482,11 @@ def perform_requests(operator, nodes, element, cfg, inputdata, realop):
     cfg.decrypt = True
     configdata = cfg.get_node_attributes(nodes, _configattributes)
     cfg.decrypt = cryptit
-    resultdata = queue.LightQueue()
-    livingthreads = set([])
-    numnodes = len(nodes)
-    for node in nodes:
-        livingthreads.add(_ipmiworkers.spawn(
-            perform_request, operator, node, element, configdata, inputdata,
-            cfg, resultdata, realop))
-    while livingthreads:
-        try:
-            bundle = []
-            datum = resultdata.get(timeout=10)
-            while datum:
-                if datum != 'Done':
-                    if isinstance(datum, Exception):
-                        raise datum
-                    if (hasattr(datum, 'kvpairs') and datum.kvpairs and
-                            len(datum.kvpairs) == 1):
-                        bundle.append((list(datum.kvpairs)[0], datum))
-                        numnodes -= 1
-                    else:
-                        yield datum
-                timeout = 0.1 if numnodes else 0.001
-                datum = resultdata.get(timeout=timeout)
-        except queue.Empty:
-            pass
-        finally:
-            for datum in sorted(
-                    bundle, key=lambda x: util.naturalize_string(x[0])):
-                yield datum[1]
-        for t in list(livingthreads):
-            if t.dead:
-                livingthreads.discard(t)
-    try:
-        # drain queue if a thread put something on the queue and died
-        while True:
-            datum = resultdata.get_nowait()
-            if datum != 'Done':
-                yield datum
-    except queue.Empty:
-        pass
+    for datum in fanin.gather(
+            nodes, lambda node, results: _ipmiworkers.spawn(
+                perform_request, operator, node, element, configdata,
+                inputdata, cfg, results, realop)):
+        yield datum
 
 
 def perform_request(operator, node, element,
@@ -339,12 +525,47 @@ def perform_request(operator, node, element,
             results.put(msg.ConfluentNodeError(node, 'Unexpected Error: {0}'.format(str(e))))
             traceback.print_exc()
         finally:
-            results.put('Done')
-        if (node, cfg.tenant) in persistent_ipmicmds:
-            del persistent_ipmicmds[(node, cfg.tenant)]
+            results.put(fanin.NodeDone(node))
+        _discard_ipmicmd(node, cfg.tenant)
 
 persistent_ipmicmds = {}
 
+
+def _discard_ipmicmd(node, tenant):
+    ipmicmd = persistent_ipmicmds.pop((node, tenant), None)
+    if ipmicmd is not None:
+        ipmicmd.close_confluent()
+
+
+def _keep_sessions():
+    while True:
+        refresh = _get_redfish_option('session_refresh', 120)
+        eventlet.sleep(refresh)
+        now = util.monotonic_time()
+        for key in list(persistent_ipmicmds):
+            ipmicmd = persistent_ipmicmds.get(key, None)
+            if ipmicmd is None:
+                continue
+            if now - ipmicmd.lastused > _get_redfish_option('session_idle',
+                                                            1800):
+                _discard_ipmicmd(*key)
+            elif now - ipmicmd.lastrefreshed >= refresh:
+                _requestpool.spawn_n(_refresh_session, key, ipmicmd)
+
+
+def _start_session_keeper():
+    global _sessionkeeper
+    if _sessionkeeper is None:
+        _sessionkeeper = eventlet.spawn(_keep_sessions)
+
+
+def _refresh_session(key, ipmicmd):
+    try:
+        ipmicmd.refresh_session()
+    except Exception:
+        if persistent_ipmicmds.get(key, None) is ipmicmd:
+            _discard_ipmicmd(*key)
+
 class IpmiHandler(object):
     def __init__(self, operation, node, element, cfd, inputdata, cfg, output,
                  realop):
@@ -368,10 +589,7 @@ class IpmiHandler(object):
         self.tenant = cfg.tenant
         tenant = cfg.tenant
         if (node, tenant) not in persistent_ipmicmds:
-            try:
-                persistent_ipmicmds[(node, tenant)].close_confluent()
-            except KeyError:  # was no previous session
-                pass
+            _start_session_keeper()
             try:
                 persistent_ipmicmds[(node, tenant)] = IpmiCommandWrapper(
                     node, cfg, bmc=connparams['bmc'],
@@ -384,6 +602,7 @@ class IpmiHandler(object):
                     raise exc.TargetEndpointUnreachable(ge.strerror)
                 raise
         self.ipmicmd = persistent_ipmicmds[(node, tenant)]
+        self.ipmicmd.lastused = util.monotonic_time()
 
     bootdevices = {
         'optical': 'cd'
@@ -873,7 +1092,7 @@ class IpmiHandler(object):
             svid = myinf.get('PCI Subsystem Vendor ID', None)
             did = myinf.get('PCI Device ID', None)
             vid = myinf.get('PCI Vendor ID', None)
-            vstr, dstr = get_pci_text_from_ids(sdid, svid, did, vid)
+            vstr, dstr = pciids.get_pci_text_from_ids(sdid, svid, did, vid)
             if vstr:
                 newinf['information']['PCI Vendor'] = vstr
             if dstr:
@@ -1146,6 +1365,8 @@ class IpmiHandler(object):
                 badsensors = []
                 for reading in response['badreadings']:
                     if hasattr(reading, 'health'):
+                        # the response may be shared with other requests
+                        reading = copy.copy(reading)
                         reading.health = _str_health(reading.health)
                     badsensors.append(reading)
                 self.output.put(msg.SensorReadings(badsensors, name=self.node))
@@ -1437,10 +1658,31 @@ def retrieve(nodes, element, configmanager, inputdata):
     elif '/'.join(element).startswith('support/servicedata'):
         return firmwaremanager.list_updates(nodes, configmanager.tenant,
                                             element, 'ffdc')
+    elif element[0] == 'sensors':
+        return sensorcache.retrieve_sensors(
+            nodes, element, configmanager, sensor_categories,
+            lambda nodes: perform_requests('read', nodes, element,
+                                           configmanager, inputdata, 'read'))
+    elif element == ['health', 'hardware']:
+        return healthcache.retrieve_health(
+            nodes, configmanager, inputdata,
+            lambda nodes: perform_requests('read', nodes, element,
+                                           configmanager, inputdata, 'read'))
+    elif element[0] == 'inventory':
+        return inventorycache.retrieve_inventory(
+            nodes, element, configmanager, inputdata,
+            lambda nodes: perform_requests('read', nodes, element,
+                                           configmanager, inputdata, 'read'))
     else:
         return perform_requests('read', nodes, element, configmanager,
                                 inputdata, 'read')
 
+
+def sample_sensors(nodes, category, configmanager):
+    return perform_requests('read', nodes,
+                            ['sensors', 'hardware', category, 'all'],
+                            configmanager, None, 'read')
+
 def delete(nodes, element, configmanager, inputdata):
     if '/'.join(element).startswith('inventory/firmware/updates/active'):
         return firmwaremanager.remove_updates(nodes, configmanager.tenant,
@@ -1453,3 +1695,6 @@ def delete(nodes, element, configmanager, inputdata):
                                               element, type='ffdc')
     return perform_requests(
         'delete', nodes, element, configmanager, inputdata, 'delete')
+
+
+sensorcache.register_sampler('redfish', sample_sensors, simplify_name)
@@ -9,6 +9,7 @@ import eventlet.green.subprocess as subprocess
 import confluent.discovery.handlers.xcc as xcc
 import confluent.discovery.handlers.tsm as tsm
 import crypt
+import hashlib
 import json
 import os
 import time
@@ -18,6 +19,10 @@ currtz = None
 keymap = 'us'
 currlocale = 'en_US.UTF-8'
 currtzvintage = None
+# digests of the api keys verified for each node, dropped when the
+# crypted.selfapikey of the node changes
+_verifiedkeys = {}
+_keywatched = set([])
 
 
 def yamldump(input):
@@ -41,6 +46,33 @@ def get_extra_names(nodename, cfg):
                         names.add('{0}.{1}'.format(currname, domain))
     return names
 
+def _selfapikey_changed(nodeattribs, configmanager, **kwargs):
+    for node in nodeattribs:
+        _verifiedkeys.pop(node, None)
+
+
+def _verify_apikey(cfg, nodename, apikey):
+    if not isinstance(apikey, bytes):
+        digest = hashlib.sha256(apikey.encode('utf8')).digest()
+    else:
+        digest = hashlib.sha256(apikey).digest()
+    if _verifiedkeys.get(nodename, None) == digest:
+        return True
+    eak = cfg.get_node_attributes(nodename, 'crypted.selfapikey').get(
+        nodename, {}).get('crypted.selfapikey', {}).get('hashvalue', None)
+    if not eak:
+        return False
+    if nodename not in _keywatched:
+        _keywatched.add(nodename)
+        cfg.watch_attributes((nodename,), ('crypted.selfapikey',),
+                             _selfapikey_changed)
+    salt = '$'.join(eak.split('$', 3)[:-1]) + '$'
+    if crypt.crypt(apikey, salt) != eak:
+        return False
+    _verifiedkeys[nodename] = digest
+    return True
+
+
 def handle_request(env, start_response):
     global currtz
     global keymap
@@ -54,14 +86,7 @@ def handle_request(env, start_response):
         yield 'Unauthorized'
         return
     cfg = configmanager.ConfigManager(None)
-    eak = cfg.get_node_attributes(nodename, 'crypted.selfapikey').get(
-        nodename, {}).get('crypted.selfapikey', {}).get('hashvalue', None)
-    if not eak:
-        start_response('401 Unauthorized', [])
-        yield 'Unauthorized'
-        return
-    salt = '$'.join(eak.split('$', 3)[:-1]) + '$'
-    if crypt.crypt(apikey, salt) != eak:
+    if not _verify_apikey(cfg, nodename, apikey):
         start_response('401 Unauthorized', [])
         yield 'Unauthorized'
         return
@@ -0,0 +1,308 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2019 Lenovo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This is an optional background sampler of hardware sensors.  When
+# 'sample_interval' is set in the [sensors] section of service.cfg, the
+# sensors of managed nodes are read on that interval by the hardware
+# management plugins that registered a sampler, and kept in a fixed size
+# history per node.  Sensor requests are then answered from the most recent
+# sample if it is no older than 'max_age' seconds, and the history is
+# available under /nodes/<node>/sensors/history/.
+# Other settings in the same section:
+# - sample_categories: comma separated sensor categories to sample (all)
+# - history_size: number of samples kept per node (60)
+# - bmc_concurrency: nodes sampled at once behind the same BMC (1)
+# - sample_concurrency: nodes sampled at once overall (64)
+
+import array
+import confluent.collective.manager as collective
+import confluent.config.conf as conf
+import confluent.config.configmanager as configmanager
+import confluent.log as log
+import confluent.messages as msg
+import confluent.util as util
+import eventlet
+import time
+
+_samplers = {}
+_histories = {}
+_samplerthread = None
+_nan = float('nan')
+
+
+class _NodeHistory(object):
+    """Ring buffer of the sensor samples of a node
+
+    Timestamps are shared by all sensors of the node, and values are kept in
+    preallocated arrays, one per sensor.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array.array('d', [0.0]) * size
+        self.values = {}
+        self.pos = 0
+        self.count = 0
+        self.latest = {}
+        self.names = {}
+        self.categories = set([])
+        self.sampled = None
+
+    def record(self, readings, categories, simplify):
+        slot = self.pos
+        self.times[slot] = time.time()
+        seen = set([])
+        for reading in readings:
+            name = reading['name']
+            seen.add(name)
+            values = self.values.get(name, None)
+            if values is None:
+                values = array.array('f', [_nan]) * self.size
+                self.values[name] = values
+            value = reading.get('value', None)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                value = _nan
+            values[slot] = value
+        for name in self.values:
+            if name not in seen:
+                self.values[name][slot] = _nan
+        self.pos = (slot + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.latest = dict((reading['name'], reading) for reading in readings)
+        self.names = dict((simplify(name), name) for name in self.latest)
+        self.categories = set(categories)
+        self.sampled = util.monotonic_time()
+
+    def history(self, name):
+        values = self.values.get(name, None)
+        if values is None:
+            return []
+        samples = []
+        for idx in range(self.pos - self.count, self.pos):
+            value = values[idx % self.size]
+            if value == value:  # skip NaN, where there was no reading
+                samples.append([self.times[idx % self.size], value])
+        return samples
+
+
+def register_sampler(method, sampler, simplify):
+    """Register a plugin able to sample sensors in the background
+
+    :param method: The hardwaremanagement.method served by the plugin
+    :param sampler: Function given a list of nodes, a sensor category and a
+                    configmanager, returning the SensorReadings for the nodes
+    :param simplify: Function giving the resource name of a sensor
+    """
+    _samplers[method] = (sampler, simplify)
+
+
+def _sample_interval():
+    return conf.get_int_option('sensors', 'sample_interval') or 0
+
+
+def _max_age():
+    maxage = conf.get_int_option('sensors', 'max_age')
+    if maxage is None:
+        maxage = _sample_interval() * 2
+    return maxage
+
+
+def _sample_categories():
+    categories = conf.get_option('sensors', 'sample_categories')
+    if not categories:
+        return ['all']
+    return [x.strip() for x in categories.split(',') if x.strip()]
+
+
+def _history_size():
+    return conf.get_int_option('sensors', 'history_size') or 60
+
+
+def _bmc_concurrency():
+    return conf.get_int_option('sensors', 'bmc_concurrency') or 1
+
+
+def _sample_concurrency():
+    return conf.get_int_option('sensors', 'sample_concurrency') or 64
+
+
+def _sample_batches(nodes, bmcs):
+    # Limit how many nodes behind one BMC are sampled together, as well as
+    # how many are sampled at once overall
+    perbmc = _bmc_concurrency()
+    batchsize = _sample_concurrency()
+    pending = list(nodes)
+    while pending:
+        batch = []
+        deferred = []
+        counts = {}
+        for node in pending:
+            bmc = bmcs.get(node, node)
+            if len(batch) >= batchsize or counts.get(bmc, 0) >= perbmc:
+                deferred.append(node)
+                continue
+            counts[bmc] = counts.get(bmc, 0) + 1
+            batch.append(node)
+        yield batch
+        pending = deferred
+
+
+def _sample_nodes(method, nodes, bmcs, cfg):
+    tenant = cfg.tenant
+    sampler, simplify = _samplers[method]
+    categories = _sample_categories()
+    size = _history_size()
+    for batch in _sample_batches(nodes, bmcs):
+        readings = dict((node, []) for node in batch)
+        for category in categories:
+            for rsp in sampler(batch, category, cfg):
+                kvpairs = getattr(rsp, 'kvpairs', None) or {}
+                for node in kvpairs:
+                    if node in readings and isinstance(kvpairs[node], dict):
+                        readings[node].extend(
+                            kvpairs[node].get('sensors', []))
+        for node in batch:
+            if not readings[node]:
+                continue  # nothing read, leave whatever was there
+            history = _histories.get((tenant, node), None)
+            if history is None or history.size != size:
+                history = _NodeHistory(size)
+                _histories[(tenant, node)] = history
+            history.record(readings[node], categories, simplify)
+
+
+def sample_once():
+    """Sample the sensors of all nodes managed by this server"""
+    cfg = configmanager.ConfigManager(None)
+    nodes = list(cfg.list_nodes())
+    attribs = cfg.get_node_attributes(
+        nodes, ('hardwaremanagement.method', 'hardwaremanagement.manager',
+                'collective.manager'))
+    myname = collective.get_myname()
+    bymethod = {}
+    bmcs = {}
+    for node in nodes:
+        nodeattr = attribs.get(node, {})
+        manager = nodeattr.get('collective.manager', {}).get('value', None)
+        if manager and manager != myname:
+            continue
+        method = nodeattr.get('hardwaremanagement.method', {}).get(
+            'value', 'ipmi')
+        if method not in _samplers:
+            continue
+        bymethod.setdefault(method, []).append(node)
+        bmc = nodeattr.get('hardwaremanagement.manager', {}).get('value', None)
+        if bmc:
+            bmcs[node] = bmc.split('/', 1)[0]
+    for tenant, node in list(_histories):
+        if tenant == cfg.tenant and node not in attribs:
+            del _histories[(tenant, node)]
+    for method in bymethod:
+        _sample_nodes(method, bymethod[method], bmcs, cfg)
+
+
+def _sample_forever():
+    while True:
+        interval = _sample_interval()
+        if not interval:
+            return
+        start = util.monotonic_time()
+        try:
+            sample_once()
+        except Exception:
+            log.logtrace()
+        eventlet.sleep(max(interval - (util.monotonic_time() - start), 1))
+
+
+def start_sampler():
+    global _samplerthread
+    if not _sample_interval() or _samplerthread is not None:
+        return
+    _samplerthread = eventlet.spawn(_sample_forever)
+
+
+def _cached_readings(tenant, node, category, sensorname, categories):
+    history = _histories.get((tenant, node), None)
+    if history is None or history.sampled is None:
+        return None
+    if util.monotonic_time() - history.sampled > _max_age():
+        return None
+    if 'all' not in history.categories and category not in history.categories:
+        return None
+    if sensorname != 'all':
+        if sensorname not in history.names:
+            return None
+        return [history.latest[history.names[sensorname]]]
+    readings = []
+    for reading in history.latest.values():
+        if (category == 'all' or
+                reading.get('type', None) in categories.get(category, ())):
+            readings.append(reading)
+    return readings
+
+
+def retrieve_sensors(nodes, element, configmanager, categories, fetch):
+    """Answer a sensor request from recent samples where possible
+
+    :param nodes: The nodes requested
+    :param element: The path of the request
+    :param configmanager: The configuration manager of the request
+    :param categories: Map of sensor categories to the sensor types in them
+    :param fetch: Function to read the sensors of a list of nodes directly
+    """
+    if element[-1] == '':
+        element = element[:-1]
+    if element[:2] == ['sensors', 'history']:
+        for rsp in _retrieve_history(configmanager.tenant, nodes, element):
+            yield rsp
+        return
+    if (not _sample_interval() or len(element) != 4 or
+            element[2] == 'leds'):
+        for rsp in fetch(nodes):
+            yield rsp
+        return
+    missing = []
+    for node in nodes:
+        readings = _cached_readings(configmanager.tenant, node, element[2],
+                                    element[3], categories)
+        if readings is None:
+            missing.append(node)
+            continue
+        yield msg.SensorReadings(readings, name=node)
+    if missing:
+        for rsp in fetch(missing):
+            yield rsp
+
+
+def _retrieve_history(tenant, nodes, element):
+    if len(element) == 2:
+        names = set([])
+        for node in nodes:
+            if (tenant, node) in _histories:
+                names.update(_histories[(tenant, node)].names)
+        for name in sorted(names):
+            yield msg.ChildCollection(name)
+        return
+    sensorname = element[2]
+    for node in nodes:
+        history = _histories.get((tenant, node), None)
+        if history is None or sensorname not in history.names:
+            yield msg.ConfluentTargetNotFound(node,
+                                              'No history for sensor')
+            continue
+        name = history.names[sensorname]
+        units = history.latest.get(name, {}).get('units', None)
+        yield msg.SensorHistory(name, units, history.history(name), node)
@@ -139,22 +139,36 @@ def sessionhdl(connection, authname, skipauth=False, cert=None):
             dreq = tlvdata.recvall(connection, response['dispatch']['length'])
             return pluginapi.handle_dispatch(connection, cert, dreq,
                                              response['dispatch']['name'])
+        if 'dispatchstream' in response:
+            return pluginapi.handle_dispatch_stream(
+                connection, cert, response['dispatchstream']['name'])
         if 'proxyconsole' in response:
             return start_proxy_term(connection, cert, response['proxyconsole'])
         authname = response['username']
-        passphrase = response['password']
         # note(jbjohnso): here, we need to authenticate, but not
         # authorize a user.  When authorization starts understanding
         # element path, that authorization will need to be called
         # per request the user makes
-        authdata = auth.check_user_passphrase(authname, passphrase)
+        if 'sessiontoken' in response:
+            # a token from an earlier session stands in for the passphrase
+            if auth.check_session_token(response['sessiontoken']) == authname:
+                authdata = auth.authorize(authname, element=None)
+            else:
+                authdata = None
+        else:
+            authdata = auth.check_user_passphrase(authname,
+                                                  response['password'])
         if not authdata:
             auditlog.log(
                 {'operation': 'connect', 'user': authname, 'allowed': False})
         else:
             authenticated = True
             cfm = authdata[1]
-    send_data(connection, {'authpassed': 1})
+    if authdata and not skipauth:
+        send_data(connection, {'authpassed': 1, 'sessiontoken':
+                               auth.make_session_token(authname)})
+    else:
+        send_data(connection, {'authpassed': 1})
     request = tlvdata.recv(connection)
     if request and 'collective' in request:
         if skipauth:
@@ -108,6 +108,26 @@ def monotonic_time():
     return os.times()[4]
 
 
+def get_resident_memory():
+    """Return the resident memory of this process in kilobytes
+
+    Falls back to the peak resident size where current usage is not
+    readily available.
+    """
+    try:
+        with open('/proc/self/status') as statusfile:
+            for line in statusfile:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        return None
+
+
 def get_certificate_from_file(certfile):
     cert = open(certfile, 'r').read()
     inpemcert = False
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2017 Lenovo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compare memory used by node records as unpickled from the configuration
+# store against the compact layout with interned attribute names and shared
+# inherited values.
+# usage: configmembench.py [nodes] [groups] [attributes per group]
+
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+path = os.path.dirname(os.path.realpath(__file__))
+path = os.path.realpath(os.path.join(path, '..'))
+if path.startswith('/opt'):
+    sys.path.append(path)
+
+import confluent.config.configmanager as configmanager
+
+numnodes = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+numgroups = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+numattribs = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+
+def make_groups():
+    groups = {}
+    for gnum in range(numgroups):
+        group = 'group{0}'.format(gnum)
+        groups[group] = {'nodes': set([])}
+        for anum in range(numattribs):
+            attrib = 'attribute{0}.{1}'.format(gnum, anum)
+            groups[group][attrib] = {'value': 'value{0}-{1}'.format(gnum,
+                                                                     anum)}
+    return groups
+
+
+def make_pickled_nodes(groups):
+    # as the records are written to and read from the dbm store
+    pickled = []
+    for nnum in range(numnodes):
+        node = {'groups': sorted(groups),
+                'id.serial': {'value': 'serial{0}'.format(nnum)}}
+        for group in groups:
+            for attrib in groups[group]:
+                if attrib == 'nodes':
+                    continue
+                node[attrib] = dict(groups[group][attrib])
+                node[attrib]['inheritedfrom'] = group
+        pickled.append(pickle.dumps(node))
+    return pickled
+
+
+def measure(pickled, loader):
+    tracemalloc.start()
+    start = time.time()
+    records = [loader(x) for x in pickled]
+    elapsed = time.time() - start
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return records, used, elapsed
+
+
+groups = make_groups()
+pickled = make_pickled_nodes(groups)
+legacy, legacyused, legacytime = measure(pickled, pickle.loads)
+compact, compactused, compacttime = measure(
+    pickled,
+    lambda x: configmanager._compact_record(pickle.loads(x), groups=groups))
+if legacy != compact:
+    sys.stderr.write('Compact records do not match legacy records\n')
+    sys.exit(1)
+print('{0} nodes, {1} groups, {2} inherited attributes per group'.format(
+    numnodes, numgroups, numattribs))
+print('Legacy layout:  {0:>12} bytes ({1:.0f} per node) in {2:.3f}s'.format(
+    legacyused, float(legacyused) / numnodes, legacytime))
+print('Compact layout: {0:>12} bytes ({1:.0f} per node) in {2:.3f}s'.format(
+    compactused, float(compactused) / numnodes, compacttime))
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2017 Lenovo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compare the CPU time and memory of keeping a terminal emulation per
+# console, fed all output as it arrives, against keeping only the replay
+# buffer of lazy_screen and reconstructing the screen of a few consoles.
+# usage: consolebench.py [consoles] [chunks per console] [screens rendered]
+
+import os
+import random
+import subprocess
+import sys
+import time
+path = os.path.dirname(os.path.realpath(__file__))
+path = os.path.realpath(os.path.join(path, '..'))
+if path.startswith('/opt'):
+    sys.path.append(path)
+
+import pyte
+import confluent.consoleserver as consoleserver
+
+numconsoles = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+numchunks = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+numrendered = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+
+def make_chunks():
+    # something like the output of a booting OS, with some color and the
+    # occasional clear screen of a firmware menu
+    rand = random.Random(1)
+    chunks = []
+    for num in range(numchunks):
+        if num % 20 == 0:
+            chunks.append(b'\x1b[2J\x1b[1;1H\x1b[1;37;44m Setup \x1b[0m\r\n')
+            continue
+        chunk = b''
+        for _ in range(rand.randint(1, 8)):
+            chunk += b'[  %5d.%06d] \x1b[32mOK\x1b[0m Started unit %d\r\n' % (
+                rand.randint(0, 99), rand.randint(0, 999999),
+                rand.randint(0, 9999))
+        chunks.append(chunk)
+    return chunks
+
+
+def rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def run(mode):
+    chunks = make_chunks()
+    startrss = rss()
+    start = time.process_time()
+    consoles = []
+    for _ in range(numconsoles):
+        if mode == 'full':
+            screen = pyte.Screen(100, 31)
+            stream = pyte.ByteStream()
+            stream.attach(screen)
+            consoles.append((screen, stream))
+        else:
+            consoles.append(consoleserver.ReplayBuffer(16384))
+    for chunk in chunks:
+        for console in consoles:
+            if mode == 'full':
+                console[1].feed(chunk)
+            else:
+                console.append(chunk)
+    for console in consoles[:numrendered]:
+        if mode == 'full':
+            console[0].display
+        else:
+            console.render().display
+    elapsed = time.process_time() - start
+    return elapsed, rss() - startrss
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 4:
+        elapsed, used = run(sys.argv[4])
+        print('{0} {1}'.format(elapsed, used))
+        sys.exit(0)
+    print('{0} consoles, {1} chunks each, {2} screens rendered'.format(
+        numconsoles, numchunks, numrendered))
+    for mode, name in (('full', 'Terminal emulation:'),
+                       ('lazy', 'Replay buffer:')):
+        # a process of its own for each, to measure memory apart
+        out = subprocess.check_output(
+            [sys.executable, os.path.realpath(__file__), str(numconsoles),
+             str(numchunks), str(numrendered), mode])
+        elapsed, used = out.split()
+        print('{0:<20} {1:8.3f}s CPU {2:>12} bytes RSS growth'.format(
+            name, float(elapsed), int(used)))
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2017 Lenovo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measure console log throughput, writing each record as it is logged
+# against leaving records to the group commit of the log writer thread.
+# Logs are written to a scratch directory, not /var/log/confluent.
+# usage: logbench.py [consoles] [records per console] [record size]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+path = os.path.dirname(os.path.realpath(__file__))
+path = os.path.realpath(os.path.join(path, '..'))
+if path.startswith('/opt'):
+    sys.path.append(path)
+
+import confluent.config.configmanager as configmanager
+import confluent.log as log
+
+numconsoles = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+numrecords = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+recordsize = int(sys.argv[3]) if len(sys.argv) > 3 else 80
+
+
+def run(buffered):
+    logdir = tempfile.mkdtemp()
+    configmanager.get_global = lambda key: logdir
+    log._loggers.clear()
+    try:
+        loggers = [log.Logger('bench{0}'.format(idx), console=True,
+                              buffered=buffered)
+                   for idx in range(numconsoles)]
+        record = b'x' * (recordsize - 2) + b'\r\n'
+        start = time.time()
+        startcpu = time.process_time()
+        for _ in range(numrecords):
+            for logger in loggers:
+                logger.log(record)
+        # the time taken from whoever logs, on the hub in confluent
+        logged = time.time() - start
+        log.flush()
+        elapsed = time.time() - start
+        cpu = time.process_time() - startcpu
+        for logger in loggers:
+            logger.closelog()
+        return logged, elapsed, cpu
+    finally:
+        shutil.rmtree(logdir)
+
+
+if __name__ == '__main__':
+    total = numconsoles * numrecords
+    print('{0} consoles, {1} records of {2} bytes each'.format(
+        numconsoles, numrecords, recordsize))
+    for buffered, name in ((False, 'Per record:'), (True, 'Group commit:')):
+        logged, elapsed, cpu = run(buffered)
+        print('{0:<14} {1:8.3f}s logging {2:8.3f}s total {3:8.3f}s CPU '
+              '{4:>10.0f} records/s'.format(name, logged, elapsed, cpu,
+                                            total / elapsed))
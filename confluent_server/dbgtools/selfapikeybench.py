@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2017 Lenovo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Simulate many nodes deploying at once, each making a number of /self/
+# requests, and measure the cost of verifying their api keys with the
+# verified key cache against crypting the key on every request.  The node
+# configuration is held in memory here, so only verification is measured.
+# usage: selfapikeybench.py [nodes] [requests per node] [concurrency]
+
+import crypt
+import os
+import sys
+import time
+path = os.path.dirname(os.path.realpath(__file__))
+path = os.path.realpath(os.path.join(path, '..'))
+if path.startswith('/opt'):
+    sys.path.append(path)
+
+import eventlet
+import eventlet.greenpool
+import confluent.selfservice as selfservice
+
+numnodes = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+numrequests = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+
+class BenchConfig(object):
+    # stands in for the ConfigManager, answering only what verifying needs
+
+    def __init__(self, apikeys):
+        self.attribs = {}
+        for node in apikeys:
+            self.attribs[node] = {'crypted.selfapikey': {
+                'hashvalue': crypt.crypt(
+                    apikeys[node], crypt.mksalt(crypt.METHOD_SHA512))}}
+
+    def get_node_attributes(self, nodename, attributes):
+        return {nodename: self.attribs.get(nodename, {})}
+
+    def watch_attributes(self, nodes, attributes, callback):
+        pass
+
+
+def deploy(cfg, nodename, apikey, cached):
+    # a node working through its deployment, one request after another
+    for _ in range(numrequests):
+        if not cached:
+            selfservice._verifiedkeys.clear()
+        if not selfservice._verify_apikey(cfg, nodename, apikey):
+            raise Exception('{0} failed verification'.format(nodename))
+        eventlet.sleep(0)
+
+
+def run(cfg, apikeys, cached):
+    selfservice._verifiedkeys.clear()
+    pool = eventlet.greenpool.GreenPool(concurrency)
+    start = time.time()
+    startcpu = time.process_time()
+    for node in apikeys:
+        pool.spawn_n(deploy, cfg, node, apikeys[node], cached)
+    pool.waitall()
+    return time.time() - start, time.process_time() - startcpu
+
+
+if __name__ == '__main__':
+    apikeys = dict(('n{0}'.format(idx), os.urandom(16).hex())
+                   for idx in range(numnodes))
+    cfg = BenchConfig(apikeys)
+    total = numnodes * numrequests
+    print('{0} nodes, {1} requests each, {2} at a time'.format(
+        numnodes, numrequests, concurrency))
+    for cached, name in ((False, 'Crypt each:'), (True, 'Cached:')):
+        elapsed, cpu = run(cfg, apikeys, cached)
+        print('{0:<12} {1:8.3f}s {2:8.3f}s CPU {3:>10.0f} requests/s'.format(
+            name, elapsed, cpu, total / elapsed))
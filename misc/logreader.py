@@ -1,5 +1,6 @@
 #!/usr/bin/python2
 import collections
+import mmap
 import os
 import struct
 import sys
@@ -21,8 +22,9 @@ def writeout(data):
 
 class LogReplay(object):
     def __init__(self, logfile, cblfile):
-        self.bin = open(cblfile, 'r')
-        self.txt = open(logfile, 'r')
+        # mapped rather than read, so walking records takes no system calls
+        self.bin = self._map(cblfile)
+        self.txt = self._map(logfile)
         self.cleardata = []
         self.clearidx = 0
         self.pendingdata = collections.deque([])
@@ -30,6 +32,11 @@ class LogReplay(object):
         self.laststamp = None
         self.needclear = False
 
+    @staticmethod
+    def _map(filename):
+        with open(filename, 'rb') as logfile:
+            return mmap.mmap(logfile.fileno(), 0, access=mmap.ACCESS_READ)
+
     def _rewind(self, datasize=None):
         curroffset = self.bin.tell() - 16
         if self.cleardata and self.clearidx > 1: